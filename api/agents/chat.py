@@ -2,18 +2,41 @@
 Agent chat endpoints
 """
 
-from fastapi import HTTPException, Depends
+from fastapi import HTTPException, Depends, Request
 from sqlalchemy.orm import Session
+from typing import Optional
+import asyncio
 import time
 
 from database import get_db, Agent as DBAgent
 from genagents.genagents import GenerativeAgent
+from simulation_engine.settings import CHAT_DEADLINE_SECONDS
+from simulation_engine.scheduler import llm_priority
+from simulation_engine.deadline import Deadline, DeadlineExceeded, deadline
 from api.models import ChatRequest, ChatResponse
 
 # Import shared state
 from api.shared_state import loaded_agents, conversation_histories
 
-async def chat_with_agent(agent_id: str, request: ChatRequest, db: Session = Depends(get_db)):
+async def _utterance_until_disconnect(agent, history, http_request: Optional[Request]):
+    """
+    Runs agent.utterance in a worker thread under the chat deadline, and
+    cancels its LLM calls (queued or streaming) if the client disconnects.
+    """
+    chat_deadline = Deadline(CHAT_DEADLINE_SECONDS)
+    # The task copies the current context, so the thread's LLM calls see both
+    # the deadline and the interactive priority class.
+    with deadline(curr_deadline=chat_deadline), llm_priority("interactive"):
+        task = asyncio.ensure_future(asyncio.to_thread(agent.utterance, history))
+
+    while not task.done():
+        done, _ = await asyncio.wait({task}, timeout=0.25)
+        if not done and http_request is not None and await http_request.is_disconnected():
+            chat_deadline.cancel()
+    return task.result()
+
+async def chat_with_agent(agent_id: str, request: ChatRequest, db: Session = Depends(get_db),
+                          http_request: Optional[Request] = None):
     """
     Send a message to an agent and get a response
     """
@@ -77,8 +100,10 @@ async def chat_with_agent(agent_id: str, request: ChatRequest, db: Session = Dep
         # Generate response from agent using the full conversation history
         try:
             if hasattr(agent, 'utterance') and callable(getattr(agent, 'utterance')):
-                # Use the conversation history as done in main.py
-                response = agent.utterance(conversation_histories[agent_id])
+                # Use the conversation history as done in main.py. Chat 
+                # requests go ahead of queued batch work (surveys, ingestion).
+                response = await _utterance_until_disconnect(
+                    agent, list(conversation_histories[agent_id]), http_request)
                 
                 # Add agent's response to conversation history
                 conversation_histories[agent_id].append([agent.get_fullname(), response])
@@ -86,6 +111,11 @@ async def chat_with_agent(agent_id: str, request: ChatRequest, db: Session = Dep
                 # Fallback: create a simple response based on agent's memories
                 response = f"As {agent_name}, I remember my experiences from the interview. You said: '{request.message}'. Based on what I shared during my interview, I think..."
                 conversation_histories[agent_id].append([agent_name, response])  # type: ignore
+        except DeadlineExceeded as e:
+            # The message was not answered; it is dropped from the history so
+            # a retry does not send it twice.
+            conversation_histories[agent_id].pop()
+            raise HTTPException(status_code=504, detail=f"Agent did not respond in time: {str(e)}")
         except Exception as e:
             print(f"Error generating utterance: {str(e)}")
             print(f"Error type: {type(e)}")
@@ -102,6 +132,8 @@ async def chat_with_agent(agent_id: str, request: ChatRequest, db: Session = Dep
             timestamp=time.strftime("%Y-%m-%d %H:%M:%S")
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error chatting with agent: {str(e)}")
 
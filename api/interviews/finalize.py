@@ -51,6 +51,9 @@ async def finalize_agent_creation(session_id: str, db: Session = Depends(get_db)
             loaded_agents[session_id] = agent
         
         agent = loaded_agents[session_id]
+        # The memories' embeddings are requested in batches; make sure they
+        # are all in before the memory stream is stored.
+        agent.memory_stream.flush_embeddings()
         print(f"Using agent, has memory_stream: {hasattr(agent, 'memory_stream')}")
         agent_path = session.agent_path
         
@@ -2,7 +2,7 @@
 Main API router that combines all endpoints
 """
 
-from fastapi import FastAPI, Depends
+from fastapi import FastAPI, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.orm import Session
 
@@ -93,8 +93,9 @@ async def get_agent_details_endpoint(agent_id: str, db: Session = Depends(get_db
     return await get_agent_details(agent_id, db)
 
 @app.post("/agents/{agent_id}/chat", response_model=ChatResponse)
-async def chat_with_agent_endpoint(agent_id: str, request: ChatRequest, db: Session = Depends(get_db)):
-    return await chat_with_agent(agent_id, request, db)
+async def chat_with_agent_endpoint(agent_id: str, request: ChatRequest, http_request: Request,
+                                   db: Session = Depends(get_db)):
+    return await chat_with_agent(agent_id, request, db, http_request)
 
 @app.delete("/agents/{agent_id}/chat")
 async def clear_conversation_history_endpoint(agent_id: str):
@@ -0,0 +1,106 @@
+"""
+Benchmark of the environment execution modes on a synthetic population.
+
+Every task does the CPU-bound part of a survey call in pure Python (relevance
+scoring of every memory node against a focal embedding, like
+extract_relevance, plus prompt rendering) followed by a sleep that stands in
+for the LLM latency. No API calls are made. The timings are only reported:
+how far the process modes scale depends on the CPU count of the machine
+(printed first), so nothing is asserted about it.
+
+Usage:
+  python benchmarks/executor_scaling.py --agents 400 --nodes 2000
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from genagents.modules.memory_stream import cos_sim
+from environment.agent_pool import AgentPool
+from environment.executor import ThreadTaskExecutor, HybridExecutor
+
+
+def make_population(population_dir, num_agents, num_nodes, dim):
+  rng = random.Random(0)
+  tasks = []
+  for count in range(num_agents):
+    agent_folder = f"{population_dir}/agent_{count:05d}"
+    os.makedirs(f"{agent_folder}/memory_stream", exist_ok=True)
+    nodes = []
+    embeddings = {}
+    for node_id in range(num_nodes):
+      content = f"agent {count} memory {node_id}"
+      nodes += [{"node_id": node_id, "node_type": "observation",
+                 "content": content, "importance": rng.randint(0, 100),
+                 "created": node_id, "last_retrieved": node_id,
+                 "pointer_id": None}]
+      embeddings[content] = [rng.random() for _ in range(dim)]
+    with open(f"{agent_folder}/scratch.json", "w") as f:
+      json.dump({"first_name": f"Agent{count}", "last_name": "Bench"}, f)
+    with open(f"{agent_folder}/memory_stream/nodes.json", "w") as f:
+      json.dump(nodes, f)
+    with open(f"{agent_folder}/memory_stream/embeddings.json", "w") as f:
+      json.dump(embeddings, f)
+    tasks += [(f"agent_{count:05d}", {"agent_folder": agent_folder}, ())]
+  return tasks
+
+
+def bench_task(agent, focal_embedding, llm_latency):
+  memory_stream = agent.memory_stream
+  scores = {node.node_id: cos_sim(memory_stream.embeddings[node.content],
+                                  focal_embedding)
+            for node in memory_stream.seq_nodes}
+  top = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:120]
+  prompt = "\n".join(memory_stream.id_to_node[i].content for i, _ in top)
+  time.sleep(llm_latency)
+  return len(prompt)
+
+
+def run(executor, tasks, rounds):
+  start = time.time()
+  for _ in range(rounds):
+    for _ in executor.run(bench_task, tasks):
+      pass
+  executor.shutdown()
+  return time.time() - start
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--agents", type=int, default=200)
+  parser.add_argument("--nodes", type=int, default=1000)
+  parser.add_argument("--dim", type=int, default=64)
+  parser.add_argument("--threads", type=int, default=32)
+  parser.add_argument("--latency", type=float, default=0.05)
+  parser.add_argument("--rounds", type=int, default=2)
+  parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+  args = parser.parse_args()
+
+  print (f"cpus={os.cpu_count()}  agents={args.agents}  nodes={args.nodes}  "
+         f"threads={args.threads}  latency={args.latency}s")
+  with tempfile.TemporaryDirectory() as population_dir:
+    tasks = make_population(population_dir, args.agents, args.nodes, args.dim)
+    focal_embedding = [random.random() for _ in range(args.dim)]
+    tasks = [(key, agent_meta, (focal_embedding, args.latency))
+             for key, agent_meta, _ in tasks]
+    num_tasks = len(tasks) * args.rounds
+
+    seconds = run(ThreadTaskExecutor(AgentPool(), args.threads),
+                  tasks, args.rounds)
+    print (f"threads    workers=1  {seconds:7.2f}s  "
+           f"{num_tasks / seconds:8.1f} tasks/s")
+
+    num_workers = 2
+    while num_workers <= args.max_workers:
+      executor = HybridExecutor(num_workers,
+                                max(1, args.threads // num_workers))
+      seconds = run(executor, tasks, args.rounds)
+      print (f"processes  workers={num_workers:<2} {seconds:7.2f}s  "
+             f"{num_tasks / seconds:8.1f} tasks/s")
+      num_workers *= 2
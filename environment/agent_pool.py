@@ -0,0 +1,207 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+from simulation_engine.settings import *
+from simulation_engine.global_methods import *
+from genagents.genagents import GenerativeAgent
+
+
+def resolve_agent_folder(agent_meta):
+  """
+  Resolves an agent registry entry to the folder the agent is stored in.
+  Entries either name the folder directly ("agent_folder") or give the
+  population and agent id inside POPULATIONS_DIR.
+
+  Parameters:
+    agent_meta: an agent registry entry
+  Returns:
+    str path to the agent folder
+  """
+  if "agent_folder" in agent_meta:
+    return agent_meta["agent_folder"]
+  return f"{POPULATIONS_DIR}/{agent_meta['population']}/{agent_meta['agent_id']}"
+
+
+def _save_stamp(agent_folder):
+  # The (mtime, size) of the files a save writes; it changes with every save
+  # (a journal append or a new snapshot).
+  stamp = []
+  for file_path in [f"{agent_folder}/scratch.json",
+                    f"{agent_folder}/meta.json",
+                    f"{agent_folder}/memory_stream/nodes.json",
+                    f"{agent_folder}/memory_stream/journal.jsonl"]:
+    try:
+      stat = os.stat(file_path)
+      stamp += [(stat.st_mtime_ns, stat.st_size)]
+    except FileNotFoundError:
+      stamp += [None]
+  return tuple(stamp)
+
+
+class AgentPool:
+  def __init__(self, max_agents=AGENT_POOL_MAX_AGENTS,
+               max_nodes=AGENT_POOL_MAX_NODES, revalidate=False):
+    # Loaded agents are kept in least-recently-used order. The pool is
+    # bounded both by the number of agents and by the total number of memory
+    # nodes held, since the node count is what dominates memory use. With
+    # <revalidate> (pools of worker processes, whose agents are saved by
+    # another process), a cached agent is reloaded once its files changed.
+    self.max_agents = max_agents
+    self.max_nodes = max_nodes
+    self.revalidate = revalidate
+    self.agents = OrderedDict()
+    self.node_count = 0
+    self._stamps = dict()
+    # <node_count> is kept current by a size listener (_resize) on every
+    # pooled agent's memory stream, as the agents grow after loading.
+    self._over_bounds = False
+
+    self._lock = threading.Lock()
+    self._count_lock = threading.Lock()
+    self._loading = dict()
+    self.stats = {"hits": 0, "misses": 0, "evictions": 0, "reloads": 0,
+                  "dirty_skips": 0, "load_seconds": 0.0}
+
+
+  def __len__(self):
+    return len(self.agents)
+
+
+  def __contains__(self, agent_folder):
+    return agent_folder in self.agents
+
+
+  def get(self, agent_meta):
+    """
+    Returns the loaded agent for a registry entry, loading it from disk on a
+    miss. Concurrent callers asking for the same agent wait for one load.
+
+    Parameters:
+      agent_meta: an agent registry entry
+    Returns:
+      GenerativeAgent
+    """
+    agent_folder = resolve_agent_folder(agent_meta)
+    while True:
+      stamp = _save_stamp(agent_folder) if self.revalidate else None
+      with self._lock:
+        if (agent_folder in self.agents and self.revalidate
+            and self._stamps.get(agent_folder) != stamp):
+          self.stats["reloads"] += 1
+          self._remove(agent_folder)
+        if agent_folder in self.agents:
+          self.agents.move_to_end(agent_folder)
+          self.stats["hits"] += 1
+          return self.agents[agent_folder]
+        event = self._loading.get(agent_folder)
+        if event is None:
+          event = threading.Event()
+          self._loading[agent_folder] = event
+          break
+      event.wait()
+
+    try:
+      start = time.time()
+      if not check_if_file_exists(f"{agent_folder}/scratch.json"):
+        raise FileNotFoundError(f"No generative agent at {agent_folder}")
+      # Stamped before loading, so a save that lands during the load makes
+      # the next get() reload the agent again.
+      stamp = _save_stamp(agent_folder) if self.revalidate else None
+      agent = GenerativeAgent(agent_folder)
+      load_seconds = time.time() - start
+      with self._lock:
+        self.stats["misses"] += 1
+        self.stats["load_seconds"] += load_seconds
+        self._insert(agent_folder, agent)
+        self._stamps[agent_folder] = stamp
+      return agent
+    finally:
+      with self._lock:
+        del self._loading[agent_folder]
+      event.set()
+
+
+  def put(self, agent_folder, agent):
+    """
+    Adds an already loaded agent to the pool.
+
+    Parameters:
+      agent_folder: the folder the agent belongs to
+      agent: GenerativeAgent
+    Returns:
+      None
+    """
+    stamp = _save_stamp(agent_folder) if self.revalidate else None
+    with self._lock:
+      if agent_folder in self.agents:
+        self._remove(agent_folder)
+      self._insert(agent_folder, agent)
+      self._stamps[agent_folder] = stamp
+
+
+  def _resize(self, delta):
+    with self._count_lock:
+      self.node_count += delta
+
+
+  def _over(self):
+    return (len(self.agents) > self.max_agents
+            or self.node_count > self.max_nodes)
+
+
+  def _remove(self, agent_folder):
+    agent = self.agents.pop(agent_folder)
+    self._stamps.pop(agent_folder, None)
+    memory_stream = agent.memory_stream
+    with memory_stream._nodes_lock:
+      memory_stream.size_listeners.remove(self._resize)
+      self._resize(-len(memory_stream.seq_nodes))
+    return agent
+
+
+  def _insert(self, agent_folder, agent):
+    self.agents[agent_folder] = agent
+    memory_stream = agent.memory_stream
+    with memory_stream._nodes_lock:
+      memory_stream.size_listeners += [self._resize]
+      self._resize(len(memory_stream.seq_nodes))
+    if not self._over():
+      self._over_bounds = False
+      return
+
+    # Least recently used first. Agents with unsaved changes are never
+    # dropped (that would lose them); they stay until they are saved, even
+    # if that keeps the pool over its bounds.
+    for curr_folder in list(self.agents.keys()):
+      if not self._over():
+        break
+      if curr_folder == agent_folder:
+        continue
+      if self.agents[curr_folder].has_unsaved_changes():
+        self.stats["dirty_skips"] += 1
+        continue
+      self._remove(curr_folder)
+      self.stats["evictions"] += 1
+
+    # Reported once each time the pool stays over its bounds, until it is
+    # back within them.
+    over_bounds = self._over()
+    if over_bounds and not self._over_bounds:
+      print (f"Agent pool over its bounds ({len(self.agents)} agents, "
+             f"{self.node_count} nodes): the least recently used agents "
+             f"have unsaved changes. Save them to let the pool evict them.")
+    self._over_bounds = over_bounds
+
+
+  def clear(self):
+    with self._lock:
+      for agent_folder in list(self.agents.keys()):
+        self._remove(agent_folder)
+      self._over_bounds = False
+
+
+# The pool shared by every Environment that is not given its own pool, so that
+# Survey and Interview runs over the same population reuse loaded agents.
+shared_agent_pool = AgentPool()
@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+from simulation_engine.settings import *
+from simulation_engine.global_methods import *
+
+
+def wave_key(payload):
+  """
+  A short stable key for a survey wave or interview script, so that a
+  checkpoint is only resumed by a run that asks the same thing.
+
+  Parameters:
+    payload: JSON serializable description of the run (e.g., the questions)
+  Returns:
+    str hex key
+  """
+  serialized = json.dumps(payload, sort_keys=True, default=str)
+  return hashlib.sha1(serialized.encode("utf-8")).hexdigest()[:16]
+
+
+# ##############################################################################
+# ###                            JSONL CHECKPOINT                            ###
+# ##############################################################################
+
+class JsonlCheckpoint:
+  def __init__(self, checkpoint_path, fsync_every=CHECKPOINT_FSYNC_EVERY):
+    # An append-only log of completed work. Each line is one JSON record;
+    # records are written as soon as they complete so a crash loses at most
+    # the records that were still in flight.
+    self.checkpoint_path = checkpoint_path
+    self.fsync_every = fsync_every
+    self.unsynced_count = 0
+    self._file = None
+    self._lock = threading.Lock()
+
+
+  def read(self, key=None):
+    """
+    Reads the checkpoint. A partial last line (from a crash mid-write) is
+    skipped.
+
+    Parameters:
+      key: only return records whose "wave" matches this key
+    Returns:
+      records: list of record dictionaries
+    """
+    records = []
+    if not os.path.exists(self.checkpoint_path):
+      return records
+    with open(self.checkpoint_path) as f:
+      for line in f:
+        line = line.strip()
+        if not line:
+          continue
+        try:
+          record = json.loads(line)
+        except json.JSONDecodeError:
+          continue
+        if key is None or record.get("wave") == key:
+          records += [record]
+    return records
+
+
+  def append(self, record):
+    line = json.dumps(record, default=str) + "\n"
+    with self._lock:
+      if self._file is None:
+        create_folder_if_not_there(self.checkpoint_path)
+        self._file = open(self.checkpoint_path, "a")
+      self._file.write(line)
+      self._file.flush()
+      self.unsynced_count += 1
+      if self.unsynced_count >= self.fsync_every:
+        os.fsync(self._file.fileno())
+        self.unsynced_count = 0
+
+
+  def close(self):
+    with self._lock:
+      if self._file is not None:
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+        self.unsynced_count = 0
+
+
+# ##############################################################################
+# ###                            PROGRESS TRACKER                            ###
+# ##############################################################################
+
+class ProgressTracker:
+  def __init__(self, total, label="progress", report_every=5.0, skipped=0):
+    # Counts completed and failed units of work and prints throughput and ETA
+    # at most once every <report_every> seconds.
+    self.total = total
+    self.label = label
+    self.report_every = report_every
+    self.skipped = skipped
+    self.done = 0
+    self.failed = 0
+    self.start = time.time()
+    self._last_report = 0.0
+    self._lock = threading.Lock()
+
+
+  def update(self, count=1, failed=False):
+    with self._lock:
+      if failed:
+        self.failed += count
+      else:
+        self.done += count
+      now = time.time()
+      finished = self.done + self.failed >= self.total
+      if now - self._last_report >= self.report_every or finished:
+        self._last_report = now
+        print (self.report())
+
+
+  def extend(self, total):
+    # Raises the total (e.g., once an adaptive sample outgrows its plan).
+    with self._lock:
+      self.total = max(self.total, total)
+
+
+  def throughput(self):
+    elapsed = time.time() - self.start
+    if elapsed <= 0:
+      return 0.0
+    return (self.done + self.failed) / elapsed
+
+
+  def eta(self):
+    rate = self.throughput()
+    remaining = self.total - self.done - self.failed
+    if rate <= 0:
+      return float("inf")
+    return remaining / rate
+
+
+  def report(self):
+    eta = self.eta()
+    eta_str = "--" if eta == float("inf") else f"{eta:.0f}s"
+    return (f"[{self.label}] {self.done + self.failed}/{self.total} "
+            f"(failed: {self.failed}, resumed: {self.skipped}) "
+            f"{self.throughput():.2f}/s, ETA {eta_str}")
+
+
+  def summary(self):
+    return {"total": self.total,
+            "done": self.done,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "seconds": time.time() - self.start,
+            "per_sec": self.throughput()}
@@ -1,16 +1,29 @@
 import uuid
 import os
 import json
-import pandas as pd
+import time
+import threading
+
+from environment.agent_pool import shared_agent_pool
+from environment.executor import ThreadTaskExecutor, HybridExecutor
 
 
 class Environment:
-  def __init__(self, env_type, saved_dir=None):
+  def __init__(self, env_type, saved_dir=None, agent_pool=None):
     self.env_type = env_type
     self.env_id = f'{env_type}_{str(uuid.uuid4())[:15]}'
     self.agent_registry = dict()
     self.responses = None  # Will be different for Survey and Interview
 
+    # Loaded agents are shared across runs (and, by default, across 
+    # environments) through the agent pool. Loader time and LLM time are 
+    # tracked separately in <run_stats>. 
+    self.agent_pool = agent_pool if agent_pool else shared_agent_pool
+    self.run_stats = {"agents": 0, "load_seconds": 0.0, "llm_seconds": 0.0}
+    self.last_run = None
+    self._stats_lock = threading.Lock()
+    self._hybrid_executor = None
+
     if saved_dir:
       self._load_saved_env(saved_dir)
 
@@ -48,6 +61,89 @@ class Environment:
     self.agent_registry.update(new_agent_registry)
 
 
+  def _get_agent(self, agent_pid):
+    start = time.time()
+    agent = self.agent_pool.get(self.agent_registry[agent_pid])
+    self._record_time("load_seconds", time.time() - start)
+    return agent
+
+
+  def _record_time(self, key, seconds, agents=0):
+    with self._stats_lock:
+      self.run_stats[key] += seconds
+      self.run_stats["agents"] += agents
+
+
+  def _make_executor(self, num_threads=50, num_workers=None):
+    # With num_workers > 1, agent loading, retrieval and prompt rendering run
+    # in worker processes (each with its own agent cache and a thread pool 
+    # for the LLM calls). The process executor is kept across runs so the 
+    # per-process agent caches stay warm. 
+    if num_workers and num_workers > 1:
+      if (self._hybrid_executor is None 
+          or self._hybrid_executor.num_workers != num_workers):
+        self.close()
+        self._hybrid_executor = HybridExecutor(
+          num_workers, max(1, num_threads // num_workers))
+      return self._hybrid_executor
+    return ThreadTaskExecutor(self.agent_pool, num_threads)
+
+
+  def _run_tasks(self, executor, task_fn, tasks, call_timeout=None, 
+                 expires_at=None, batch_fn=None):
+    """
+    Runs task_fn(agent, *args) for every (agent_pid, args) in tasks on the 
+    given executor and yields (agent_pid, result, error) as they complete. 
+    Load time and task time are added to <run_stats>. Each task runs under a
+    deadline of <call_timeout> seconds, capped by the run's <expires_at>; a 
+    task that misses it comes back with a DeadlineExceeded error. 
+    <batch_fn> prepares each batch of tasks where its agents are loaded (see
+    ThreadTaskExecutor.run). 
+    """
+    tasks = [(agent_pid, self.agent_registry[agent_pid], args) 
+             for agent_pid, args in tasks]
+    for agent_pid, result, error, load_seconds, task_seconds in executor.run(
+        task_fn, tasks, call_timeout, expires_at, batch_fn):
+      self._record_time("load_seconds", load_seconds)
+      self._record_time("llm_seconds", task_seconds, agents=1)
+      yield agent_pid, result, error
+
+
+  def _submit_task(self, executor, task_fn, agent_pid, args, 
+                   call_timeout=None, expires_at=None):
+    """
+    Submits task_fn(agent, *args) for one agent and returns its future, to be
+    read with _task_result(). Unlike _run_tasks, this lets the caller queue 
+    an agent's next task as soon as its previous one completes. 
+    """
+    task = (agent_pid, self.agent_registry[agent_pid], args)
+    return executor.submit(task_fn, task, call_timeout, expires_at)
+
+
+  def _task_result(self, future):
+    # (agent_pid, result, error) of a future from _submit_task, with its load
+    # time and task time added to <run_stats>.
+    agent_pid, result, error, load_seconds, task_seconds = future.result()
+    self._record_time("load_seconds", load_seconds)
+    self._record_time("llm_seconds", task_seconds, agents=1)
+    return agent_pid, result, error
+
+
+  def _release_executor(self, executor):
+    if executor is not self._hybrid_executor:
+      executor.shutdown()
+
+
+  def close(self):
+    if self._hybrid_executor:
+      self._hybrid_executor.shutdown()
+      self._hybrid_executor = None
+
+
+  def reset_run_stats(self):
+    self.run_stats = {"agents": 0, "load_seconds": 0.0, "llm_seconds": 0.0}
+
+
   def package(self):
     return {
       "packaged_meta": {"env_id": self.env_id},
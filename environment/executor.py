@@ -0,0 +1,272 @@
+import time
+import zlib
+import threading
+import multiprocessing
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from simulation_engine.settings import *
+from simulation_engine.global_methods import *
+from simulation_engine.deadline import deadline
+from simulation_engine.concurrency import llm_limiter
+from environment.agent_pool import AgentPool, resolve_agent_folder
+
+
+# ##############################################################################
+# ###                         WORKER PROCESS STATE                           ###
+# ##############################################################################
+
+# Every worker process keeps its own agent cache and its own thread pool for
+# the LLM calls. They are created by the process initializer. The cached
+# agents are reloaded once their files change (e.g., the parent saved them),
+# and each worker's LLM concurrency limiter gets an equal share of the
+# process-wide budget.
+_worker_agent_pool = None
+_worker_threads = None
+
+
+def _init_worker(threads_per_worker, num_workers):
+  global _worker_agent_pool, _worker_threads
+  _worker_agent_pool = AgentPool(revalidate=True)
+  _worker_threads = ThreadPoolExecutor(max_workers=threads_per_worker)
+  llm_limiter.share(num_workers)
+
+
+def run_agent_task(agent_pool, task_fn, key, agent_meta, args,
+                   call_timeout=None, expires_at=None):
+  """
+  Runs one task against one agent and times the agent loading separately from
+  the task itself (retrieval and LLM calls).
+
+  Parameters:
+    agent_pool: the AgentPool to load the agent from
+    task_fn: callable(agent, *args)
+    key: the key of the task (e.g., the agent_pid)
+    agent_meta: the agent registry entry
+    args: tuple of extra arguments for task_fn
+    call_timeout: seconds the task may take, or None
+    expires_at: absolute time.time() by which the whole run must finish
+  Returns:
+    (key, result, error, load_seconds, task_seconds)
+  """
+  start = time.time()
+  # Tasks still queued when the run's deadline passes fail without loading
+  # the agent.
+  if expires_at is not None and start >= expires_at:
+    return key, None, "DeadlineExceeded: run deadline exceeded", 0.0, 0.0
+  try:
+    agent = agent_pool.get(agent_meta)
+  except Exception as e:
+    return key, None, f"{type(e).__name__}: {e}", time.time() - start, 0.0
+  load_seconds = time.time() - start
+
+  start = time.time()
+  try:
+    with deadline(call_timeout, expires_at):
+      result = task_fn(agent, *args)
+    return key, result, None, load_seconds, time.time() - start
+  except Exception as e:
+    return (key, None, f"{type(e).__name__}: {e}",
+            load_seconds, time.time() - start)
+
+
+def _run_batch(task_fn, batch, call_timeout=None, expires_at=None,
+               batch_fn=None):
+  if batch_fn is not None and (expires_at is None or time.time() < expires_at):
+    batch = batch_fn(_worker_agent_pool, batch)
+  futures = [_worker_threads.submit(run_agent_task, _worker_agent_pool,
+                                    task_fn, key, agent_meta, args,
+                                    call_timeout, expires_at)
+             for key, agent_meta, args in batch]
+  return [future.result() for future in futures]
+
+
+def _run_entries(entries):
+  # A batch of tasks submitted one at a time (see HybridExecutor.submit); 
+  # every entry carries its own task_fn and deadlines.
+  futures = [_worker_threads.submit(run_agent_task, _worker_agent_pool,
+                                    task_fn, key, agent_meta, args,
+                                    call_timeout, expires_at)
+             for task_fn, (key, agent_meta, args), call_timeout, expires_at 
+             in entries]
+  return [future.result() for future in futures]
+
+
+# ##############################################################################
+# ###                               EXECUTORS                                ###
+# ##############################################################################
+
+class ThreadTaskExecutor:
+  def __init__(self, agent_pool, num_threads=50):
+    # The default execution mode: one thread pool in the current process,
+    # loading agents from the environment's agent pool.
+    self.agent_pool = agent_pool
+    self._executor = ThreadPoolExecutor(max_workers=num_threads)
+
+
+  def run(self, task_fn, tasks, call_timeout=None, expires_at=None,
+          batch_fn=None):
+    """
+    Runs task_fn over the tasks and yields results as they complete.
+
+    Parameters:
+      task_fn: callable(agent, *args)
+      tasks: list of (key, agent_meta, args) tuples
+      call_timeout: seconds each task may take, or None
+      expires_at: absolute time.time() by which the run must finish, or None
+      batch_fn: optional callable(agent_pool, tasks) that returns the tasks
+        with updated args before they run (e.g., to give every task an agent
+        description from one retrieval pass over the agents of the batch);
+        here the whole task list is one batch
+    Returns:
+      A generator of (key, result, error, load_seconds, task_seconds)
+    """
+    if batch_fn is not None:
+      tasks = batch_fn(self.agent_pool, tasks)
+    futures = [self._executor.submit(run_agent_task, self.agent_pool,
+                                     task_fn, key, agent_meta, args,
+                                     call_timeout, expires_at)
+               for key, agent_meta, args in tasks]
+    for future in concurrent.futures.as_completed(futures):
+      yield future.result()
+
+
+  def submit(self, task_fn, task, call_timeout=None, expires_at=None):
+    """
+    Submits one task. Unlike run(), the caller can submit follow-up work for
+    an agent as soon as its previous task is done.
+
+    Parameters:
+      task_fn: callable(agent, *args)
+      task: a (key, agent_meta, args) tuple
+      call_timeout: seconds the task may take, or None
+      expires_at: absolute time.time() by which the run must finish, or None
+    Returns:
+      A future of (key, result, error, load_seconds, task_seconds)
+    """
+    key, agent_meta, args = task
+    return self._executor.submit(run_agent_task, self.agent_pool, task_fn, 
+                                 key, agent_meta, args, call_timeout, 
+                                 expires_at)
+
+
+  def shutdown(self):
+    self._executor.shutdown()
+
+
+class HybridExecutor:
+  def __init__(self, num_workers, threads_per_worker=8, batch_size=8):
+    # <num_workers> single-process shards. A task always goes to the shard
+    # picked by its agent folder, so every agent is loaded (and its retrieval
+    # runs) in one process whose cache it then stays in across runs. Inside
+    # each process a thread pool overlaps the LLM calls. Workers are spawned
+    # rather than forked, so they do not inherit the parent's threads and
+    # locks (the background scorers, the LLM scheduler) mid-use.
+    self.num_workers = num_workers
+    self.threads_per_worker = threads_per_worker
+    self.batch_size = batch_size
+    mp_context = multiprocessing.get_context("spawn")
+    self._shards = [ProcessPoolExecutor(max_workers=1, mp_context=mp_context,
+                                        initializer=_init_worker,
+                                        initargs=(threads_per_worker,
+                                                  num_workers))
+                    for _ in range(num_workers)]
+    # Tasks given to submit() that wait for their shard's current batch.
+    self._waiting = [[] for _ in range(num_workers)]
+    self._sending = [False] * num_workers
+    self._lock = threading.RLock()
+
+
+  def _shard(self, agent_meta):
+    agent_folder = resolve_agent_folder(agent_meta)
+    return zlib.crc32(agent_folder.encode("utf-8")) % self.num_workers
+
+
+  def run(self, task_fn, tasks, call_timeout=None, expires_at=None,
+          batch_fn=None):
+    """
+    Runs task_fn over the tasks in the worker processes and yields results
+    as each batch completes. task_fn (and batch_fn) must be module-level 
+    functions (or partials of them) so they can be pickled.
+
+    Parameters:
+      task_fn: callable(agent, *args)
+      tasks: list of (key, agent_meta, args) tuples
+      call_timeout: seconds each task may take, or None
+      expires_at: absolute time.time() by which the run must finish, or None
+      batch_fn: optional callable(agent_pool, tasks) run in the worker on 
+        each batch before its tasks (see ThreadTaskExecutor.run)
+    Returns:
+      A generator of (key, result, error, load_seconds, task_seconds)
+    """
+    shard_tasks = [[] for _ in range(self.num_workers)]
+    for task in tasks:
+      shard_tasks[self._shard(task[1])] += [task]
+
+    futures = []
+    for shard, curr_tasks in zip(self._shards, shard_tasks):
+      # Enough tasks per batch to keep the process's threads busy.
+      batch_size = max(self.batch_size, self.threads_per_worker)
+      for batch in chunk_list(curr_tasks, batch_size):
+        futures += [shard.submit(_run_batch, task_fn, batch,
+                                 call_timeout, expires_at, batch_fn)]
+
+    for future in concurrent.futures.as_completed(futures):
+      for result in future.result():
+        yield result
+
+
+  def submit(self, task_fn, task, call_timeout=None, expires_at=None):
+    """
+    Submits one task to the shard of its agent (see ThreadTaskExecutor.submit).
+    A shard process runs one batch at a time, so the tasks submitted while 
+    its batch is running wait and go out together as its next batch. 
+
+    Returns:
+      A future of (key, result, error, load_seconds, task_seconds)
+    """
+    future = concurrent.futures.Future()
+    shard = self._shard(task[1])
+    with self._lock:
+      self._waiting[shard] += [(future, task_fn, task, call_timeout, 
+                                expires_at)]
+      if not self._sending[shard]:
+        self._send(shard)
+    return future
+
+
+  def _send(self, shard):
+    # Sends the shard's waiting tasks as its next batch. Called under <_lock>.
+    batch_size = max(self.batch_size, self.threads_per_worker)
+    entries = self._waiting[shard][:batch_size]
+    del self._waiting[shard][:batch_size]
+    self._sending[shard] = bool(entries)
+    if not entries:
+      return
+    try:
+      batch = self._shards[shard].submit(_run_entries, 
+                                         [entry[1:] for entry in entries])
+    except Exception as e:
+      # E.g., the executor was shut down; the tasks fail rather than hang.
+      batch = concurrent.futures.Future()
+      batch.set_exception(e)
+    batch.add_done_callback(lambda done: self._sent(shard, entries, done))
+
+
+  def _sent(self, shard, entries, batch):
+    try:
+      results = batch.result()
+    except Exception as e:
+      results = [(entry[2][0], None, f"{type(e).__name__}: {e}", 0.0, 0.0)
+                 for entry in entries]
+    # The results are handed out first so the follow-up tasks they lead to
+    # join the next batch.
+    for entry, result in zip(entries, results):
+      entry[0].set_result(result)
+    with self._lock:
+      self._send(shard)
+
+
+  def shutdown(self):
+    for shard in self._shards:
+      shard.shutdown()
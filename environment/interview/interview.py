@@ -1,17 +1,22 @@
 import json
+import time
 import concurrent.futures
-from concurrent.futures import ThreadPoolExecutor
 
 from simulation_engine.settings import *
 from simulation_engine.global_methods import *
 from environment.environment import Environment 
-from genagents.genagents import GenerativeAgent
+from environment.checkpoint import JsonlCheckpoint, ProgressTracker, wave_key
+
+
+def interview_turn(agent, dialogue, interview_q, context):
+  dialogue = dialogue + [["Interviewer", interview_q]]
+  return agent.get_fullname(), agent.utterance(dialogue, context)
 
 
 class Interview(Environment):
-  def __init__(self, saved_dir=None):
-    super().__init__('interview', saved_dir)
-    if not saved_dir: 
+  def __init__(self, saved_dir=None, agent_pool=None):
+    super().__init__('interview', saved_dir, agent_pool)
+    if self.responses is None: 
       self.responses = {}
 
 
@@ -35,39 +40,124 @@ class Interview(Environment):
         json.dump(packaged_responses, json_file, indent=2)
 
 
-  def _interview_agent(self, agent_pid, agent_meta, interview_script, context):
-    print (f"working on {agent_pid}")
-    curr_agent = GenerativeAgent(agent_meta["population"], agent_meta["agent_id"])
-    agent_responses = []
-    for interview_q, duration in interview_script:
-      agent_responses.append(["Interviewer", interview_q])
-      agent_response = curr_agent.utterance(agent_responses, context)
-      agent_responses.append([curr_agent.scratch.get_fullname(), agent_response])
-    return agent_pid, agent_responses
-
-
-  def interview(self, interview_script, context, num_threads=50):
-    with ThreadPoolExecutor(max_workers=num_threads) as executor:
-      future_to_agent = {executor.submit(self._interview_agent, agent_pid, agent_meta, interview_script, context): agent_pid 
-                         for agent_pid, agent_meta in self.agent_registry.items()}
-      
-      for future in concurrent.futures.as_completed(future_to_agent):
-        agent_pid = future_to_agent[future]
-        try:
-          agent_pid, agent_responses = future.result()
-          if agent_pid not in self.responses:
-            self.responses[agent_pid] = []
-
-          print (self.responses[agent_pid])
-          self.responses[agent_pid] += agent_responses
-        except Exception as exc:
-          print(f'{agent_pid} generated an exception: {exc}')
-
+  def interview(self, interview_script, context, 
+                num_threads=LLM_MAX_CONCURRENCY, checkpoint_path=None, 
+                resume=True, on_turn=None, num_workers=None, 
+                call_timeout=None, run_timeout=None):
+    """
+    Runs an interview script over every agent in the registry. The script is
+    pipelined across agents: each agent is asked its turns in order, and 
+    its next turn is queued as soon as its own previous turn completes, so a
+    slow agent does not hold the others back and the answers stream out 
+    while the run is still going. Every completed turn is appended to the 
+    checkpoint (when one is given), and a rerun with resume=True continues 
+    each agent from its last completed turn. 
+
+    Parameters:
+      interview_script: list of [question, duration] pairs
+      context: str context passed to the utterance prompt
+      num_threads: number of worker threads (the number of LLM requests in 
+        flight is further bounded by the adaptive llm_limiter)
+      checkpoint_path: path of a JSONL checkpoint for this interview
+      resume: continue from the turns already in the checkpoint
+      on_turn: optional callable(agent_pid, turn, question, response) called 
+        as each turn completes
+      num_workers: run agent loading and retrieval in this many worker 
+        processes instead of in one thread pool
+      call_timeout: seconds each turn may take before its LLM calls are 
+        abandoned and the agent counts as failed
+      run_timeout: seconds the whole interview may take; agents cut off by 
+        it can be continued by a resumed run
+    Returns: 
+      self.responses
+    """
+    checkpoint = JsonlCheckpoint(checkpoint_path) if checkpoint_path else None
+    key = wave_key([interview_script, context])
+
+    # Rebuilding each agent's dialogue from the checkpointed turns. 
+    dialogues = {agent_pid: [] for agent_pid in self.agent_registry}
+    completed = {agent_pid: 0 for agent_pid in self.agent_registry}
+    if checkpoint and resume: 
+      records = sorted(checkpoint.read(key), key=lambda r: r["turn"])
+      for record in records: 
+        agent_pid = record["agent_pid"]
+        if agent_pid not in dialogues or record["turn"] != completed[agent_pid]: 
+          continue
+        dialogues[agent_pid] += [["Interviewer", record["question"]], 
+                                 [record["speaker"], record["response"]]]
+        completed[agent_pid] += 1
+    resumed = {agent_pid: len(dialogue) 
+               for agent_pid, dialogue in dialogues.items()}
+
+    resumed_turns = sum(completed.values())
+    remaining_turns = len(interview_script) * len(dialogues) - resumed_turns
+    progress = ProgressTracker(remaining_turns, "interview", 
+                               skipped=resumed_turns)
+    failures = dict()
+
+    expires_at = time.time() + run_timeout if run_timeout else None
+    executor = self._make_executor(num_threads, num_workers)
+    # The turn that each future in flight is asking.
+    in_flight = dict()
+
+    def submit_next_turn(agent_pid): 
+      turn = completed[agent_pid]
+      if turn >= len(interview_script): 
+        return
+      interview_q = interview_script[turn][0]
+      future = self._submit_task(
+        executor, interview_turn, agent_pid, 
+        (dialogues[agent_pid], interview_q, context), call_timeout, 
+        expires_at)
+      in_flight[future] = turn
+
+    try: 
+      for agent_pid in dialogues: 
+        submit_next_turn(agent_pid)
+
+      while in_flight: 
+        done, _ = concurrent.futures.wait(
+          in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done: 
+          turn = in_flight.pop(future)
+          interview_q = interview_script[turn][0]
+          agent_pid, result, error = self._task_result(future)
+          if error:
+            failures[agent_pid] = error
+            print(f'{agent_pid} generated an exception: {error}')
+            progress.update(len(interview_script) - turn, failed=True)
+            continue
+
+          speaker, agent_response = result
+          dialogues[agent_pid] += [["Interviewer", interview_q], 
+                                   [speaker, agent_response]]
+          completed[agent_pid] += 1
+          if checkpoint: 
+            checkpoint.append({"wave": key, "agent_pid": agent_pid, 
+                               "turn": turn, "question": interview_q, 
+                               "speaker": speaker, "response": agent_response})
+          if on_turn: 
+            on_turn(agent_pid, turn, interview_q, agent_response)
+          progress.update()
+          submit_next_turn(agent_pid)
+    finally: 
+      self._release_executor(executor)
+
+    if checkpoint: 
+      checkpoint.close()
+
+    for agent_pid, dialogue in dialogues.items(): 
+      if agent_pid not in self.responses:
+        self.responses[agent_pid] = []
+      # The resumed turns that an earlier run already recorded end the 
+      # agent's responses; only the turns after them are added.
+      recorded = self.responses[agent_pid]
+      for length in range(resumed[agent_pid], 0, -2): 
+        if recorded[-length:] == dialogue[:length]: 
+          dialogue = dialogue[length:]
+          break
+      recorded += dialogue
+
+    self.last_run = progress.summary()
+    self.last_run["failures"] = failures
     return self.responses
-
-
-
-
-
-
-
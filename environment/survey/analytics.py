@@ -0,0 +1,244 @@
+import numpy as np
+import pandas as pd
+
+
+class SurveyAnalytics:
+  def __init__(self, survey, weights=None, n_boot=1000, seed=None):
+    """
+    Population analytics over a Survey's answers: per-question distributions
+    and weighted marginals, cross-tabulations against scratch fields, numeric
+    summaries and bootstrap confidence intervals.
+
+    Everything is computed from the survey's ResponseIndex: each question is
+    an array holding the row of every agent's answer (-1 for no answer), so
+    counts and weighted marginals are (weighted) bincounts and cross-tabs 
+    are bincounts over pairs of rows. The index is updated as each wave (or
+    each streamed batch of Survey.ask) is merged, and the row arrays are 
+    rebuilt only for the fields that changed, so results can be polled 
+    while a survey is still running without re-scanning the responses.
+
+    Parameters:
+      survey: the Survey to analyze
+      weights: default agent weights -- None, a scratch field holding each
+        agent's (numeric) weight, or a dictionary of agent_pid to weight
+      n_boot: default number of bootstrap replicates
+      seed: seed of the bootstrap's random generator
+    """
+    self.survey = survey
+    self.index = survey.response_index
+    self.weights = weights
+    self.n_boot = n_boot
+    self.rng = np.random.default_rng(seed)
+    self._columns = dict()
+
+
+  def _rows(self, field, namespace="responses"):
+    # Returns (values, rows): the field's indexed values, in display order, 
+    # and the row of every index position's value (-1 for none), cached 
+    # until the field changes.
+    if namespace == "responses":
+      self.survey._index_questions([field])
+    key = (namespace, field)
+    version = (self.index.field_versions.get(key), self.index.size)
+    cached = self._columns.get(key)
+    if cached is None or cached[0] != version:
+      codes, column_values = self.index.codes(field, namespace)
+      values = self._order_values(field, list(column_values), namespace)
+      row_of = {value: count for count, value in enumerate(values)}
+      # The last entry maps the -1 code (no value) to the -1 row.
+      remap = np.asarray([row_of[value] for value in column_values] + [-1],
+                         dtype=np.int64)
+      cached = (version, values, remap[codes])
+      self._columns[key] = cached
+    return cached[1], cached[2]
+
+
+  def _counts(self, rows, n_values, w=None):
+    # The (weighted) number of agents on each row.
+    answered = rows >= 0
+    return np.bincount(rows[answered], 
+                       weights=None if w is None else w[answered],
+                       minlength=n_values).astype(np.float64)
+
+
+  def _order_values(self, field, values, namespace):
+    # Categorical questions keep the order of their options; everything
+    # else is sorted.
+    schema = self.survey.question_schema.get(field, dict())
+    if namespace == "responses" and schema.get("type") == "categorical":
+      options = [str(i) for i in schema["options"]]
+      return ([i for i in options if i in values]
+              + [i for i in values if i not in options])
+    try:
+      return sorted(values)
+    except TypeError:
+      return sorted(values, key=str)
+
+
+  def _weights(self, weights=None):
+    # The weight of every index position, or None for unweighted.
+    weights = self.weights if weights is None else weights
+    if weights is None:
+      return None
+    if isinstance(weights, str):
+      self.survey._index_scratch([weights])
+      values, rows = self._rows(weights, "scratch")
+      # Agents without the field weigh 0 (the appended last entry).
+      return np.append(np.asarray(values, dtype=np.float64), 0.0)[rows]
+    ret = np.zeros(self.index.size, dtype=np.float64)
+    positions = self.index.positions
+    for agent_pid, weight in weights.items():
+      if agent_pid in positions:
+        ret[positions[agent_pid]] = weight
+    return ret
+
+
+  def distribution(self, question, weights=None, normalize=True):
+    """
+    The distribution of the answers to a question among the agents who
+    answered it. With weights, this is the weighted marginal.
+
+    Parameters:
+      question: the question
+      weights: overrides the default weights
+      normalize: return shares instead of (weighted) counts
+    Returns:
+      pd.Series indexed by answer
+    """
+    values, rows = self._rows(question)
+    counts = self._counts(rows, len(values), self._weights(weights))
+    if normalize and counts.sum() > 0:
+      counts = counts / counts.sum()
+    return pd.Series(counts, index=pd.Index(values, name="answer"),
+                     name=question)
+
+
+  def distributions(self, questions=None, weights=None, normalize=True):
+    """
+    distribution() for several questions (every indexed question if None).
+    """
+    if questions is None:
+      questions = self.index.fields("responses")
+    return {question: self.distribution(question, weights, normalize)
+            for question in questions}
+
+
+  def crosstab(self, question, scratch_field, weights=None, normalize=None):
+    """
+    Cross-tabulates the answers to a question against a scratch field (e.g.,
+    a demographic field).
+
+    Parameters:
+      question: the question
+      scratch_field: the scratch field
+      weights: overrides the default weights
+      normalize: None for (weighted) counts, "index" for shares within each
+        answer, "columns" for shares within each scratch value, or "all"
+    Returns:
+      pd.DataFrame with one row per answer and one column per scratch value
+    """
+    self.survey._index_scratch([scratch_field])
+    answers, answer_rows = self._rows(question)
+    groups, group_rows = self._rows(scratch_field, "scratch")
+    w = self._weights(weights)
+    both = (answer_rows >= 0) & (group_rows >= 0)
+    cells = answer_rows * len(groups) + group_rows
+    table = np.bincount(cells[both], weights=None if w is None else w[both],
+                        minlength=len(answers) * len(groups))
+    table = table.astype(np.float64).reshape(len(answers), len(groups))
+
+    if normalize == "index":
+      table = table / np.maximum(table.sum(axis=1, keepdims=True), 1e-12)
+    elif normalize == "columns":
+      table = table / np.maximum(table.sum(axis=0, keepdims=True), 1e-12)
+    elif normalize == "all":
+      table = table / max(table.sum(), 1e-12)
+    return pd.DataFrame(table, index=pd.Index(answers, name=question),
+                        columns=pd.Index(groups, name=scratch_field))
+
+
+  def numeric_summary(self, question, weights=None):
+    """
+    Count, (weighted) mean and standard deviation, min and max of a numeric
+    question.
+
+    Parameters:
+      question: an int or float question
+      weights: overrides the default weights
+    Returns:
+      dictionary of the summary statistics
+    """
+    values, rows = self._rows(question)
+    x = np.asarray(values, dtype=np.float64)
+    counts = self._counts(rows, len(values))
+    w = self._weights(weights)
+    mass = counts if w is None else self._counts(rows, len(values), w)
+
+    total = mass.sum()
+    if total <= 0:
+      return {"count": int(counts.sum()), "mean": float("nan"),
+              "std": float("nan"), "min": float("nan"), "max": float("nan")}
+    mean = (mass * x).sum() / total
+    std = np.sqrt((mass * (x - mean) ** 2).sum() / total)
+    answered = x[counts > 0]
+    return {"count": int(counts.sum()), "mean": float(mean), "std": float(std),
+            "min": float(answered.min()), "max": float(answered.max())}
+
+
+  def bootstrap_ci(self, question, answer=None, weights=None, n_boot=None,
+                   ci=0.95):
+    """
+    A percentile bootstrap confidence interval for the share of an answer
+    (when <answer> is given) or for the mean of a numeric question.
+
+    Unweighted replicates resample the answer counts directly (a multinomial
+    draw over the answers, which is exactly a resample of the agents);
+    weighted replicates use Poisson resampling weights per agent, drawn in
+    blocks to bound memory.
+
+    Parameters:
+      question: the question
+      answer: the answer whose share is estimated, or None for the mean
+      weights: overrides the default weights
+      n_boot: number of replicates
+      ci: the confidence level
+    Returns:
+      (estimate, low, high)
+    """
+    n_boot = n_boot or self.n_boot
+    values, rows = self._rows(question)
+    if answer is None:
+      x = np.asarray(values, dtype=np.float64)
+    else:
+      x = np.asarray([value == answer for value in values], dtype=np.float64)
+    w = self._weights(weights)
+
+    if w is None:
+      counts = self._counts(rows, len(values))
+      n = int(counts.sum())
+      if n == 0:
+        return float("nan"), float("nan"), float("nan")
+      estimate = (counts * x).sum() / n
+      draws = self.rng.multinomial(n, counts / n, size=n_boot)
+      replicates = draws @ x / n
+    else:
+      # Per respondent: their value and their weight.
+      answered = rows >= 0
+      if not answered.any():
+        return float("nan"), float("nan"), float("nan")
+      agent_x = x[rows[answered]]
+      agent_w = w[answered]
+      estimate = (agent_w * agent_x).sum() / agent_w.sum()
+
+      replicates = []
+      block = max(1, 20000000 // len(agent_x))
+      for start in range(0, n_boot, block):
+        size = min(block, n_boot - start)
+        resample = self.rng.poisson(1.0, (size, len(agent_x))) * agent_w
+        replicates += [(resample @ agent_x) / np.maximum(resample.sum(axis=1),
+                                                         1e-12)]
+      replicates = np.concatenate(replicates)
+
+    alpha = (1 - ci) / 2
+    low, high = np.quantile(replicates, [alpha, 1 - alpha])
+    return float(estimate), float(low), float(high)
@@ -0,0 +1,213 @@
+import numpy as np
+import pandas as pd
+
+
+def _value_key(value):
+  # Answers are indexed by value; 1, 1.0 and np.int64(1) are the same answer
+  # (as they are for pandas isin), and missing answers are not indexed.
+  if value is None:
+    return None
+  if isinstance(value, (bool, np.bool_)):
+    return bool(value)
+  if isinstance(value, (float, np.floating)):
+    if value != value:
+      return None
+    if float(value).is_integer():
+      return int(value)
+    return float(value)
+  if isinstance(value, np.integer):
+    return int(value)
+  return value
+
+
+class _Column:
+  def __init__(self, capacity):
+    # A dictionary-encoded field: the code of every agent's value (-1 when it
+    # has none) and the values in code order. Codes use the smallest integer
+    # dtype that holds them, so a field costs 1-4 bytes per agent whatever
+    # the number of distinct values.
+    self.codes = np.full(capacity, -1, dtype=np.int8)
+    self.values = []
+    self.code_of = dict()
+
+
+  def code(self, key):
+    if key not in self.code_of:
+      self.code_of[key] = len(self.values)
+      self.values += [key]
+      if len(self.values) > np.iinfo(self.codes.dtype).max:
+        self.codes = self.codes.astype(np.min_scalar_type(-2 * len(self.values)))
+    return self.code_of[key]
+
+
+class ResponseIndex:
+  def __init__(self):
+    """
+    An inverted index from (field, value) to the agents that have it. Fields
+    are survey questions (namespace "responses") or scratch fields 
+    (namespace "scratch"), and each field is stored as one array of value 
+    codes over the agents. Criteria are resolved with a vectorized isin over 
+    a field's allowed values and AND across fields, so a filter over a large
+    population costs a few vectorized operations instead of a pass over the 
+    responses frame. Waves are added incrementally with update().
+    """
+    self.positions = dict()
+    self.columns = dict()
+    self.field_versions = dict()
+    self.size = 0
+    self._agent_pids = np.empty(0, dtype=object)
+
+
+  def __len__(self):
+    return self.size
+
+
+  def __contains__(self, agent_pid):
+    return agent_pid in self.positions
+
+
+  def _grow(self, capacity):
+    # Code arrays are over-allocated (doubling), so adding agents one wave at
+    # a time stays amortized O(1) per agent.
+    if capacity <= len(self._agent_pids):
+      return
+    # Growing changes every array's length, so every field counts as changed.
+    for key in self.field_versions:
+      self.field_versions[key] += 1
+    capacity = max(capacity, 2 * len(self._agent_pids), 1024)
+    agent_pids = np.empty(capacity, dtype=object)
+    agent_pids[:self.size] = self._agent_pids[:self.size]
+    self._agent_pids = agent_pids
+    for column in self.columns.values():
+      codes = np.full(capacity, -1, dtype=column.codes.dtype)
+      codes[:len(column.codes)] = column.codes
+      column.codes = codes
+
+
+  def add_agents(self, agent_pids):
+    """
+    Assigns index positions to the agents that do not have one yet and
+    returns the positions of every given agent.
+    """
+    new_pids = [i for i in dict.fromkeys(agent_pids) if i not in self.positions]
+    if new_pids:
+      self._grow(self.size + len(new_pids))
+      for agent_pid in new_pids:
+        self.positions[agent_pid] = self.size
+        self._agent_pids[self.size] = agent_pid
+        self.size += 1
+    return np.fromiter((self.positions[i] for i in agent_pids), dtype=np.int64,
+                       count=len(agent_pids))
+
+
+  def has_field(self, field, namespace="responses"):
+    return (namespace, field) in self.columns
+
+
+  def fields(self, namespace="responses"):
+    return [field for curr_namespace, field in self.columns
+            if curr_namespace == namespace]
+
+
+  def update(self, field, agent_pids, values, namespace="responses"):
+    """
+    Sets the indexed value of <field> for the given agents, replacing the
+    value they had before.
+
+    Parameters:
+      field: the question (or scratch field)
+      agent_pids: list of agent pids
+      values: list of their values, in the same order
+      namespace: "responses" or "scratch"
+    Returns:
+      None
+    """
+    agent_pids = list(agent_pids)
+    positions = self.add_agents(agent_pids)
+    column = self.columns.get((namespace, field))
+    if column is None:
+      column = _Column(len(self._agent_pids))
+      self.columns[(namespace, field)] = column
+    self.field_versions[(namespace, field)] = (
+      self.field_versions.get((namespace, field), 0) + 1)
+
+    codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+    remap = np.full(len(uniques) + 1, -1, dtype=np.int64)
+    for code, value in enumerate(uniques):
+      key = _value_key(value)
+      if key is not None:
+        remap[code] = column.code(key)
+    # pd.factorize codes missing values as -1, which remaps to -1.
+    column.codes[positions] = remap[codes]
+
+
+  def update_frame(self, frame, agent_column="agent_pid", namespace="responses",
+                   columns=None):
+    """
+    Indexes the columns of a frame with one row per agent: every column, or
+    only <columns> (plus the columns that are already indexed).
+    """
+    if frame.empty:
+      return
+    agent_pids = frame[agent_column].tolist()
+    for column in frame.columns:
+      if column == agent_column:
+        continue
+      if (columns is not None and column not in columns 
+          and not self.has_field(column, namespace)):
+        continue
+      self.update(column, agent_pids, frame[column].to_numpy(dtype=object),
+                  namespace)
+
+
+  def values(self, field, namespace="responses"):
+    column = self.columns.get((namespace, field))
+    return list(column.values) if column else []
+
+
+  def codes(self, field, namespace="responses"):
+    """
+    The value codes of a field over the index positions (-1 for agents
+    without a value) and the values they stand for.
+    """
+    column = self.columns.get((namespace, field))
+    if column is None:
+      return np.full(self.size, -1, dtype=np.int8), []
+    return column.codes[:self.size], column.values
+
+
+  def mask(self, criteria, namespace="responses", mask=None):
+    """
+    Resolves criteria to a boolean mask over the index positions.
+
+    Parameters:
+      criteria: dictionary of field to the allowed values (a list, a single
+        value or a callable that takes a value and returns a bool)
+      namespace: "responses" or "scratch"
+      mask: optional mask to AND the result into
+    Returns:
+      numpy bool array of length len(self)
+    """
+    if mask is None:
+      mask = np.ones(self.size, dtype=bool)
+    for field, allowed in criteria.items():
+      codes, values = self.codes(field, namespace)
+      if callable(allowed):
+        keys = [key for key in values if allowed(key)]
+      elif isinstance(allowed, (list, tuple, set)):
+        keys = [_value_key(i) for i in allowed]
+      else:
+        keys = [_value_key(allowed)]
+
+      column = self.columns.get((namespace, field))
+      allowed_codes = [column.code_of[key] for key in keys
+                       if column is not None and key in column.code_of]
+      mask &= np.isin(codes, allowed_codes)
+    return mask
+
+
+  def select(self, mask):
+    """
+    Returns the agent pids of a mask, in index order.
+    """
+    return self._agent_pids[:self.size][mask].tolist()
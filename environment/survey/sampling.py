@@ -0,0 +1,202 @@
+import math
+import random
+from statistics import NormalDist
+
+import numpy as np
+
+from simulation_engine.settings import *
+
+
+class AdaptiveSampler:
+  def __init__(self, agent_pids, agent_strata, questions,
+               batch_size=SAMPLING_BATCH_SIZE,
+               target_margin=SAMPLING_TARGET_MARGIN,
+               confidence=SAMPLING_CONFIDENCE,
+               min_sample=SAMPLING_MIN_SAMPLE, seed=None):
+    """
+    Draws agents in stratified random batches and tracks, per question, the
+    stratified estimate of every answer's share and the margin of error of
+    that estimate, so a survey can stop once the answer distributions have
+    settled instead of asking the whole population.
+
+    Batches follow proportional allocation: each draw goes to the stratum
+    furthest below its population share of the sample so far (after every
+    stratum got two draws, so each has a variance estimate), and agents are
+    drawn at random within their stratum. Shares are estimated as
+    sum_h W_h * p_h over the sampled strata (W_h the stratum's population
+    share), with the stratified variance sum_h W_h^2 p_h (1 - p_h) / (n_h - 1)
+    and its finite population correction.
+
+    Parameters:
+      agent_pids: the agents to sample from
+      agent_strata: dictionary of agent_pid to its stratum (any hashable,
+        e.g., a tuple of scratch values)
+      questions: the questions tracked, in the order of the responses
+      batch_size: agents drawn per batch
+      target_margin: stop once every answer share is known to within this
+        margin of error
+      confidence: the confidence level of the margin of error
+      min_sample: never stop before this many agents have answered
+      seed: seed of the random draws
+    """
+    self.questions = list(questions)
+    self.batch_size = batch_size
+    self.target_margin = target_margin
+    self.min_sample = min_sample
+    self.z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    self.population = len(agent_pids)
+
+    rng = random.Random(seed)
+    members = dict()
+    for agent_pid in agent_pids:
+      members.setdefault(agent_strata[agent_pid], []).append(agent_pid)
+    self.strata = list(members.keys())
+    self._stratum_ids = {stratum: count
+                         for count, stratum in enumerate(self.strata)}
+    self._pools = [members[stratum] for stratum in self.strata]
+    for pool in self._pools:
+      rng.shuffle(pool)
+    self._agent_strata = {agent_pid: self._stratum_ids[agent_strata[agent_pid]]
+                          for agent_pid in agent_pids}
+
+    self.stratum_sizes = np.array([len(i) for i in self._pools], dtype=float)
+    self.stratum_weights = self.stratum_sizes / max(self.population, 1)
+    self.drawn = np.zeros(len(self.strata))
+
+    # Per question: the number of agents who answered, per stratum, and the
+    # number who gave each answer, per stratum.
+    self.answered = {q: np.zeros(len(self.strata)) for q in self.questions}
+    self.counts = {q: dict() for q in self.questions}
+    self.sampled = 0
+
+
+  def remaining(self):
+    return int(self.stratum_sizes.sum() - self.drawn.sum())
+
+
+  def discard(self, agent_pid):
+    """
+    Removes an agent from the pool without counting it as drawn (e.g., one
+    whose answers were resumed from a checkpoint and are add()ed directly).
+    """
+    stratum_id = self._agent_strata[agent_pid]
+    pool = self._pools[stratum_id]
+    if agent_pid in pool:
+      pool.remove(agent_pid)
+      self.drawn[stratum_id] += 1
+
+
+  def next_batch(self, batch_size=None):
+    """
+    Draws the next stratified batch of agents (fewer, or none, once the
+    population is exhausted).
+    """
+    batch_size = batch_size or self.batch_size
+    batch = []
+    available = np.array([len(i) > 0 for i in self._pools])
+    for _ in range(min(batch_size, self.remaining())):
+      total = self.drawn.sum() + 1
+      deficit = np.where(available, self.stratum_weights * total - self.drawn,
+                         -np.inf)
+      deficit[available & (self.drawn < 2)] = np.inf
+      stratum_id = int(np.argmax(deficit))
+      batch += [self._pools[stratum_id].pop()]
+      self.drawn[stratum_id] += 1
+      available[stratum_id] = len(self._pools[stratum_id]) > 0
+    return batch
+
+
+  def add(self, agent_pid, responses):
+    """
+    Records an agent's answers (in the order of <questions>); None answers
+    are not counted for their question.
+    """
+    stratum_id = self._agent_strata[agent_pid]
+    self.sampled += 1
+    for question, response in zip(self.questions, responses):
+      if response is None:
+        continue
+      self.answered[question][stratum_id] += 1
+      counts = self.counts[question].setdefault(
+        response, np.zeros(len(self.strata)))
+      counts[stratum_id] += 1
+
+
+  def estimate(self, question):
+    """
+    The stratified estimate and margin of error of every answer's share.
+
+    Returns:
+      dictionary of answer to (share, margin of error)
+    """
+    answered = self.answered[question]
+    sampled = answered > 0
+    if not sampled.any():
+      return dict()
+    # Strata without answers yet are left out and the weights renormalized
+    # (converged() waits until every stratum has answers).
+    weights = self.stratum_weights[sampled] / self.stratum_weights[sampled].sum()
+    n = answered[sampled]
+    fpc = 1 - np.minimum(n / self.stratum_sizes[sampled], 1)
+
+    ret = dict()
+    for answer, counts in self.counts[question].items():
+      p = counts[sampled] / n
+      share = float((weights * p).sum())
+      variance = (weights ** 2 * p * (1 - p) / np.maximum(n - 1, 1) * fpc).sum()
+      ret[answer] = (share, float(self.z * math.sqrt(variance)))
+    return ret
+
+
+  def max_margin(self):
+    margins = [margin for question in self.questions
+               for _, margin in self.estimate(question).values()]
+    return max(margins) if margins else float("inf")
+
+
+  def planned_size(self):
+    """
+    The sample size expected to reach <target_margin>: the size at which a
+    50/50 share (the widest margin) would, under simple random sampling with
+    the finite population correction, bounded below by <min_sample> and two
+    agents per stratum.
+    """
+    n0 = (self.z / self.target_margin) ** 2 * 0.25
+    size = n0 / (1 + (n0 - 1) / max(self.population, 1))
+    size = max(math.ceil(size), self.min_sample,
+               int(np.minimum(self.stratum_sizes, 2).sum()))
+    return min(size, self.population)
+
+
+  def converged(self):
+    """
+    True once at least <min_sample> agents answered every question, every
+    stratum has at least two answers to every question (or no agents left to
+    draw) and every answer share is within <target_margin>.
+    """
+    if min(i.sum() for i in self.answered.values()) < self.min_sample:
+      return False
+    # An unsampled stratum would silently drop out of the estimate.
+    needed = np.minimum(self.stratum_sizes, 2)
+    exhausted = np.array([len(i) == 0 for i in self._pools])
+    for answered in self.answered.values():
+      if not ((answered >= needed) | exhausted).all():
+        return False
+    return self.max_margin() <= self.target_margin
+
+
+  def summary(self, calls_per_agent=1):
+    """
+    The sample size, whether the target precision was reached and the LLM
+    calls saved (an estimate: <calls_per_agent> for every agent not asked).
+    """
+    skipped = self.remaining()
+    return {"population": self.population,
+            "sampled": self.sampled,
+            "strata": len(self.strata),
+            "converged": self.converged(),
+            "max_margin": self.max_margin(),
+            "target_margin": self.target_margin,
+            "agents_skipped": skipped,
+            "llm_calls_saved": skipped * calls_per_agent,
+            "estimates": {q: self.estimate(q) for q in self.questions}}
@@ -1,90 +1,529 @@
+import json
+import math
+import time
+import functools
 import pandas as pd
-from concurrent.futures import ThreadPoolExecutor
 
 from simulation_engine.settings import *
 from simulation_engine.global_methods import *
 from environment.environment import Environment 
-from genagents.genagents import GenerativeAgent
+from environment.checkpoint import JsonlCheckpoint, ProgressTracker, wave_key
+from environment.agent_pool import resolve_agent_folder
+from environment.survey.response_index import ResponseIndex
+from environment.survey.analytics import SurveyAnalytics
+from environment.survey.sampling import AdaptiveSampler
+from genagents.modules.journal import read_scratch
+from genagents.population_index import PopulationEmbeddingIndex
+
+
+def administer_survey(agent, questions, agent_desc=None, 
+                      chunk_size=MAX_CHUNK_SIZE):
+  return agent.categorical_resp(questions, agent_desc, chunk_size)
+
+
+def administer_ask(agent, questions, agent_desc=None, 
+                   chunk_size=MAX_CHUNK_SIZE):
+  return agent.ask(questions, agent_desc, chunk_size)
+
+
+def shared_agent_descs(anchor, agent_pool, tasks): 
+  # Gives every task of a batch (questions, agent_desc, chunk_size) the 
+  # agent description built by one vectorized retrieval pass over the 
+  # stacked embeddings of the batch's agents. It runs wherever the agents 
+  # are loaded, i.e., in the worker processes when there are any. The 
+  # index reuses the segments of agents whose memory did not change since 
+  # an earlier batch or wave, so only changed agents are re-stacked. Agents
+  # that fail to load keep no description and fail in their own task. 
+  agents = dict()
+  for agent_pid, agent_meta, _ in tasks: 
+    try: 
+      agents[agent_pid] = agent_pool.get(agent_meta)
+    except Exception: 
+      continue
+  agent_descs = PopulationEmbeddingIndex(agents).agent_descs(anchor)
+  return [(agent_pid, agent_meta, 
+           (args[0], agent_descs.get(agent_pid), *args[2:])) 
+          for agent_pid, agent_meta, args in tasks]
+
+
+RESPONSE_FORMATS = {"csv": "responses.csv", 
+                    "parquet": "responses.parquet", 
+                    "feather": "responses.feather"}
 
 
 class Survey(Environment): 
-  def __init__(self, saved_dir=None):
-    super().__init__('survey', saved_dir)
-    if not saved_dir: 
+  def __init__(self, saved_dir=None, agent_pool=None, responses_format="csv"):
+    # <question_schema> maps every question column to its response type and
+    # options, so that responses can be stored in typed columnar formats. 
+    # <response_index> maps every (question, answer) of the categorical and
+    # numeric questions and every indexed (scratch field, value) to the 
+    # agents that have it, for filtering. Open answers are only indexed 
+    # once a filter asks for them. 
+    self.responses_format = responses_format
+    self.question_schema = dict()
+    self.response_index = ResponseIndex()
+    self._scratches = dict()
+    super().__init__('survey', saved_dir, agent_pool)
+    if self.responses is None: 
       self.responses = pd.DataFrame(columns=['agent_pid'])
     
 
-  def _load_responses(self, responses_path):
-    responses_path = os.path.join(responses_path, "responses.csv")
+  def _load_responses(self, saved_dir):
+    schema_path = os.path.join(saved_dir, "responses_schema.json")
+    if os.path.exists(schema_path):
+      with open(schema_path, 'r') as f:
+        self.question_schema = json.load(f)
 
-    if os.path.exists(responses_path):
-      self.responses = pd.read_csv(responses_path)
+    for responses_format, file_name in RESPONSE_FORMATS.items(): 
+      responses_path = os.path.join(saved_dir, file_name)
+      if not os.path.exists(responses_path):
+        continue
+      if responses_format == "parquet": 
+        self.responses = pd.read_parquet(responses_path)
+      elif responses_format == "feather": 
+        self.responses = pd.read_feather(responses_path)
+      else: 
+        self.responses = pd.read_csv(responses_path)
+      self.responses_format = responses_format
+      self.response_index.update_frame(
+        self.responses, columns=self._indexed_questions(self.responses.columns))
       print(f"Loaded responses from {responses_path}")
-    else:
-      print(f"Responses file not found at {responses_path}")
+      return
+
+    print(f"Responses file not found in {saved_dir}")
 
 
   def _package_responses(self):
     if self.responses.empty:
       print("No responses to package.")
-      return []
+      return self.responses
     
     columns = ['agent_pid'] + [col for col in self.responses.columns if col != 'agent_pid']
-    return [self.responses.columns.tolist()] + self.responses[columns].values.tolist()
+    return self._typed_responses(self.responses[columns])
+
+
+  def _typed_responses(self, responses): 
+    # Casting every question column to the dtype declared by its schema:
+    # categorical questions become pandas categoricals over their options 
+    # (answers outside the options are kept as extra categories; questions 
+    # with the same options share one CategoricalDtype), numeric questions 
+    # become numeric columns and open questions become string columns. 
+    responses = responses.copy()
+    dtypes = dict()
+    for question, schema in self.question_schema.items(): 
+      if question not in responses.columns: 
+        continue
+      if schema["type"] == "categorical": 
+        options = [str(i) for i in schema["options"]]
+        column = responses[question].astype("object")
+        column = column.where(column.isna(), column.astype(str))
+        extra = [i for i in column.dropna().unique() if i not in options]
+        categories = tuple(options + extra)
+        if categories not in dtypes: 
+          dtypes[categories] = pd.CategoricalDtype(list(categories))
+        responses[question] = column.astype(dtypes[categories])
+      elif schema["type"] in ["int", "float"]: 
+        responses[question] = pd.to_numeric(responses[question], 
+                                             errors="coerce")
+      elif schema["type"] == "open": 
+        responses[question] = responses[question].astype("string")
+    return responses
 
 
   def _save_responses(self, save_dir, packaged_responses):
-    write_list_of_list_to_csv(packaged_responses, os.path.join(save_dir, "responses.csv"))
+    with open(os.path.join(save_dir, "responses_schema.json"), 'w') as f:
+      json.dump(self.question_schema, f, indent=2)
+
+    responses_format = self.responses_format
+    if responses_format != "csv": 
+      responses_path = os.path.join(save_dir, RESPONSE_FORMATS[responses_format])
+      try: 
+        if responses_format == "parquet": 
+          packaged_responses.to_parquet(responses_path, index=False)
+        else: 
+          packaged_responses.reset_index(drop=True).to_feather(responses_path)
+        return
+      except ImportError as e: 
+        print(f"Could not write {responses_format} ({e}); "
+              f"falling back to CSV.")
+
+    packaged_responses.to_csv(os.path.join(save_dir, "responses.csv"), 
+                              index=False)
+
+
+  def _update_schema(self, questions, response_type="categorical"): 
+    for question, options in questions.items(): 
+      if response_type == "categorical": 
+        self.question_schema[question] = {"type": response_type, 
+                                          "options": list(options)}
+      else: 
+        self.question_schema[question] = {"type": response_type, 
+                                          "range": list(options)}
+
+
+  def _update_ask_schema(self, questions): 
+    for q in questions: 
+      if q["response-type"] == "categorical": 
+        self.question_schema[q["question"]] = {
+          "type": "categorical", "options": list(q["response-options"])}
+      elif q["response-type"] in ["int", "float"]: 
+        self.question_schema[q["question"]] = {
+          "type": q["response-type"], "range": list(q["response-scale"])}
+      else: 
+        self.question_schema[q["question"]] = {"type": "open"}
+
+
+  def _merge_responses(self, rows): 
+    """
+    Merges a wave of response rows into <self.responses> in one step. Rows 
+    of agents that already have responses overwrite the matching columns; 
+    new agents are appended. 
+
+    Parameters:
+      rows: list of dictionaries, each with an "agent_pid" key and one key 
+        per question
+    Returns: 
+      None
+    """
+    if not rows: 
+      return 
+    wave = pd.DataFrame.from_records(rows).drop_duplicates(
+             "agent_pid", keep="last").set_index("agent_pid")
+    current = self.responses.set_index("agent_pid")
+
+    new_pids = wave.index.difference(current.index, sort=False)
+    new_columns = [col for col in wave.columns if col not in current.columns]
+    merged = current.reindex(index=current.index.append(new_pids), 
+                             columns=list(current.columns) + new_columns)
+    positions = merged.index.get_indexer(wave.index)
+    for column in wave.columns: 
+      values = merged[column].to_numpy(dtype=object, copy=True)
+      values[positions] = wave[column].to_numpy(dtype=object)
+      merged[column] = values
+
+    self.responses = merged.infer_objects().rename_axis("agent_pid").reset_index()
+    self.response_index.update_frame(
+      wave.reset_index(), columns=self._indexed_questions(wave.columns))
+
+
+  def _indexed_questions(self, questions): 
+    # The questions indexed as their answers are merged: categorical and 
+    # numeric ones, whose answers come from a few values. Open answers are 
+    # nearly all distinct, so they are not (questions without a schema, 
+    # from responses saved before it existed, are). 
+    return [question for question in questions 
+            if self.question_schema.get(question, dict()).get("type") != "open"]
 
 
-  def _administer_to_agent(self, agent_pid, questions):
-    population = self.agent_registry[agent_pid]["population"]
-    agent_id = self.agent_registry[agent_pid]["agent_id"]
+  def _get_scratch(self, agent_pid): 
+    # The scratch of a registered agent (with the journal's latest scratch 
+    # update), read without loading its memory stream unless the agent is 
+    # already loaded. 
+    if agent_pid not in self._scratches: 
+      agent_meta = self.agent_registry[agent_pid]
+      agent_folder = resolve_agent_folder(agent_meta)
+      if agent_folder in self.agent_pool: 
+        scratch = self.agent_pool.get(agent_meta).scratch
+      else: 
+        scratch = read_scratch(agent_folder)
+      self._scratches[agent_pid] = scratch
+    return self._scratches[agent_pid]
 
-    agent = GenerativeAgent(population, agent_id)
-    print (f"Generating {agent_pid}'s response")
-    output = agent.categorical_resp(questions) 
-    output["agent_pid"] = agent_pid
-    print (output)
-    return output
 
+  def _index_questions(self, questions): 
+    # Indexes the answered questions that are not indexed yet (open ones, 
+    # once a filter or the analytics ask for them). 
+    for question in questions: 
+      if (question in self.responses.columns 
+          and not self.response_index.has_field(question)): 
+        self.response_index.update_frame(
+          self.responses[["agent_pid", question]])
 
-  def _filter_agents(self, inclusion_criteria):
-    if inclusion_criteria:
-      # Apply inclusion criteria as filters on the DataFrame
-      criteria = [(self.responses[question].isin(allowed_responses)) 
-                for question, allowed_responses in inclusion_criteria.items()]
-      mask = pd.concat(criteria, axis=1).all(axis=1)
-      filtered_agents = self.responses[mask]['agent_pid'].unique()
-      return list(filtered_agents)
-    return list(self.agent_registry)
 
+  def _index_scratch(self, fields): 
+    # Indexes the scratch fields of every registered agent; only the fields
+    # (and agents) that are not indexed yet are read. 
+    indexed = [field for field in fields 
+               if self.response_index.has_field(field, "scratch")]
+    new_fields = [field for field in fields if field not in indexed]
+    new_pids = []
+    if len(self._scratches) < len(self.agent_registry): 
+      new_pids = [agent_pid for agent_pid in self.agent_registry 
+                  if agent_pid not in self._scratches]
 
-  def survey(self, questions, inclusion_criteria={}, num_threads=50):
-    filtered_agents = self._filter_agents(inclusion_criteria)
+    for field, agent_pids in ([(field, new_pids) for field in indexed] 
+                              + [(field, list(self.agent_registry)) 
+                                 for field in new_fields]): 
+      if not agent_pids: 
+        continue
+      values = [self._get_scratch(agent_pid).get(field) 
+                for agent_pid in agent_pids]
+      self.response_index.update(field, agent_pids, values, "scratch")
+
+
+  def _filter_agents(self, inclusion_criteria, scratch_criteria=None):
+    """
+    The agents whose responses meet <inclusion_criteria> and whose scratch
+    meets <scratch_criteria>, resolved on the response index (any of each 
+    field's allowed values, AND across fields). 
+
+    Parameters:
+      inclusion_criteria: dictionary of question to allowed responses
+      scratch_criteria: dictionary of scratch field to allowed values (a 
+        list, a single value or a callable)
+    Returns: 
+      list of agent pids
+    """
+    if not inclusion_criteria and not scratch_criteria: 
+      return list(self.agent_registry)
+
+    if scratch_criteria: 
+      self._index_scratch(list(scratch_criteria.keys()))
+    self._index_questions(list((inclusion_criteria or dict()).keys()))
+    mask = self.response_index.mask(inclusion_criteria or dict())
+    if scratch_criteria: 
+      mask = self.response_index.mask(scratch_criteria, "scratch", mask)
+    return self.response_index.select(mask)
+
+
+  def analytics(self, weights=None, n_boot=1000, seed=None): 
+    """
+    Distributions, weighted marginals, cross-tabs by scratch fields and 
+    bootstrap confidence intervals over the responses (see SurveyAnalytics). 
+    The analytics read the response index, so they reflect every wave merged 
+    so far, including the batches a running Survey.ask has streamed in. 
+    """
+    return SurveyAnalytics(self, weights, n_boot, seed)
+
+
+  def _make_sampler(self, agent_pids, questions_list, sampling): 
+    # An AdaptiveSampler over the agents, stratified on the scratch fields 
+    # listed in sampling["strata"] (no strata: simple random batches). 
+    sampling = dict(sampling)
+    strata = sampling.pop("strata", [])
+    agent_strata = {agent_pid: tuple(str(self._get_scratch(agent_pid).get(i)) 
+                                     for i in strata) 
+                    for agent_pid in agent_pids}
+    return AdaptiveSampler(agent_pids, agent_strata, questions_list, 
+                           **sampling)
+
+
+  def survey(self, questions, inclusion_criteria={}, scratch_criteria=None, 
+             num_threads=LLM_MAX_CONCURRENCY, shared_retrieval=False, 
+             checkpoint_path=None, resume=True, num_workers=None, 
+             call_timeout=None, run_timeout=None, chunk_size=MAX_CHUNK_SIZE, 
+             sampling=None):
+    """
+    Administers a wave of categorical questions to the agents that meet the 
+    inclusion criteria. Answers are processed as they complete: each agent's
+    answers are appended to the checkpoint (when one is given) right away, 
+    and one agent failing does not abort the wave. 
+
+    By default every agent that meets the criteria is asked. With 
+    <sampling>, agents are instead drawn in stratified random batches until 
+    every answer share is estimated to the target precision (see 
+    AdaptiveSampler); the estimates and the LLM calls saved are reported in 
+    <self.last_run["sampling"]>. 
+
+    Parameters:
+      questions: dictionary of question to list of options
+      inclusion_criteria: dictionary of question to allowed responses
+      scratch_criteria: dictionary of scratch field (e.g., a demographic 
+        field) to allowed values, or to a callable on the value
+      num_threads: number of worker threads (the number of LLM requests in 
+        flight is further bounded by the adaptive llm_limiter)
+      shared_retrieval: build the agent descriptions from one vectorized 
+        retrieval pass over the population (per batch of each worker 
+        process with num_workers)
+      checkpoint_path: path of a JSONL checkpoint for this wave
+      resume: skip agents that already have answers for this wave in the 
+        checkpoint
+      num_workers: run agent loading and retrieval in this many worker 
+        processes (each with num_threads // num_workers threads for the LLM
+        calls) instead of in one thread pool
+      call_timeout: seconds each agent's survey may take before its LLM 
+        calls are abandoned and the agent counts as failed
+      run_timeout: seconds the whole wave may take; agents not surveyed by 
+        then count as failed (and are picked up by a resumed run)
+      chunk_size: questions per prompt; an agent's chunks are asked 
+        concurrently from one shared agent description (None sends the 
+        whole questionnaire in one prompt)
+      sampling: None to ask every agent, True to sample adaptively with the
+        SAMPLING_* settings, or a dictionary with "strata" (the scratch 
+        fields to stratify on, e.g., ["gender", "age"]) and any of 
+        AdaptiveSampler's "batch_size", "target_margin", "confidence", 
+        "min_sample" and "seed"
+    Returns: 
+      outputs: list of the agents' outputs (including resumed ones)
+    """
+    self._update_schema(questions)
+    return self._run_wave("survey", administer_survey, questions, 
+                          list(questions.keys()), inclusion_criteria, 
+                          scratch_criteria, num_threads, shared_retrieval, 
+                          checkpoint_path, resume, num_workers, call_timeout, 
+                          run_timeout, chunk_size, sampling=sampling)
+
+
+  def ask(self, questions, inclusion_criteria={}, scratch_criteria=None, 
+          num_threads=LLM_MAX_CONCURRENCY, shared_retrieval=False, 
+          checkpoint_path=None, resume=True, num_workers=None, 
+          call_timeout=None, run_timeout=None, chunk_size=MAX_CHUNK_SIZE, 
+          merge_every=500):
+    """
+    Administers a mixed questionnaire (categorical, int, float and open 
+    questions) to the agents that meet the inclusion criteria. Each agent's 
+    description is retrieved once for the whole questionnaire, its questions
+    are chunked by response type and the chunks are asked concurrently. 
+    Answers are merged into <self.responses> as they stream in: one column 
+    per question, numeric for int/float questions and categorical over the 
+    options of categorical questions. Everything else behaves as in 
+    survey(). 
+
+    Parameters:
+      questions: list of question dictionaries with "question", 
+        "response-type" ("categorical", "int", "float" or "open") and 
+        "response-options", "response-scale" or "response-char-limit"
+      merge_every: merge the answers collected so far into <self.responses>
+        every this many agents
+      (see survey() for the other parameters)
+    Returns: 
+      outputs: list of the agents' outputs (including resumed ones)
+    """
+    self._update_ask_schema(questions)
+    return self._run_wave("ask", administer_ask, questions, 
+                          [q["question"] for q in questions], 
+                          inclusion_criteria, scratch_criteria, num_threads, 
+                          shared_retrieval, checkpoint_path, resume, 
+                          num_workers, call_timeout, run_timeout, chunk_size, 
+                          merge_every)
+
+
+  def _run_wave(self, label, task_fn, questions, questions_list, 
+                inclusion_criteria, scratch_criteria, num_threads, 
+                shared_retrieval, checkpoint_path, resume, num_workers, 
+                call_timeout, run_timeout, chunk_size, merge_every=None, 
+                sampling=None):
+    # Runs task_fn(agent, questions, agent_desc, chunk_size) over the 
+    # filtered agents (or over an adaptive sample of them) and merges the 
+    # answers (one column per entry of <questions_list>) into 
+    # <self.responses>. 
+    filtered_agents = self._filter_agents(inclusion_criteria, scratch_criteria)
 
     if not filtered_agents:
       print("No agents meet the inclusion criteria.")
       return []
 
-    with ThreadPoolExecutor(max_workers=num_threads) as executor:
-      futures = [executor.submit(self._administer_to_agent, agent_pid, questions) 
-                 for agent_pid in filtered_agents]
-      outputs = [future.result() for future in futures]
+    sampler = None
+    if sampling: 
+      sampler = self._make_sampler(filtered_agents, questions_list, 
+                                   dict() if sampling is True else sampling)
+
+    # Resuming the wave from the checkpoint. 
+    checkpoint = JsonlCheckpoint(checkpoint_path) if checkpoint_path else None
+    # The answers are stored in question order, so the order is part of the
+    # key (wave_key sorts dictionary keys).
+    key = wave_key([questions_list, questions])
+    outputs = []
+    if checkpoint and resume: 
+      filtered_set = set(filtered_agents)
+      done = {record["agent_pid"]: record for record in checkpoint.read(key)
+              if record["agent_pid"] in filtered_set}
+      outputs = [done[agent_pid]["output"] for agent_pid in done]
+      filtered_agents = [i for i in filtered_agents if i not in done]
+      if sampler: 
+        for agent_pid in done: 
+          sampler.discard(agent_pid)
+          sampler.add(agent_pid, done[agent_pid]["output"]["responses"])
 
-    for output in outputs:
-      response_data = {question: output["responses"][i] 
-                       for i, question in enumerate(questions.keys())}
+    def to_row(output): 
+      response_data = dict(zip(questions_list, output["responses"]))
       response_data["agent_pid"] = output["agent_pid"]
+      return response_data
 
-      if (self.responses['agent_pid'] == output["agent_pid"]).any():
-        idx = self.responses[self.responses['agent_pid'] == output["agent_pid"]].index
-        for key, value in response_data.items():
-            self.responses.loc[idx, key] = value
-      else:
-        self.responses = pd.concat([self.responses, 
-                                    pd.DataFrame([response_data])], 
-                                    ignore_index=True)
+    rows = [to_row(output) for output in outputs]
+    # A sampled wave expects to ask the sampler's planned sample size. 
+    total = len(filtered_agents)
+    if sampler: 
+      total = min(total, max(sampler.planned_size() - len(outputs), 0))
+    progress = ProgressTracker(total, label, skipped=len(outputs))
+    failures = dict()
+    repairs = {"invalid": 0, "repaired": 0, "reasks": 0}
+    cached = 0
+    expires_at = time.time() + run_timeout if run_timeout else None
+    executor = self._make_executor(num_threads, num_workers)
+    try: 
+      # Without sampling the whole population is one batch. 
+      batch = filtered_agents
+      if sampler and not sampler.converged(): 
+        batch = sampler.next_batch()
+      elif sampler: 
+        batch = []
+      batch_fn = None
+      if shared_retrieval: 
+        batch_fn = functools.partial(shared_agent_descs, 
+                                     " ".join(questions_list))
+      while batch: 
+        progress.extend(progress.done + progress.failed + len(batch))
+        tasks = [(agent_pid, (questions, None, chunk_size)) 
+                 for agent_pid in batch]
 
-    return outputs
+        for agent_pid, output, error in self._run_tasks(
+            executor, task_fn, tasks, call_timeout, expires_at, batch_fn): 
+          if error is None and output is None: 
+            error = "ResponseFormatError: no valid response"
+          if error: 
+            failures[agent_pid] = error
+            print(f'{agent_pid} generated an exception: {error}')
+            progress.update(failed=True)
+            continue
 
+          output["agent_pid"] = agent_pid
+          outputs += [output]
+          rows += [to_row(output)]
+          for field, count in output.get("repairs", dict()).items(): 
+            repairs[field] = repairs.get(field, 0) + count
+          cached += output.get("cached", 0)
+          if sampler: 
+            sampler.add(agent_pid, output["responses"])
+          if checkpoint: 
+            checkpoint.append({"wave": key, "agent_pid": agent_pid, 
+                               "output": output})
+          progress.update()
+
+          if merge_every and len(rows) >= merge_every: 
+            self._merge_responses(rows)
+            rows = []
+
+        if (not sampler or sampler.converged() 
+            or (expires_at and time.time() >= expires_at)): 
+          break
+        batch = sampler.next_batch()
+    finally: 
+      self._release_executor(executor)
+
+    if checkpoint: 
+      checkpoint.close()
+
+    self._merge_responses(rows)
+
+    self.last_run = progress.summary()
+    self.last_run["failures"] = failures
+    self.last_run["repairs"] = repairs
+    self.last_run["cached_answers"] = cached
+    print (f"Surveyed {progress.done} agents ({progress.skipped} resumed from "
+           f"checkpoint, {len(failures)} failed; "
+           f"{cached} answers from the answer store; "
+           f"{repairs['repaired']}/{repairs['invalid']} invalid answers "
+           f"repaired with {repairs['reasks']} re-asks; "
+           f"load: {self.run_stats['load_seconds']:.2f}s, "
+           f"llm: {self.run_stats['llm_seconds']:.2f}s)")
+    if sampler: 
+      calls_per_agent = (math.ceil(len(questions_list) / chunk_size) 
+                         if chunk_size else 1)
+      self.last_run["sampling"] = sampler.summary(calls_per_agent)
+      print (f"Sampled {sampler.sampled}/{sampler.population} agents over "
+             f"{len(sampler.strata)} strata (max margin of error "
+             f"{self.last_run['sampling']['max_margin']:.3f}, target "
+             f"{sampler.target_margin:.3f}); about "
+             f"{self.last_run['sampling']['llm_calls_saved']} LLM calls saved")
+    return outputs
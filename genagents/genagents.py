@@ -1,13 +1,24 @@
+import os
 import uuid
 
 from genagents.modules.interaction import *
 from genagents.modules.memory_stream import *
+from genagents.modules.journal import AgentJournal, read_meta
 
 
 # ############################################################################
 # ###                        GENERATIVE AGENT CLASS                        ###
 # ############################################################################
 
+def _agent_id(meta): 
+  if "id" not in meta: 
+    return uuid.uuid4()
+  try: 
+    return uuid.UUID(str(meta["id"]))
+  except ValueError: 
+    return meta["id"]
+
+
 class GenerativeAgent: 
   def __init__(self, agent_folder=None):
     if agent_folder: 
@@ -16,22 +27,61 @@ class GenerativeAgent:
         print ("Generative agent does not exist in the current location.")
         return 
       
-      # Loading the agent's memories. 
-      with open(f"{agent_folder}/scratch.json") as json_file:
-        scratch = json.load(json_file)
-      with open(f"{agent_folder}/memory_stream/embeddings.json") as json_file:
-        embeddings = json.load(json_file)
-      with open(f"{agent_folder}/memory_stream/nodes.json") as json_file:
-        nodes = json.load(json_file)
+      # Loading the agent's memories. The snapshot files are read first and 
+      # the journal tail written since the last compaction is replayed on 
+      # top of them. 
+      journal = AgentJournal(agent_folder)
+      scratch, nodes, embeddings = journal.load()
 
-      self.id = uuid.uuid4()
+      # The id saved in meta.json keeps the agent's identity (and its 
+      # memoized answers) stable across loads. 
+      meta = read_meta(agent_folder)
+      self.id = _agent_id(meta)
       self.scratch = scratch
       self.memory_stream = MemoryStream(nodes, embeddings)
+      self.memory_stream.compacted_through = meta.get("compacted_through", 0)
+      self.journal = journal
+      self._saved_scratch = json.dumps(self.scratch, sort_keys=True)
+      self._saved_meta = json.dumps(meta, sort_keys=True) if meta else None
 
     else: 
       self.id = uuid.uuid4()
       self.scratch = {}
       self.memory_stream = MemoryStream([], {})
+      self.journal = None
+      self._saved_scratch = None
+      self._saved_meta = None
+
+
+  @classmethod
+  def from_state(cls, scratch, nodes, embeddings, agent_folder=None, 
+                 journal_entries=0, meta=None): 
+    """
+    Building an agent from an already loaded state (e.g., one that was 
+    parsed in a worker process by the population loader). 
+
+    Parameters:
+      scratch: the scratch dictionary
+      nodes: list of packaged node dictionaries
+      embeddings: dictionary of content to embedding
+      agent_folder: the folder the state was loaded from, if any
+      journal_entries: number of journal records replayed into the state
+      meta: the agent's meta dictionary, if any
+    Returns: 
+      GenerativeAgent
+    """
+    agent = cls()
+    agent.id = _agent_id(meta or dict())
+    agent.scratch = scratch
+    agent.memory_stream = MemoryStream(nodes, embeddings)
+    agent.memory_stream.compacted_through = (meta or dict()).get(
+      "compacted_through", 0)
+    if agent_folder: 
+      agent.journal = AgentJournal(agent_folder)
+      agent.journal.entry_count = journal_entries
+      agent._saved_scratch = json.dumps(agent.scratch, sort_keys=True)
+      agent._saved_meta = json.dumps(meta, sort_keys=True) if meta else None
+    return agent
 
 
   def update_scratch(self, update): 
@@ -47,44 +97,133 @@ class GenerativeAgent:
     Returns: 
       packaged dictionary
     """
-    return {"id": str(self.id)}
+    return {"id": str(self.id), 
+            "compacted_through": self.memory_stream.compacted_through}
+
+
+  def has_unsaved_changes(self): 
+    """
+    True if the agent changed since it was last saved or loaded: nodes that 
+    were added or modified, nodes archived by a compaction, or its scratch. 
+    """
+    memory_stream = self.memory_stream
+    if memory_stream.dirty_node_ids or memory_stream.pending_archive: 
+      return True
+    if self._saved_scratch is None: 
+      return bool(self.scratch)
+    return json.dumps(self.scratch, sort_keys=True) != self._saved_scratch
 
 
-  def save(self, save_directory): 
+  def save(self, save_directory, compact=False, sync=False): 
     """
-    Given a save_code, save the agents' state in the storage. Right now, the 
-    save directory works as follows: 
-    'storage/<agent_name>/<save_code>'
+    Save the agents' state in the storage directory. 
 
-    As you grow different versions of the agent, save the new agent state in 
-    a different save code location. Remember that 'init' is the originally
-    initialized agent directory.
+    The first save to a directory writes a full snapshot (scratch.json, 
+    meta.json, memory_stream/nodes.json and memory_stream/embeddings.json). 
+    Later saves to the same directory only append the nodes, embeddings and 
+    scratch updates that changed since the previous save to 
+    memory_stream/journal.jsonl, so the write cost scales with what changed 
+    rather than with the size of the agent. Once the journal grows past 
+    JOURNAL_COMPACT_EVERY records, it is compacted into a new snapshot. 
+    meta.json is rewritten whenever it is missing or package() changed, so 
+    the agent's id survives reloads even before the first compaction. 
 
     Parameters:
-      save_code: str
+      save_directory: str path of the agent folder
+      compact: force the journal to be folded into a new snapshot
+      sync: fsync the journal right away instead of batching
     Returns: 
       None
     """
-    # Name of the agent and the current save location. 
     storage = save_directory
-    create_folder_if_not_there(f"{storage}/memory_stream")
-    
-    # Saving the agent's memory stream. This includes saving the embeddings 
-    # as well as the nodes. 
-    with open(f"{storage}/memory_stream/embeddings.json", "w") as json_file:
-      json.dump(self.memory_stream.embeddings, 
-                json_file)
-    with open(f"{storage}/memory_stream/nodes.json", "w") as json_file:
-      json.dump([node.package() for node in self.memory_stream.seq_nodes], 
-                json_file, indent=2)
+    self.memory_stream.flush_embeddings()
+    if (self.journal is None 
+        or os.path.abspath(self.journal.agent_folder) != os.path.abspath(storage)
+        or not check_if_file_exists(f"{storage}/scratch.json")): 
+      self.journal = AgentJournal(storage)
+      self._write_snapshot()
+      return
+
+    # Collecting the records that changed since the last save. 
+    # Only the collected ids are cleared afterwards: nodes can be marked 
+    # dirty concurrently (e.g., by the background importance scorer). 
+    records = []
+    dirty_node_ids = list(self.memory_stream.dirty_node_ids.keys())
+    for node_id in dirty_node_ids: 
+      node = self.memory_stream.id_to_node.get(node_id)
+      if node is None: 
+        # Archived by a compaction after it was marked dirty. 
+        continue
+      records += [{"op": "node", 
+                   "node": node.package(), 
+                   "embedding": self.memory_stream.embeddings.get(node.content)}]
+
+    scratch_str = json.dumps(self.scratch, sort_keys=True)
+    if scratch_str != self._saved_scratch: 
+      records += [{"op": "scratch", "scratch": self.scratch}]
+
+    archived = self._take_archive()
+    self.journal.append_archive(archived)
+    records += [{"op": "archive", "node_id": node["node_id"], 
+                 "merged_into": node["merged_into"]} for node in archived]
+
+    self.journal.append(records, sync)
+    for node_id in dirty_node_ids: 
+      self.memory_stream.dirty_node_ids.pop(node_id, None)
+    self._saved_scratch = scratch_str
 
-    # Saving the agent's scratch memories. 
-    with open(f"{storage}/scratch.json", "w") as json_file:
-      json.dump(self.scratch, json_file, indent=2)
+    meta = self.package()
+    meta_str = json.dumps(meta, sort_keys=True)
+    if meta_str != self._saved_meta: 
+      self.journal.write_meta(meta)
+      self._saved_meta = meta_str
 
-    # Saving the agent's meta information. 
-    with open(f"{storage}/meta.json", "w") as json_file:
-      json.dump(self.package(), json_file, indent=2)
+    if compact or self.journal.needs_compaction(): 
+      self._write_snapshot()
+
+
+  def compact(self): 
+    """
+    Folds the journal of the agent into a new snapshot. 
+
+    Parameters:
+      None
+    Returns: 
+      None
+    """
+    if self.journal: 
+      self._write_snapshot()
+
+
+  def compact_memories(self, incremental=True): 
+    """
+    Merges the agent's near-duplicate observations (see MemoryStream.compact)
+    and returns the compaction report. The archived nodes are written out 
+    on the next save. 
+    """
+    return self.memory_stream.compact(incremental=incremental)
+
+
+  def _take_archive(self): 
+    archived = self.memory_stream.pending_archive
+    self.memory_stream.pending_archive = []
+    return archived
+
+
+  def _write_snapshot(self): 
+    self.memory_stream.flush_embeddings()
+    self.journal.append_archive(self._take_archive())
+    dirty_node_ids = list(self.memory_stream.dirty_node_ids.keys())
+    meta = self.package()
+    self.journal.write_snapshot(
+      self.scratch, 
+      [node.package() for node in self.memory_stream.seq_nodes], 
+      self.memory_stream.embeddings, 
+      meta)
+    for node_id in dirty_node_ids: 
+      self.memory_stream.dirty_node_ids.pop(node_id, None)
+    self._saved_scratch = json.dumps(self.scratch, sort_keys=True)
+    self._saved_meta = json.dumps(meta, sort_keys=True)
 
 
   def get_fullname(self): 
@@ -96,17 +235,19 @@ class GenerativeAgent:
   def get_self_description(self): 
     return str(self.scratch)
 
-  def remember(self, content, time_step=0): 
+  def remember(self, content, time_step=0, deferred=None): 
     """
     Add a new observation to the memory stream. 
 
     Parameters:
       content: The content of the current memory record that we are adding to
         the agent's memory stream. 
+      deferred: add the memory right away with a provisional importance and
+        score it in the background (defaults to IMPORTANCE_DEFERRED)
     Returns: 
       None
     """
-    self.memory_stream.remember(content, time_step)
+    self.memory_stream.remember(content, time_step, deferred)
 
 
   def reflect(self, anchor, time_step=0): 
@@ -118,16 +259,23 @@ class GenerativeAgent:
     Returns: 
       None
     """
-    self.memory_stream.reflect(anchor, time_step)
+    self.memory_stream.reflect(anchor, time_step=time_step)
 
 
-  def categorical_resp(self, questions): 
-    ret = categorical_resp(self, questions)
+  def categorical_resp(self, questions, agent_desc=None, 
+                       chunk_size=MAX_CHUNK_SIZE): 
+    ret = categorical_resp(self, questions, agent_desc, chunk_size)
     return ret
     
 
-  def numerical_resp(self, questions, float_resp=False): 
-    ret = numerical_resp(self, questions, float_resp)
+  def numerical_resp(self, questions, float_resp=False, agent_desc=None, 
+                     chunk_size=MAX_CHUNK_SIZE): 
+    ret = numerical_resp(self, questions, float_resp, agent_desc, chunk_size)
+    return ret
+
+
+  def ask(self, questions, agent_desc=None, chunk_size=MAX_CHUNK_SIZE): 
+    ret = ask(self, questions, agent_desc, chunk_size)
     return ret
 
 
@@ -0,0 +1,166 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+from simulation_engine.settings import *
+from simulation_engine.global_methods import *
+
+
+def agent_state_version(agent, invalidation=ANSWER_STORE_INVALIDATION):
+  """
+  The part of an answer key that identifies the agent and the state its
+  answers were generated from. Which changes invalidate earlier answers is
+  set by <invalidation>:
+    "memory": any new memory (remember or reflect) or scratch update
+    "reflection": only new reflections or scratch updates
+    "never": answers stay valid until the store is cleared
+
+  Parameters:
+    agent: GenerativeAgent
+    invalidation: the invalidation policy
+  Returns:
+    a tuple of the agent id, its memory fingerprint and its scratch hash
+  """
+  if invalidation == "never":
+    return (str(agent.id), "", "")
+
+  if invalidation == "reflection":
+    memory = agent.memory_stream.fingerprint(["reflection"])
+  else:
+    memory = agent.memory_stream.fingerprint()
+  scratch = json.dumps(agent.scratch, sort_keys=True, default=str)
+  return (str(agent.id), memory,
+          hashlib.sha1(scratch.encode("utf-8")).hexdigest())
+
+
+class AnswerStore:
+  def __init__(self, store_path=ANSWER_STORE_PATH,
+               max_entries=ANSWER_STORE_MAX_ENTRIES,
+               enabled=ANSWER_STORE_ENABLED):
+    """
+    Memoizes survey answers per (agent id, agent state version, question,
+    options, model, prompt version), so that repeated questions against an
+    agent whose memories did not change skip the retrieval and the LLM call.
+    Entries are kept in least-recently-used order up to <max_entries>. With
+    a <store_path>, every new answer is also appended to a JSONL file that
+    is read back on start-up.
+    """
+    self.store_path = store_path
+    self.max_entries = max_entries
+    self.enabled = enabled
+
+    self.entries = OrderedDict()
+    self.metrics = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+    self._lock = threading.Lock()
+    self._file = None
+
+    if store_path and os.path.exists(store_path):
+      self._load()
+
+
+  def _load(self):
+    with open(self.store_path, "r") as f:
+      for line in f:
+        try:
+          record = json.loads(line)
+        except json.JSONDecodeError:
+          # A torn last line from an interrupted write.
+          continue
+        self.entries[record["key"]] = (record["agent_id"],
+                                       record["response"],
+                                       record["reasoning"])
+        self.entries.move_to_end(record["key"])
+    while len(self.entries) > self.max_entries:
+      self.entries.popitem(last=False)
+
+
+  @staticmethod
+  def key(state_version, family, question, options, model, prompt_version):
+    """
+    The store key of one answer.
+
+    Parameters:
+      state_version: agent_state_version(agent)
+      family: the prompt family (e.g., "categorical", "numerical:int", "ask")
+      question: the question text
+      options: the question's options, scale or question dictionary
+      model: the LLM version
+      prompt_version: the version of the prompt template
+    Returns:
+      str key
+    """
+    payload = json.dumps([list(state_version), family, question, options,
+                          model, prompt_version], sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+  def get(self, key):
+    """
+    Returns the stored (response, reasoning) for a key, or None.
+    """
+    with self._lock:
+      entry = self.entries.get(key)
+      if entry is None:
+        self.metrics["misses"] += 1
+        return None
+      self.entries.move_to_end(key)
+      self.metrics["hits"] += 1
+      return entry[1], entry[2]
+
+
+  def put(self, key, agent_id, response, reasoning=None):
+    with self._lock:
+      self.entries[key] = (agent_id, response, reasoning)
+      self.entries.move_to_end(key)
+      self.metrics["stores"] += 1
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+        self.metrics["evictions"] += 1
+
+      if self.store_path:
+        if self._file is None:
+          create_folder_if_not_there(self.store_path)
+          self._file = open(self.store_path, "a")
+        self._file.write(json.dumps({"key": key, "agent_id": agent_id,
+                                     "response": response,
+                                     "reasoning": reasoning}) + "\n")
+        self._file.flush()
+
+
+  def invalidate(self, agent_id=None):
+    """
+    Drops the stored answers of one agent, or of every agent when agent_id
+    is None. Only the in-memory entries are dropped; entries in the JSONL
+    file are keyed on the agent's state and simply stop matching once the
+    agent changes.
+    """
+    with self._lock:
+      if agent_id is None:
+        self.entries.clear()
+        return
+      agent_id = str(agent_id)
+      for key in [k for k, v in self.entries.items() if v[0] == agent_id]:
+        del self.entries[key]
+
+
+  def stats(self):
+    with self._lock:
+      ret = dict(self.metrics)
+      ret["entries"] = len(self.entries)
+      lookups = ret["hits"] + ret["misses"]
+      ret["hit_rate"] = ret["hits"] / lookups if lookups else 0.0
+      return ret
+
+
+  def close(self):
+    with self._lock:
+      if self._file is not None:
+        self._file.close()
+        self._file = None
+
+
+# The answer store consulted by categorical_resp, numerical_resp and ask.
+# Worker processes each hold their own.
+shared_answer_store = AnswerStore()
@@ -4,6 +4,8 @@ import datetime
 import random
 import string
 import re
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 
 from numpy import dot
 from numpy.linalg import norm
@@ -12,20 +14,26 @@ from simulation_engine.settings import *
 from simulation_engine.global_methods import *
 from simulation_engine.gpt_structure import *
 from simulation_engine.llm_json_parser import *
+from simulation_engine.llm_router import escalated, route_signature
+from genagents.modules.answer_store import (shared_answer_store, 
+                                            agent_state_version)
 
 
-def _main_agent_desc(agent, anchor): 
+def agent_desc_from_nodes(agent, nodes): 
   agent_desc = ""
   agent_desc += f"Self description: {agent.get_self_description()}\n==\n"
   agent_desc += f"Other observations about the subject:\n\n"
+  for node in nodes:
+    agent_desc += f"{node.content}\n"
+  return agent_desc
 
+
+def _main_agent_desc(agent, anchor): 
   retrieved = agent.memory_stream.retrieve([anchor], 0, n_count=120)
   if len(retrieved) == 0:
-    return agent_desc
+    return agent_desc_from_nodes(agent, [])
   nodes = list(retrieved.values())[0]
-  for node in nodes:
-    agent_desc += f"{node.content}\n"
-  return agent_desc
+  return agent_desc_from_nodes(agent, nodes)
 
 
 def _utterance_agent_desc(agent, anchor): 
@@ -43,11 +51,205 @@ def _utterance_agent_desc(agent, anchor):
   return agent_desc
 
 
+def validate_categorical_answer(answer, options): 
+  """
+  Returns the option the answer names (matched exactly, or ignoring case and 
+  surrounding whitespace), or None when it is not one of the options.
+  """
+  if answer is None: 
+    return None
+  answer = str(answer)
+  options = [str(i) for i in options]
+  if answer in options: 
+    return answer
+  normalized = {i.strip().casefold(): i for i in options}
+  return normalized.get(answer.strip().casefold())
+
+
+def validate_numerical_answer(answer, scale, float_resp=False): 
+  """
+  Returns the answer as a float (or a rounded int) when it is a number within
+  the question's [min, max] scale, or None otherwise.
+  """
+  try: 
+    answer = float(answer)
+  except (TypeError, ValueError): 
+    return None
+  if answer != answer: 
+    return None
+  if len(scale) == 2: 
+    low, high = sorted(float(i) for i in scale)
+    if not low <= answer <= high: 
+      return None
+  return answer if float_resp else int(round(answer))
+
+
+def repair_answers(questions, output, validate, reask, 
+                   max_rounds=SURVEY_REPAIR_ROUNDS): 
+  """
+  Checks every answer of a questionnaire against its question's options or 
+  scale, and re-asks only the questions whose answer was missing or invalid
+  (as one smaller batch) instead of the whole questionnaire. 
+
+  Parameters:
+    questions: dictionary of question to options (or scale)
+    output: the {"responses", "reasonings"} output of the first request, or
+      None when it failed altogether
+    validate: callable(answer, options) returning the normalized answer, or
+      None when the answer is invalid
+    reask: callable(sub_questions) returning the output for the subset
+    max_rounds: number of re-asks before giving up on a question
+  Returns:
+    the output with one (normalized) answer per question, None for the ones
+    that could not be repaired, and "repairs": the number of invalid answers,
+    how many were repaired and the number of re-asks
+  """
+  question_list = list(questions.keys())
+  if output is None: 
+    output = {"responses": [None] * len(question_list), 
+              "reasonings": [None] * len(question_list)}
+
+  responses = [validate(answer, questions[question]) for question, answer 
+               in zip(question_list, output["responses"])]
+  reasonings = list(output["reasonings"])
+  invalid = [count for count, answer in enumerate(responses) if answer is None]
+  repairs = {"invalid": len(invalid), "repaired": 0, "reasks": 0}
+
+  for reask_round in range(max_rounds): 
+    if not invalid: 
+      break
+    sub_questions = {question_list[i]: questions[question_list[i]] 
+                     for i in invalid}
+    # Re-asks go to the next model of the task's cascade, if it has one. 
+    with escalated(reask_round + 1): 
+      sub_output = reask(sub_questions)
+    repairs["reasks"] += 1
+    if sub_output is None: 
+      continue
+    for count, i in enumerate(invalid): 
+      answer = validate(sub_output["responses"][count], 
+                        questions[question_list[i]])
+      if answer is not None: 
+        responses[i] = answer
+        reasonings[i] = sub_output["reasonings"][count]
+        repairs["repaired"] += 1
+    invalid = [i for i in invalid if responses[i] is None]
+
+  return {"responses": responses, "reasonings": reasonings, 
+          "repairs": repairs}
+
+
+def ask_in_chunks(questions, ask, chunk_size=MAX_CHUNK_SIZE): 
+  """
+  Splits a questionnaire into chunks of <chunk_size> questions, asks the 
+  chunks concurrently and merges their answers back in question order. 
+  Shorter batch prompts keep each output well under max_tokens, and the 
+  chunks' latencies overlap instead of adding up. 
+
+  Parameters:
+    questions: dictionary of question to options (or scale)
+    ask: callable(sub_questions) returning {"responses", "reasonings"} with
+      one entry per question (or None when the request failed)
+    chunk_size: questions per prompt; None or 0 sends them all at once
+  Returns:
+    the merged {"responses", "reasonings"} output
+  """
+  items = list(questions.items())
+  if not chunk_size or len(items) <= chunk_size: 
+    return ask(questions)
+  chunks = [dict(chunk) for chunk in chunk_list(items, chunk_size)]
+  return _ask_chunks(questions, chunks, ask)
+
+
+# The threads that ask the chunks of every questionnaire in the process. 
+# More chunks in flight than LLM_MAX_CONCURRENCY would only wait for a slot
+# of the concurrency limiter, so the pool is no larger than that.
+_chunk_executor = ThreadPoolExecutor(max_workers=LLM_MAX_CONCURRENCY, 
+                                     thread_name_prefix="questionnaire-chunk")
+
+
+def _ask_chunks(questions, chunks, ask): 
+  # Asks the chunks concurrently and returns their answers in the order of
+  # <questions>. The first chunk is asked on the caller's thread and the 
+  # others on the shared pool; each runs in a copy of the caller's context,
+  # so it keeps the caller's deadline and LLM priority class.
+  futures = [_chunk_executor.submit(contextvars.copy_context().run, ask, 
+                                    chunk) 
+             for chunk in chunks[1:]]
+  outputs = [ask(chunks[0])] + [future.result() for future in futures]
+
+  answers = dict()
+  for chunk, output in zip(chunks, outputs): 
+    if output is None: 
+      continue
+    answers.update(zip(chunk, zip(output["responses"], output["reasonings"])))
+  answers = [answers.get(question, (None, None)) for question in questions]
+  return {"responses": [i[0] for i in answers], 
+          "reasonings": [i[1] for i in answers]}
+
+
+def answer_with_store(agent, family, questions, answer, 
+                      answer_store=shared_answer_store, prompt_version="1"): 
+  """
+  Answers the questions the answer store already holds for the agent's 
+  current state from the store, and calls <answer> for the rest only (so a 
+  questionnaire that is fully memoized needs no retrieval or LLM call). The
+  valid new answers are stored. 
+
+  Parameters:
+    agent: GenerativeAgent
+    family: the prompt family, part of the store key
+    questions: dictionary of question to options (or question dictionary)
+    answer: callable(sub_questions) returning the {"responses", 
+      "reasonings", "repairs"} output for the subset
+    answer_store: the AnswerStore to use
+    prompt_version: the prompt template version, part of the store key
+  Returns:
+    the output for every question, with "cached": the number of answers 
+    that came from the store
+  """
+  if not answer_store.enabled: 
+    output = answer(questions)
+    output["cached"] = 0
+    return output
+
+  state_version = agent_state_version(agent)
+  # Answers are keyed on the models of the task's route, so re-routing a 
+  # task does not serve answers from the previous model. 
+  model = route_signature(family.split(":")[0])
+  keys = {question: answer_store.key(state_version, family, question, options,
+                                     model, prompt_version) 
+          for question, options in questions.items()}
+  answers = dict()
+  for question, key in keys.items(): 
+    stored = answer_store.get(key)
+    if stored is not None: 
+      answers[question] = stored
+
+  remaining = {question: options for question, options in questions.items() 
+               if question not in answers}
+  repairs = {"invalid": 0, "repaired": 0, "reasks": 0}
+  if remaining: 
+    output = answer(remaining)
+    repairs = output.get("repairs", repairs)
+    for question, response, reasoning in zip(remaining, output["responses"], 
+                                             output["reasonings"]): 
+      answers[question] = (response, reasoning)
+      if response is not None: 
+        answer_store.put(keys[question], state_version[0], response, 
+                         reasoning)
+
+  return {"responses": [answers[question][0] for question in questions], 
+          "reasonings": [answers[question][1] for question in questions], 
+          "repairs": repairs, 
+          "cached": len(questions) - len(remaining)}
+
+
 def run_gpt_generate_categorical_resp(
   agent_desc, 
   questions,
   prompt_version="1",
-  gpt_version="GPT4o",  
+  gpt_version=None,  
   verbose=False):
 
   def create_prompt_input(agent_desc, questions):
@@ -59,8 +261,11 @@ def run_gpt_generate_categorical_resp(
     return [agent_desc, str_questions]
 
   def _func_clean_up(gpt_response, prompt=""): 
-    responses, reasonings = extract_first_json_dict_categorical(gpt_response)
-    ret = {"responses": responses, "reasonings": reasonings}
+    num_questions = len(questions)
+    ret = {"responses": answers_from_response(gpt_response, "Response", 
+                                              num_questions), 
+           "reasonings": answers_from_response(gpt_response, "Reasoning", 
+                                               num_questions)}
     return ret
 
   def _get_fail_safe():
@@ -76,16 +281,31 @@ def run_gpt_generate_categorical_resp(
 
   output, prompt, prompt_input, fail_safe = chat_safe_generate(
     prompt_input, prompt_lib_file, gpt_version, 1, fail_safe, 
-    _func_clean_up, verbose)
+    _func_clean_up, verbose, response_schema=RESPONSE_SCHEMAS["categorical"],
+    task="categorical")
 
   return output, [output, prompt, prompt_input, fail_safe]
 
 
-def categorical_resp(agent, questions): 
-  anchor = " ".join(list(questions.keys()))
-  agent_desc = _main_agent_desc(agent, anchor)
-  return run_gpt_generate_categorical_resp(
-           agent_desc, questions, "1", LLM_VERS)[0]
+def categorical_resp(agent, questions, agent_desc=None, 
+                     chunk_size=MAX_CHUNK_SIZE): 
+  def answer(questions): 
+    curr_desc = agent_desc
+    if curr_desc is None: 
+      anchor = " ".join(list(questions.keys()))
+      curr_desc = _main_agent_desc(agent, anchor)
+
+    def ask(sub_questions): 
+      return run_gpt_generate_categorical_resp(
+               curr_desc, sub_questions, "1")[0]
+
+    def reask(sub_questions): 
+      return ask_in_chunks(sub_questions, ask, chunk_size)
+
+    return repair_answers(questions, reask(questions), 
+                          validate_categorical_answer, reask)
+
+  return answer_with_store(agent, "categorical", questions, answer)
 
 
 def run_gpt_generate_numerical_resp(
@@ -93,7 +313,7 @@ def run_gpt_generate_numerical_resp(
   questions, 
   float_resp,
   prompt_version="1",
-  gpt_version="GPT4o",  
+  gpt_version=None,  
   verbose=False):
 
   def create_prompt_input(agent_desc, questions, float_resp):
@@ -110,8 +330,11 @@ def run_gpt_generate_numerical_resp(
     return [agent_desc, str_questions, resp_type]
 
   def _func_clean_up(gpt_response, prompt=""): 
-    responses, reasonings = extract_first_json_dict_numerical(gpt_response)
-    ret = {"responses": responses, "reasonings": reasonings}
+    num_questions = len(questions)
+    ret = {"responses": answers_from_response(gpt_response, "Response", 
+                                              num_questions), 
+           "reasonings": answers_from_response(gpt_response, "Reasoning", 
+                                               num_questions)}
     return ret
 
   def _get_fail_safe():
@@ -127,21 +350,34 @@ def run_gpt_generate_numerical_resp(
 
   output, prompt, prompt_input, fail_safe = chat_safe_generate(
     prompt_input, prompt_lib_file, gpt_version, 1, fail_safe, 
-    _func_clean_up, verbose)
-
-  if float_resp: 
-    output["responses"] = [float(i) for i in output["responses"]]
-  else: 
-    output["responses"] = [int(i) for i in output["responses"]]
+    _func_clean_up, verbose, response_schema=RESPONSE_SCHEMAS["numerical"],
+    task="numerical")
 
   return output, [output, prompt, prompt_input, fail_safe]
 
 
-def numerical_resp(agent, questions, float_resp): 
-  anchor = " ".join(list(questions.keys()))
-  agent_desc = _main_agent_desc(agent, anchor)
-  return run_gpt_generate_numerical_resp(
-           agent_desc, questions, float_resp, "1", LLM_VERS)[0]
+def numerical_resp(agent, questions, float_resp, agent_desc=None, 
+                   chunk_size=MAX_CHUNK_SIZE): 
+  def validate(answer, scale): 
+    return validate_numerical_answer(answer, scale, float_resp)
+
+  def answer(questions): 
+    curr_desc = agent_desc
+    if curr_desc is None: 
+      anchor = " ".join(list(questions.keys()))
+      curr_desc = _main_agent_desc(agent, anchor)
+
+    def ask(sub_questions): 
+      return run_gpt_generate_numerical_resp(
+               curr_desc, sub_questions, float_resp, "1")[0]
+
+    def reask(sub_questions): 
+      return ask_in_chunks(sub_questions, ask, chunk_size)
+
+    return repair_answers(questions, reask(questions), validate, reask)
+
+  family = "numerical:float" if float_resp else "numerical:int"
+  return answer_with_store(agent, family, questions, answer)
 
 
 def run_gpt_generate_utterance(
@@ -149,15 +385,14 @@ def run_gpt_generate_utterance(
   str_dialogue,
   context,
   prompt_version="1",
-  gpt_version="GPT4o",  
+  gpt_version=None,  
   verbose=False):
 
   def create_prompt_input(agent_desc, str_dialogue, context):
     return [agent_desc, context, str_dialogue]
 
   def _func_clean_up(gpt_response, prompt=""): 
-    utterance = extract_first_json_dict(gpt_response)["utterance"]
-    return utterance
+    return gpt_response["utterance"]
 
   def _get_fail_safe():
     return None
@@ -169,7 +404,8 @@ def run_gpt_generate_utterance(
 
   output, prompt, prompt_input, fail_safe = chat_safe_generate(
     prompt_input, prompt_lib_file, gpt_version, 1, fail_safe, 
-    _func_clean_up, verbose)
+    _func_clean_up, verbose, response_schema=RESPONSE_SCHEMAS["utterance"],
+    task="utterance")
 
   return output, [output, prompt, prompt_input, fail_safe]
 
@@ -183,14 +419,69 @@ def utterance(agent, curr_dialogue, context):
   anchor = str_dialogue
   agent_desc = _utterance_agent_desc(agent, anchor)
   return run_gpt_generate_utterance(
-           agent_desc, str_dialogue, context, "1", LLM_VERS)[0]
+           agent_desc, str_dialogue, context, "1")[0]
 
 ##  Ask function.
+def validate_ask_answer(answer, question): 
+  """
+  Validates the answer to one question of a mixed questionnaire against its
+  response type: an option for categorical questions, a number within the 
+  scale for int/float questions and a non-empty string (cut to the 
+  character limit) for open questions. Returns None when it is invalid.
+  """
+  response_type = question["response-type"]
+  if response_type == "categorical": 
+    return validate_categorical_answer(answer, question["response-options"])
+  if response_type in ["int", "float"]: 
+    return validate_numerical_answer(answer, question["response-scale"], 
+                                     response_type == "float")
+  if answer is None or not str(answer).strip(): 
+    return None
+  return str(answer).strip()[:question.get("response-char-limit", 200)]
+
+
+def chunk_ask_questions(questions, chunk_size=MAX_CHUNK_SIZE): 
+  """
+  Type-aware chunking of a mixed questionnaire: questions of the same 
+  response type share a prompt, and an open question counts once per 200 
+  characters of its limit against <chunk_size>, so chunks of long free-text 
+  answers stay within max_tokens. 
+
+  Parameters:
+    questions: dictionary of question text to question dictionary
+    chunk_size: budget per prompt; None or 0 puts everything in one chunk
+  Returns:
+    list of dictionaries of question text to question dictionary
+  """
+  if not chunk_size: 
+    return [questions]
+
+  groups = dict()
+  for text, question in questions.items(): 
+    groups.setdefault(question["response-type"], []).append((text, question))
+
+  chunks = []
+  for group in groups.values(): 
+    curr_chunk, curr_cost = dict(), 0
+    for text, question in group: 
+      cost = 1
+      if question["response-type"] == "open": 
+        cost = max(1, math.ceil(question.get("response-char-limit", 200) / 200))
+      if curr_chunk and curr_cost + cost > chunk_size: 
+        chunks += [curr_chunk]
+        curr_chunk, curr_cost = dict(), 0
+      curr_chunk[text] = question
+      curr_cost += cost
+    if curr_chunk: 
+      chunks += [curr_chunk]
+  return chunks
+
+
 def run_gpt_generate_ask(
     agent_desc,
     questions,
     prompt_version="1",
-    gpt_version="GPT4o",
+    gpt_version=None,
     verbose=False):
 
     def create_prompt_input(agent_desc, questions):
@@ -211,8 +502,12 @@ def run_gpt_generate_ask(
         return [agent_desc, str_questions.strip()]
 
     def _func_clean_up(gpt_response, prompt=""):
-        responses = extract_first_json_dict(gpt_response)
-        return responses
+        num_questions = len(questions)
+        ret = {"responses": answers_from_response(gpt_response, "Response",
+                                                  num_questions),
+               "reasonings": answers_from_response(gpt_response, "Reasoning",
+                                                   num_questions)}
+        return ret
 
     def _get_fail_safe():
         return None
@@ -224,32 +519,29 @@ def run_gpt_generate_ask(
 
     output, prompt, prompt_input, fail_safe = chat_safe_generate(
         prompt_input, prompt_lib_file, gpt_version, 1, fail_safe,
-        _func_clean_up, verbose)
+        _func_clean_up, verbose, response_schema=RESPONSE_SCHEMAS["ask"],
+        task="ask")
 
     return output, [output, prompt, prompt_input, fail_safe]
 
 
+def ask(agent, questions, agent_desc=None, chunk_size=MAX_CHUNK_SIZE): 
+  def answer(questions): 
+    curr_desc = agent_desc
+    if curr_desc is None: 
+      anchor = " ".join(list(questions.keys()))
+      curr_desc = _main_agent_desc(agent, anchor)
 
-  
-
-
-
-
-
-  
-
-
-
-
-  
-
-
-
-
-
-  
-
-
+    def ask_chunk(sub_questions): 
+      return run_gpt_generate_ask(
+               curr_desc, list(sub_questions.values()), "1")[0]
 
+    def reask(sub_questions): 
+      chunks = chunk_ask_questions(sub_questions, chunk_size)
+      return _ask_chunks(sub_questions, chunks, ask_chunk)
 
+    return repair_answers(questions, reask(questions), validate_ask_answer, 
+                          reask)
 
+  questions = {q["question"]: q for q in questions}
+  return answer_with_store(agent, "ask", questions, answer)
@@ -0,0 +1,310 @@
+import os
+import re
+import json
+import threading
+
+from simulation_engine.settings import *
+from simulation_engine.global_methods import *
+
+
+# ##############################################################################
+# ###                        SNAPSHOT HELPER FUNCTIONS                       ###
+# ##############################################################################
+
+def write_json_atomic(data, outfile, indent=None):
+  """
+  Writes a JSON file by first writing to a temporary file in the same folder
+  and then renaming it over the target. A crash mid-write therefore leaves
+  either the old file or the new file, never a truncated one.
+
+  Parameters:
+    data: JSON serializable object to write
+    outfile: path of the JSON file
+    indent: indent passed to json.dump
+  Returns:
+    None
+  """
+  create_folder_if_not_there(outfile)
+  tmp_file = f"{outfile}.tmp"
+  with open(tmp_file, "w") as json_file:
+    json.dump(data, json_file, indent=indent)
+    json_file.flush()
+    os.fsync(json_file.fileno())
+  os.replace(tmp_file, outfile)
+
+
+def read_meta(agent_folder):
+  """
+  Reads the agent's meta.json (its stable id), or {} if there is none.
+  """
+  meta_path = f"{agent_folder}/meta.json"
+  if not os.path.exists(meta_path):
+    return dict()
+  with open(meta_path, "r") as f:
+    return json.load(f)
+
+
+_SCRATCH_OP = re.compile(r'"op"\s*:\s*"scratch"')
+
+
+def read_scratch(agent_folder):
+  """
+  Reads the agent's current scratch without loading its memory stream: the
+  scratch.json snapshot, or the last scratch record of the journal written
+  since then. Only the scratch records of the journal are parsed.
+  """
+  with open(f"{agent_folder}/scratch.json") as json_file:
+    scratch = json.load(json_file)
+  journal_path = f"{agent_folder}/memory_stream/journal.jsonl"
+  if not os.path.exists(journal_path):
+    return scratch
+  with open(journal_path) as f:
+    for line in f:
+      # A cheap match skips the node records without parsing them; whatever
+      # matches is parsed and checked, whatever the key order or separators.
+      if not _SCRATCH_OP.search(line):
+        continue
+      try:
+        record = json.loads(line)
+      except json.JSONDecodeError:
+        # A partial last line (see AgentJournal.read_records).
+        break
+      if record.get("op") == "scratch":
+        scratch = record["scratch"]
+  return scratch
+
+
+def replay_journal_records(records, scratch, nodes, embeddings):
+  """
+  Applies journal records on top of a loaded snapshot. Every record is an
+  upsert, so replaying a record that is already part of the snapshot is
+  harmless (this is what makes compaction crash-safe).
+
+  Parameters:
+    records: list of journal record dictionaries in the order they were
+      written
+    scratch: the scratch dictionary from the snapshot
+    nodes: list of packaged node dictionaries from the snapshot
+    embeddings: dictionary of content to embedding from the snapshot
+  Returns:
+    scratch, nodes, embeddings after the replay
+  """
+  node_pos = {node["node_id"]: count for count, node in enumerate(nodes)}
+  archived = set()
+  for record in records:
+    if record["op"] == "node":
+      node = record["node"]
+      if node["node_id"] in node_pos:
+        nodes[node_pos[node["node_id"]]] = node
+      else:
+        node_pos[node["node_id"]] = len(nodes)
+        nodes += [node]
+      if record.get("embedding") is not None:
+        embeddings[node["content"]] = record["embedding"]
+
+    elif record["op"] == "scratch":
+      scratch = record["scratch"]
+
+    elif record["op"] == "archive":
+      # Written by MemoryStream.compact; the node itself is in archive.jsonl.
+      archived.add(record["node_id"])
+
+  if archived:
+    nodes = [node for node in nodes if node["node_id"] not in archived]
+    live_contents = set(node["content"] for node in nodes)
+    embeddings = {content: embedding for content, embedding
+                  in embeddings.items() if content in live_contents}
+  return scratch, nodes, embeddings
+
+
+# ##############################################################################
+# ###                              AGENT JOURNAL                             ###
+# ##############################################################################
+
+class AgentJournal:
+  def __init__(self, agent_folder, fsync_every=JOURNAL_FSYNC_EVERY,
+               compact_every=JOURNAL_COMPACT_EVERY):
+    # The journal lives next to the snapshot files of the memory stream.
+    self.agent_folder = agent_folder
+    self.journal_path = f"{agent_folder}/memory_stream/journal.jsonl"
+    self.archive_path = f"{agent_folder}/memory_stream/archive.jsonl"
+    self.fsync_every = fsync_every
+    self.compact_every = compact_every
+
+    # <entry_count> is the number of records in the journal tail that are
+    # not yet folded into the snapshot. <unsynced_count> is the number of
+    # records written since the last fsync.
+    self.entry_count = 0
+    self.unsynced_count = 0
+    self.bytes_written = 0
+    self._file = None
+    self._lock = threading.Lock()
+
+
+  def read_records(self):
+    """
+    Reads the journal tail. A crash in the middle of an append can leave a
+    partial last line; that line is dropped since its save never completed.
+
+    Parameters:
+      None
+    Returns:
+      records: list of journal record dictionaries
+    """
+    records = []
+    if not os.path.exists(self.journal_path):
+      return records
+
+    with open(self.journal_path) as f:
+      for line in f:
+        line = line.strip()
+        if not line:
+          continue
+        try:
+          records += [json.loads(line)]
+        except json.JSONDecodeError:
+          break
+    self.entry_count = len(records)
+    return records
+
+
+  def load(self):
+    """
+    Loads the agent state by reading the snapshot and replaying the journal
+    tail on top of it.
+
+    Parameters:
+      None
+    Returns:
+      scratch, nodes, embeddings
+    """
+    with open(f"{self.agent_folder}/scratch.json") as json_file:
+      scratch = json.load(json_file)
+    with open(f"{self.agent_folder}/memory_stream/embeddings.json") as json_file:
+      embeddings = json.load(json_file)
+    with open(f"{self.agent_folder}/memory_stream/nodes.json") as json_file:
+      nodes = json.load(json_file)
+
+    return replay_journal_records(self.read_records(),
+                                  scratch, nodes, embeddings)
+
+
+  def append(self, records, sync=False):
+    """
+    Appends records to the journal. The records of one call are written with
+    a single write; fsync is batched so that it is issued once every
+    <fsync_every> records (or right away when sync is True).
+
+    Parameters:
+      records: list of journal record dictionaries
+      sync: force an fsync after this append
+    Returns:
+      None
+    """
+    if not records:
+      return
+
+    payload = "".join(json.dumps(record) + "\n" for record in records)
+    with self._lock:
+      if self._file is None:
+        create_folder_if_not_there(self.journal_path)
+        self._file = open(self.journal_path, "a")
+      self._file.write(payload)
+      self._file.flush()
+
+      self.entry_count += len(records)
+      self.unsynced_count += len(records)
+      self.bytes_written += len(payload)
+      if sync or self.unsynced_count >= self.fsync_every:
+        os.fsync(self._file.fileno())
+        self.unsynced_count = 0
+
+
+  def append_archive(self, nodes):
+    """
+    Appends the packaged nodes archived by MemoryStream.compact (each with
+    the "merged_into" id of the node it was merged into) to archive.jsonl.
+    This is written before the journal records that remove the nodes, so a
+    crash in between at worst archives a node twice.
+    """
+    if not nodes:
+      return
+    create_folder_if_not_there(self.archive_path)
+    with open(self.archive_path, "a") as f:
+      f.write("".join(json.dumps(node) + "\n" for node in nodes))
+      f.flush()
+      os.fsync(f.fileno())
+
+
+  def read_archive(self):
+    """
+    The archived nodes by node id (e.g., to follow the lineage of a node
+    that was merged away).
+    """
+    archive = dict()
+    if not os.path.exists(self.archive_path):
+      return archive
+    with open(self.archive_path) as f:
+      for line in f:
+        try:
+          node = json.loads(line)
+        except json.JSONDecodeError:
+          continue
+        archive[node["node_id"]] = node
+    return archive
+
+
+  def needs_compaction(self):
+    return self.entry_count >= self.compact_every
+
+
+  def write_snapshot(self, scratch, nodes, embeddings, meta):
+    """
+    Writes a full snapshot of the agent and truncates the journal. Each
+    snapshot file is replaced atomically and the journal is only removed
+    once every file is in place, so a crash at any point still loads to the
+    latest saved state.
+
+    Parameters:
+      scratch: the scratch dictionary
+      nodes: list of packaged node dictionaries
+      embeddings: dictionary of content to embedding
+      meta: the packaged meta dictionary
+    Returns:
+      None
+    """
+    with self._lock:
+      write_json_atomic(embeddings,
+                        f"{self.agent_folder}/memory_stream/embeddings.json")
+      write_json_atomic(nodes,
+                        f"{self.agent_folder}/memory_stream/nodes.json",
+                        indent=2)
+      write_json_atomic(scratch, f"{self.agent_folder}/scratch.json", indent=2)
+      write_json_atomic(meta, f"{self.agent_folder}/meta.json", indent=2)
+
+      if self._file is not None:
+        self._file.close()
+        self._file = None
+      if os.path.exists(self.journal_path):
+        os.remove(self.journal_path)
+      self.entry_count = 0
+      self.unsynced_count = 0
+
+
+  def write_meta(self, meta):
+    """
+    Replaces meta.json atomically (its id and compaction state), without a 
+    snapshot of the rest of the agent.
+    """
+    with self._lock:
+      write_json_atomic(meta, f"{self.agent_folder}/meta.json", indent=2)
+
+
+  def close(self):
+    with self._lock:
+      if self._file is not None:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+        self.unsynced_count = 0
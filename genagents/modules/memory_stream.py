@@ -4,7 +4,14 @@ import datetime
 import random
 import string
 import re
-
+import json
+import time
+import hashlib
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 from numpy import dot
 from numpy.linalg import norm
 
@@ -17,7 +24,7 @@ from simulation_engine.llm_json_parser import *
 def run_gpt_generate_importance(
   records, 
   prompt_version="1",
-  gpt_version="GPT4o",  
+  gpt_version=None,  
   verbose=False):
 
   def create_prompt_input(records):
@@ -28,11 +35,10 @@ def run_gpt_generate_importance(
     return [records_str]
 
   def _func_clean_up(gpt_response, prompt=""): 
-    gpt_response = extract_first_json_dict(gpt_response)
     return list(gpt_response.values())
 
   def _get_fail_safe():
-    return 25
+    return [25] * len(records)
 
   if len(records) > 1: 
     prompt_lib_file = f"{LLM_PROMPT_DIR}/generative_agent/memory_stream/importance_score/batch_v1.txt" 
@@ -44,13 +50,14 @@ def run_gpt_generate_importance(
 
   output, prompt, prompt_input, fail_safe = chat_safe_generate(
     prompt_input, prompt_lib_file, gpt_version, 1, fail_safe, 
-    _func_clean_up, verbose)
+    _func_clean_up, verbose, response_schema=RESPONSE_SCHEMAS["importance"],
+    task="importance")
 
   return output, [output, prompt, prompt_input, fail_safe]
 
 
 def generate_importance_score(records): 
-  return run_gpt_generate_importance(records, "1", LLM_VERS)[0]
+  return run_gpt_generate_importance(records, "1")[0]
 
 
 def run_gpt_generate_reflection(
@@ -58,7 +65,7 @@ def run_gpt_generate_reflection(
   anchor, 
   reflection_count,
   prompt_version="1",
-  gpt_version="GPT4o",  
+  gpt_version=None,  
   verbose=False):
 
   def create_prompt_input(records, anchor, reflection_count):
@@ -69,7 +76,7 @@ def run_gpt_generate_reflection(
     return [records_str, reflection_count, anchor]
 
   def _func_clean_up(gpt_response, prompt=""): 
-    return extract_first_json_dict(gpt_response)["reflection"]
+    return gpt_response["reflection"]
 
   def _get_fail_safe():
     return []
@@ -84,15 +91,445 @@ def run_gpt_generate_reflection(
 
   output, prompt, prompt_input, fail_safe = chat_safe_generate(
     prompt_input, prompt_lib_file, gpt_version, 1, fail_safe, 
-    _func_clean_up, verbose)
+    _func_clean_up, verbose, response_schema=RESPONSE_SCHEMAS["reflection"],
+    task="reflection")
 
   return output, [output, prompt, prompt_input, fail_safe]
 
 
 def generate_reflection(records, anchor, reflection_count): 
   records = [i.content for i in records]
-  return run_gpt_generate_reflection(records, anchor, reflection_count, "1", 
-                                     LLM_VERS)[0]
+  return run_gpt_generate_reflection(records, anchor, reflection_count, 
+                                     "1")[0]
+
+
+# ##############################################################################
+# ###                      DEFERRED IMPORTANCE SCORING                       ###
+# ##############################################################################
+
+def heuristic_importance(content, embedding, recent_embeddings, 
+                         recent_contents=None): 
+  """
+  A provisional importance score (0 to 100) computed locally, for memories 
+  whose LLM score is deferred: longer records and records that are less 
+  similar to the agent's recent memories score higher. 
+
+  Parameters:
+    content: the str content of the memory record
+    embedding: the record's embedding, or None while it is pending; novelty
+      is then measured by word overlap with <recent_contents>
+    recent_embeddings: list of the embeddings of the agent's recent memories
+    recent_contents: list of the contents of the agent's recent memories
+  Returns: 
+    int provisional importance score
+  """
+  words = content.split()
+  length = min(1.0, math.log1p(len(words)) 
+                    / math.log1p(IMPORTANCE_HEURISTIC_WORDS))
+
+  novelty = 1.0
+  if embedding is not None and recent_embeddings: 
+    matrix = np.asarray(recent_embeddings, dtype=np.float32)
+    vector = np.asarray(embedding, dtype=np.float32)
+    sims = matrix @ vector / (norm(matrix, axis=1) * norm(vector) + 1e-12)
+    novelty = 1.0 - max(0.0, float(sims.max()))
+  elif embedding is None and recent_contents and words: 
+    word_set = set(i.lower() for i in words)
+    overlaps = [len(word_set & set(i.lower().split())) 
+                / len(word_set | set(i.lower().split())) 
+                for i in recent_contents]
+    novelty = 1.0 - max(overlaps)
+
+  score = 100 * (IMPORTANCE_HEURISTIC_LENGTH_W * length 
+                 + (1 - IMPORTANCE_HEURISTIC_LENGTH_W) * novelty)
+  return int(round(min(100.0, max(0.0, score))))
+
+
+class ImportanceScorer: 
+  def __init__(self, batch_size=IMPORTANCE_BATCH_SIZE, 
+               flush_seconds=IMPORTANCE_FLUSH_SECONDS, 
+               max_attempts=IMPORTANCE_MAX_ATTEMPTS, backoff_seconds=1.0): 
+    """
+    Scores deferred memories in the background. Nodes are submitted with a 
+    provisional importance; a worker thread collects them into batches of up
+    to <batch_size> (or whatever is queued after <flush_seconds>), scores 
+    each batch with one importance_score/batch_v1 request and writes the 
+    scores back, marking the nodes dirty so the next save journals them and
+    the memoized answers keyed on the memory fingerprint are invalidated. 
+    Batches may mix nodes of several agents. 
+
+    A batch whose request fails (the fail-safe scores come back) or whose 
+    response leaves nodes out is requeued right away, but not scored again
+    before an exponential backoff (<backoff_seconds> times 2 ** attempts, at
+    most a minute) has passed, so other nodes keep being scored meanwhile; 
+    after <max_attempts> the nodes keep their provisional scores. 
+    """
+    self.batch_size = batch_size
+    self.flush_seconds = flush_seconds
+    self.max_attempts = max_attempts
+    self.backoff_seconds = backoff_seconds
+    # Queue entries are (memory_stream, node, provisional importance, 
+    # attempts, not before), the last being the time.time() before which a
+    # retried entry is not scored again. 
+    self.queue = []
+    self.metrics = {"ingested": 0, "ingest_seconds": 0.0, "deferred": 0, 
+                    "scored": 0, "unscored": 0, "retries": 0, "batches": 0, 
+                    "drift_sum": 0.0, "drift_max": 0.0}
+    self._in_flight = 0
+    self._flushing = False
+    self._thread = None
+    self._cond = threading.Condition()
+
+
+  def submit(self, memory_stream, node): 
+    with self._cond: 
+      self.queue += [(memory_stream, node, node.importance, 0, 0.0)]
+      self.metrics["deferred"] += 1
+      if self._thread is None or not self._thread.is_alive(): 
+        self._thread = threading.Thread(target=self._run, daemon=True, 
+                                        name="importance-scorer")
+        self._thread.start()
+      if len(self.queue) >= self.batch_size: 
+        self._cond.notify_all()
+
+
+  def record_ingest(self, seconds): 
+    with self._cond: 
+      self.metrics["ingested"] += 1
+      self.metrics["ingest_seconds"] += seconds
+
+
+  def _num_ready(self): 
+    now = time.time()
+    return sum(1 for entry in self.queue if entry[4] <= now)
+
+
+  def _wait_seconds(self): 
+    # Waits at most <flush_seconds>, and no longer than until the next 
+    # retried entry's backoff is over. 
+    now = time.time()
+    backoffs = [entry[4] - now for entry in self.queue if entry[4] > now]
+    return max(0.0, min([self.flush_seconds] + backoffs))
+
+
+  def _run(self): 
+    while True: 
+      with self._cond: 
+        self._cond.wait_for(lambda: (self._num_ready() >= self.batch_size 
+                                     or (self._flushing and self._num_ready())),
+                            timeout=self._wait_seconds())
+        now = time.time()
+        batch = []
+        waiting = []
+        for entry in self.queue: 
+          if entry[4] <= now and len(batch) < self.batch_size: 
+            batch += [entry]
+          else: 
+            waiting += [entry]
+        if not batch: 
+          continue
+        self.queue = waiting
+        self._in_flight += len(batch)
+      retry = []
+      try: 
+        retry = self._score(batch)
+      finally: 
+        with self._cond: 
+          self.queue += retry
+          self._in_flight -= len(batch)
+          self._cond.notify_all()
+
+
+  def _score(self, batch): 
+    # Returns the entries to requeue (with one more attempt counted).
+    contents = [node.content for _, node, _, _, _ in batch]
+    try: 
+      scores, (_, _, _, fail_safe) = run_gpt_generate_importance(contents, "1")
+      if scores is fail_safe: 
+        # Every attempt failed: these are not scores.
+        scores = []
+    except Exception as e: 
+      print (f"Importance scoring failed: {e}")
+      scores = []
+
+    drifts = []
+    retry = []
+    unscored = 0
+    for count, entry in enumerate(batch): 
+      memory_stream, node, provisional, attempts, _ = entry
+      if count >= len(scores): 
+        # Failed or left out of the response; the node keeps its 
+        # provisional score until a later attempt succeeds.
+        if attempts + 1 < self.max_attempts: 
+          backoff = min(self.backoff_seconds * 2 ** (attempts + 1), 60)
+          retry += [(memory_stream, node, provisional, attempts + 1, 
+                     time.time() + backoff)]
+        else: 
+          unscored += 1
+        continue
+      with memory_stream._nodes_lock: 
+        node.importance = scores[count]
+        memory_stream.mark_dirty(node.node_id)
+      if node.node_type == "observation": 
+        memory_stream.track_importance(scores[count] - provisional)
+      drifts += [abs(scores[count] - provisional)]
+
+    with self._cond: 
+      self.metrics["batches"] += 1
+      self.metrics["scored"] += len(drifts)
+      self.metrics["unscored"] += unscored
+      self.metrics["retries"] += len(retry)
+      self.metrics["drift_sum"] += sum(drifts)
+      self.metrics["drift_max"] = max([self.metrics["drift_max"]] + drifts)
+    return retry
+
+
+  def pending(self): 
+    with self._cond: 
+      return len(self.queue) + self._in_flight
+
+
+  def flush(self, timeout=None): 
+    """
+    Scores everything that is queued right away and waits until it is done
+    (e.g., before saving agents whose final scores should be persisted). 
+    Returns True if nothing is pending anymore. 
+    """
+    with self._cond: 
+      self._flushing = True
+      self._cond.notify_all()
+      try: 
+        return self._cond.wait_for(
+          lambda: not self.queue and not self._in_flight, timeout=timeout)
+      finally: 
+        self._flushing = False
+
+
+  def stats(self): 
+    """
+    The ingestion throughput (remember calls per second of ingestion time), 
+    the number of deferred, scored and still pending nodes, and how far the 
+    provisional scores drifted from the final ones. 
+    """
+    with self._cond: 
+      ret = dict(self.metrics)
+      ret["pending"] = len(self.queue) + self._in_flight
+    ret["ingest_per_sec"] = (ret["ingested"] / ret["ingest_seconds"] 
+                             if ret["ingest_seconds"] else 0.0)
+    ret["mean_drift"] = ret["drift_sum"] / ret["scored"] if ret["scored"] else 0.0
+    return ret
+
+
+# The scorer every deferred memory stream submits to. Worker processes each 
+# hold their own.
+shared_importance_scorer = ImportanceScorer()
+
+
+# ##############################################################################
+# ###                          REFLECTION SCHEDULER                          ###
+# ##############################################################################
+
+class ReflectionScheduler: 
+  def __init__(self, batch_size=REFLECTION_BATCH_SIZE, 
+               reflection_count=REFLECTION_COUNT, 
+               anchor_nodes=REFLECTION_ANCHOR_NODES): 
+    """
+    Generates reflections automatically, off the caller's thread. A memory 
+    stream is enqueued once the importance of the observations added since 
+    its last reflection crosses REFLECTION_THRESHOLD (see 
+    MemoryStream.track_importance); a worker thread reflects the queued 
+    streams in batches of up to <batch_size>, concurrently. Their LLM calls
+    go through the shared scheduler in the "batch" priority class, so they 
+    are bounded by the rate limiter and yield to interactive requests. 
+
+    The anchor of an automatic reflection is the content of the stream's 
+    <anchor_nodes> most recent observations. 
+
+    The same worker runs the scheduled compactions (COMPACTION_EVERY): a 
+    stream enqueued with the "compact" job merges its near-duplicate 
+    observations in the background rather than on the thread that saves it.
+    """
+    self.batch_size = batch_size
+    self.reflection_count = reflection_count
+    self.anchor_nodes = anchor_nodes
+    self.queue = []
+    self.metrics = {"enqueued": 0, "reflections": 0, "compactions": 0, 
+                    "compacted_nodes": 0, "failures": 0, "batches": 0, 
+                    "seconds": 0.0}
+    self._queued = set()
+    self._in_flight = 0
+    self._thread = None
+    # Reused by every batch rather than started anew per batch.
+    self._executor = ThreadPoolExecutor(max_workers=batch_size, 
+                                        thread_name_prefix="reflection-job")
+    self._cond = threading.Condition()
+
+
+  def enqueue(self, memory_stream, job="reflect"): 
+    """
+    Queues a stream for a reflection (job "reflect") or a compaction (job 
+    "compact"). 
+    """
+    with self._cond: 
+      # A stream waits in the queue at most once per job.
+      if (id(memory_stream), job) in self._queued: 
+        return
+      self._queued.add((id(memory_stream), job))
+      self.queue += [(memory_stream, job)]
+      self.metrics["enqueued"] += 1
+      if self._thread is None or not self._thread.is_alive(): 
+        self._thread = threading.Thread(target=self._run, daemon=True, 
+                                        name="reflection-scheduler")
+        self._thread.start()
+      self._cond.notify_all()
+
+
+  def _run(self): 
+    while True: 
+      with self._cond: 
+        self._cond.wait_for(lambda: self.queue)
+        batch = self.queue[:self.batch_size]
+        del self.queue[:self.batch_size]
+        self._in_flight += len(batch)
+      start = time.time()
+      try: 
+        list(self._executor.map(self._run_job, batch))
+      finally: 
+        with self._cond: 
+          for memory_stream, job in batch: 
+            self._queued.discard((id(memory_stream), job))
+          self._in_flight -= len(batch)
+          self.metrics["batches"] += 1
+          self.metrics["seconds"] += time.time() - start
+          self._cond.notify_all()
+
+
+  def _run_job(self, entry): 
+    memory_stream, job = entry
+    if job == "compact": 
+      self._compact(memory_stream)
+    else: 
+      self._reflect(memory_stream)
+
+
+  def _compact(self, memory_stream): 
+    try: 
+      report = memory_stream.compact(measure=False)
+    except Exception as e: 
+      print (f"Scheduled compaction failed: {e}")
+      with self._cond: 
+        self.metrics["failures"] += 1
+      return
+    with self._cond: 
+      self.metrics["compactions"] += 1
+      self.metrics["compacted_nodes"] += report["removed"]
+
+
+  def _reflect(self, memory_stream): 
+    # The stream is read under its <_nodes_lock> (a compaction or remember()
+    # may be changing it); reflect() adds its nodes under the same lock.
+    with memory_stream._nodes_lock: 
+      seq_nodes = list(memory_stream.seq_nodes)
+    observations = []
+    for node in reversed(seq_nodes): 
+      if len(observations) >= self.anchor_nodes: 
+        break
+      if node.node_type == "observation": 
+        observations = [node] + observations
+    if not observations: 
+      return
+    anchor = " ".join(node.content for node in observations)
+    try: 
+      memory_stream.reflect(anchor, self.reflection_count, 
+                            time_step=observations[-1].created)
+    except Exception as e: 
+      print (f"Scheduled reflection failed: {e}")
+      with self._cond: 
+        self.metrics["failures"] += 1
+      return
+    with self._cond: 
+      self.metrics["reflections"] += 1
+
+
+  def pending(self): 
+    with self._cond: 
+      return len(self.queue) + self._in_flight
+
+
+  def flush(self, timeout=None): 
+    """
+    Waits until every queued reflection has run. Returns True if nothing is
+    pending anymore. 
+    """
+    with self._cond: 
+      return self._cond.wait_for(
+        lambda: not self.queue and not self._in_flight, timeout=timeout)
+
+
+  def stats(self): 
+    with self._cond: 
+      ret = dict(self.metrics)
+      ret["pending"] = len(self.queue) + self._in_flight
+    return ret
+
+
+# The scheduler memory streams enqueue themselves on when REFLECTION_AUTO is
+# on. Worker processes each hold their own.
+shared_reflection_scheduler = ReflectionScheduler()
+
+
+# ##############################################################################
+# ###                        PENDING EMBEDDING QUEUE                         ###
+# ##############################################################################
+
+# Counts of the contents queued for embedding and of the batched requests 
+# that embedded them. 
+embedding_metrics = {"queued": 0, "flushes": 0, "embedded": 0}
+_embedding_metrics_lock = threading.Lock()
+
+
+class EmbeddingFlusher: 
+  def __init__(self, max_age=EMBEDDING_FLUSH_SECONDS): 
+    """
+    Optionally (EMBEDDING_BACKGROUND_FLUSH) flushes the pending embeddings 
+    of memory streams in the background once they are older than 
+    <max_age>, for streams that receive a few memories and then sit idle. 
+    Streams are held weakly. 
+    """
+    self.max_age = max_age
+    self.streams = weakref.WeakSet()
+    self._thread = None
+    self._lock = threading.Lock()
+
+
+  def register(self, memory_stream): 
+    with self._lock: 
+      self.streams.add(memory_stream)
+      if self._thread is None or not self._thread.is_alive(): 
+        self._thread = threading.Thread(target=self._run, daemon=True, 
+                                        name="embedding-flusher")
+        self._thread.start()
+
+
+  def _run(self): 
+    while True: 
+      time.sleep(self.max_age / 2)
+      with self._lock: 
+        streams = list(self.streams)
+      for memory_stream in streams: 
+        if memory_stream.pending_age() < self.max_age: 
+          continue
+        try: 
+          memory_stream.flush_embeddings()
+        except Exception as e: 
+          # The contents stay pending; the next retrieve flushes them again.
+          print (f"Embedding flush failed: {e}")
+          continue
+        with self._lock: 
+          self.streams.discard(memory_stream)
+
+
+shared_embedding_flusher = EmbeddingFlusher()
 
 
 # ##############################################################################
@@ -325,6 +762,55 @@ class MemoryStream:
 
     self.embeddings = embeddings
 
+    # Contents of new nodes that are not embedded yet (EMBEDDING_LAZY). They
+    # are embedded together, in batched requests, once EMBEDDING_FLUSH_SIZE 
+    # of them are queued or the oldest is EMBEDDING_FLUSH_SECONDS old, and 
+    # before anything reads the embeddings (retrieve, save). 
+    self.pending_embeddings = dict()
+    self._pending_since = None
+    self._embedding_lock = threading.RLock()
+
+    # Node ids that were added or modified since the agent was last saved. 
+    # This lets the agent journal only the nodes that changed. 
+    self.dirty_node_ids = dict()
+
+    # <version> counts the changes to the memory stream; the fingerprints
+    # (content hashes used to key memoized answers) are cached until the 
+    # next change. 
+    self.version = 0
+    self._fingerprints = dict()
+
+    # New nodes are added under <_nodes_lock>: scheduled reflections and 
+    # remember() may add nodes to the same stream from different threads. 
+    self._nodes_lock = threading.RLock()
+
+    # The importance of the observations added since the last reflection; 
+    # once it crosses REFLECTION_THRESHOLD, the stream is enqueued on its 
+    # <reflection_scheduler> (None: reflections only run when asked for). 
+    self.reflection_scheduler = (shared_reflection_scheduler 
+                                 if REFLECTION_AUTO else None)
+    # Compaction: the nodes archived since the agent was last saved (they 
+    # go to the agent's archive.jsonl) and the node id below which the 
+    # observations were already compacted against each other. 
+    self.pending_archive = []
+    self.compacted_through = 0
+    # Scheduled compaction: once COMPACTION_EVERY nodes were added since the
+    # last compaction, a new observation enqueues the stream on its 
+    # <compaction_scheduler> (None: compactions only run when asked for). 
+    self.compaction_scheduler = (shared_reflection_scheduler 
+                                 if COMPACTION_EVERY else None)
+
+    # Callables notified with the change in the number of nodes whenever 
+    # nodes are added or compacted away (e.g., by the AgentPool holding the
+    # agent, which keeps its node count without recounting every agent). 
+    self.size_listeners = []
+
+    self.importance_since_reflection = 0
+    for node in reversed(self.seq_nodes): 
+      if node.node_type == "reflection": 
+        break
+      self.importance_since_reflection += node.importance
+
 
   def count_observations(self): 
     """
@@ -367,14 +853,26 @@ class MemoryStream:
     if len(self.seq_nodes) == 0:
       return dict()
 
+    self.flush_embeddings()
+
     # Filtering for the desired node type. curr_filter can be one of the three
     # elements: 'all', 'reflection', 'observation' 
-    if curr_filter == "all": 
-      curr_nodes = self.seq_nodes
-    else: 
+    # The nodes (and their embeddings) are snapshotted under <_nodes_lock>,
+    # so scheduled reflections and compactions can change the stream while 
+    # it is scored. Nodes added since the flush and not embedded yet are 
+    # left out. 
+    with self._nodes_lock: 
+      embeddings = dict()
       for curr_node in self.seq_nodes: 
-        if curr_node.node_type == curr_filter: 
-          curr_nodes += [curr_node]
+        if curr_filter != "all" and curr_node.node_type != curr_filter: 
+          continue
+        if curr_node.content not in self.embeddings: 
+          continue
+        curr_nodes += [curr_node]
+        embeddings[curr_node.content] = self.embeddings[curr_node.content]
+    if not curr_nodes: 
+      return {focal_pt: [] for focal_pt in focal_points}
+    id_to_node = {node.node_id: node for node in curr_nodes}
 
     # <retrieved> is the main dictionary that we are returning
     retrieved = dict() 
@@ -384,7 +882,7 @@ class MemoryStream:
       recency_out = normalize_dict_floats(x, 0, 1)
       x = extract_importance(curr_nodes)
       importance_out = normalize_dict_floats(x, 0, 1)  
-      x = extract_relevance(curr_nodes, self.embeddings, focal_pt)
+      x = extract_relevance(curr_nodes, embeddings, focal_pt)
       relevance_out = normalize_dict_floats(x, 0, 1)
       
       # Computing the final scores that combines the component values. 
@@ -400,7 +898,7 @@ class MemoryStream:
       if verbose: 
         master_out = top_highest_x_values(master_out, len(master_out.keys()))
         for key, val in master_out.items(): 
-          print (self.id_to_node[key].content, val)
+          print (id_to_node[key].content, val)
           print (recency_w*recency_out[key]*1, 
                  relevance_w*relevance_out[key]*1, 
                  importance_w*importance_out[key]*1)
@@ -410,7 +908,7 @@ class MemoryStream:
       # the highest x values, we want to translate the node.id into nodes 
       # and return the list of nodes.
       master_out = top_highest_x_values(master_out, n_count)
-      master_nodes = [self.id_to_node[key] for key in list(master_out.keys())]
+      master_nodes = [id_to_node[key] for key in list(master_out.keys())]
 
       # **Sort the master_nodes list by last_retrieved in descending order**
       master_nodes = sorted(master_nodes, 
@@ -427,7 +925,8 @@ class MemoryStream:
     return retrieved 
 
 
-  def _add_node(self, time_step, node_type, content, importance, pointer_id):
+  def _add_node(self, time_step, node_type, content, importance, pointer_id,
+                embedding=None):
     """
     Adding a new node to the memory stream. 
 
@@ -437,37 +936,357 @@ class MemoryStream:
       content: the str content of the memory record
       importance: int score of the importance score
       pointer_id: the str of the parent node 
+      embedding: the content's embedding, if it was already computed
     Returns: 
-      retrieved: A dictionary whose keys are a focal_pt query str, and whose
-        values are a list of nodes that are retrieved for that query str. 
+      the new ConceptNode
+    """
+    with self._nodes_lock: 
+      # Node ids are never reused: compaction only archives nodes into a 
+      # newer node of their cluster, so the last node holds the largest id.
+      node_dict = dict()
+      node_dict["node_id"] = (self.seq_nodes[-1].node_id + 1 
+                              if self.seq_nodes else 0)
+      node_dict["node_type"] = node_type
+      node_dict["content"] = content
+      node_dict["importance"] = importance
+      node_dict["created"] = time_step
+      node_dict["last_retrieved"] = time_step
+      node_dict["pointer_id"] = pointer_id
+      new_node = ConceptNode(node_dict)
+
+      self.seq_nodes += [new_node]
+      self.id_to_node[new_node.node_id] = new_node
+      self._notify_size(1)
+    if embedding is not None: 
+      self.embeddings[content] = embedding
+    elif content not in self.embeddings: 
+      if EMBEDDING_LAZY: 
+        self._queue_embedding(content)
+      else: 
+        self.embeddings[content] = get_text_embedding(content)
+    self.mark_dirty(new_node.node_id)
+    if node_type == "observation": 
+      self.track_importance(importance)
+      if self.compaction_scheduler is not None and self.compaction_due(): 
+        self.compaction_scheduler.enqueue(self, "compact")
+    return new_node
+
+
+  def compaction_due(self, every=None): 
+    """
+    True once <every> (default COMPACTION_EVERY) nodes were added since the
+    last compaction. 
     """
-    node_dict = dict()
-    node_dict["node_id"] = len(self.seq_nodes)
-    node_dict["node_type"] = node_type
-    node_dict["content"] = content
-    node_dict["importance"] = importance
-    node_dict["created"] = time_step
-    node_dict["last_retrieved"] = time_step
-    node_dict["pointer_id"] = pointer_id
-    new_node = ConceptNode(node_dict)
+    every = COMPACTION_EVERY if every is None else every
+    with self._nodes_lock: 
+      return bool(every and self.seq_nodes and self.seq_nodes[-1].node_id + 1
+                  - self.compacted_through >= every)
 
-    self.seq_nodes += [new_node]
-    self.id_to_node[new_node.node_id] = new_node
-    self.embeddings[content] = get_text_embedding(content)
 
+  def _notify_size(self, delta): 
+    for listener in list(self.size_listeners): 
+      listener(delta)
 
-  def remember(self, content, time_step=0):
-    score = generate_importance_score([content])[0]
-    self._add_node(time_step, "observation", content, score, None)
+
+  def track_importance(self, importance): 
+    """
+    Adds to the importance accumulated since the last reflection and 
+    enqueues an automatic reflection once it crosses REFLECTION_THRESHOLD. 
+    """
+    with self._nodes_lock: 
+      self.importance_since_reflection += importance
+      due = self.importance_since_reflection >= REFLECTION_THRESHOLD
+    if self.reflection_scheduler is not None and due: 
+      self.reflection_scheduler.enqueue(self)
+
+
+  def _queue_embedding(self, content): 
+    with self._embedding_lock: 
+      if not self.pending_embeddings: 
+        self._pending_since = time.time()
+        if EMBEDDING_BACKGROUND_FLUSH: 
+          shared_embedding_flusher.register(self)
+      self.pending_embeddings[content] = True
+      due = (len(self.pending_embeddings) >= EMBEDDING_FLUSH_SIZE 
+             or self.pending_age() >= EMBEDDING_FLUSH_SECONDS)
+    with _embedding_metrics_lock: 
+      embedding_metrics["queued"] += 1
+    if due: 
+      self.flush_embeddings()
+
+
+  def pending_age(self): 
+    """
+    Seconds since the oldest pending embedding was queued (0 if none). 
+    """
+    since = self._pending_since
+    return time.time() - since if since is not None else 0.0
+
+
+  def flush_embeddings(self): 
+    """
+    Embeds every pending content with batched embedding requests. If the 
+    request fails, the contents stay pending and the error is raised. 
+
+    Parameters:
+      None
+    Returns: 
+      the number of contents embedded
+    """
+    with self._embedding_lock: 
+      contents = list(self.pending_embeddings.keys())
+      if not contents: 
+        return 0
+      for content, embedding in zip(contents, get_text_embeddings(contents)): 
+        self.embeddings[content] = embedding
+      self.pending_embeddings = dict()
+      self._pending_since = None
+    with _embedding_metrics_lock: 
+      embedding_metrics["flushes"] += 1
+      embedding_metrics["embedded"] += len(contents)
+    return len(contents)
+
+
+  def mark_dirty(self, node_id): 
+    """
+    Flagging a node as changed since the last save so that the next save 
+    writes it to the agent's journal. 
+
+    Parameters:
+      node_id: the int id of the node that was added or modified
+    Returns: 
+      None
+    """
+    self.dirty_node_ids[node_id] = True
+    self.version += 1
+    self._fingerprints = dict()
+
+
+  def fingerprint(self, node_types=None): 
+    """
+    A hash of the memory stream's content (node ids, types, contents, 
+    importance and creation times, but not the retrieval times), optionally
+    restricted to some node types. It is stable across saves and reloads, so
+    it identifies the state an answer was generated from. 
+
+    Parameters:
+      node_types: list of node types to include, or None for all
+    Returns: 
+      str hex digest
+    """
+    cache_key = tuple(node_types) if node_types else None
+    if cache_key not in self._fingerprints: 
+      digest = hashlib.sha1()
+      for node in self.seq_nodes: 
+        if node_types and node.node_type not in node_types: 
+          continue
+        digest.update(json.dumps([node.node_id, node.node_type, node.content, 
+                                  node.importance, node.created]).encode())
+      self._fingerprints[cache_key] = digest.hexdigest()
+    return self._fingerprints[cache_key]
+
+
+  def _scoring_seconds(self, nodes): 
+    # The time of one retrieval scoring pass over <nodes> (recency, 
+    # importance and relevance, as in retrieve), without the focal point's 
+    # embedding request. 
+    focal_embedding = self.embeddings[nodes[0].content]
+    start = time.time()
+    normalize_dict_floats(extract_recency(nodes), 0, 1)
+    normalize_dict_floats(extract_importance(nodes), 0, 1)
+    relevance_out = {node.node_id: cos_sim(self.embeddings[node.content], 
+                                           focal_embedding) 
+                     for node in nodes}
+    normalize_dict_floats(relevance_out, 0, 1)
+    return time.time() - start
+
+
+  def _storage_bytes(self): 
+    # The size of nodes.json and embeddings.json (the embeddings estimated 
+    # from the size of one of them). 
+    if not self.embeddings: 
+      return 0
+    nodes_bytes = len(json.dumps([node.package() for node in self.seq_nodes]))
+    embedding_bytes = len(json.dumps(next(iter(self.embeddings.values()))))
+    return nodes_bytes + embedding_bytes * len(self.embeddings)
+
+
+  def compact(self, similarity=COMPACTION_SIMILARITY, incremental=True, 
+              block_size=1024, measure=True): 
+    """
+    Consolidates near-duplicate observations. The normalized embeddings of 
+    the observations are compared block by block with one matrix product, 
+    pairs above <similarity> are grouped into clusters (union-find), and 
+    every cluster is merged into its newest node: that node keeps the 
+    highest importance and the latest retrieval time of the cluster, and the
+    others are archived (removed from the stream and its embeddings, and 
+    written to the agent's archive.jsonl with the id they were merged into 
+    on the next save). Reflections that pointed to an archived node point to
+    its cluster's node instead. 
+
+    Parameters:
+      similarity: cosine similarity above which two observations are 
+        near-duplicates
+      incremental: only compare the observations added since the last 
+        compaction (against all observations) instead of every pair
+      block_size: observations compared per matrix product
+      measure: time a retrieval scoring pass and estimate the storage size 
+        before and after
+    Returns: 
+      report dictionary: the clusters merged, the nodes removed and, with 
+      <measure>, the retrieval scoring time and storage before and after
+    """
+    start = time.time()
+    self.flush_embeddings()
+    with self._nodes_lock: 
+      observations = [node for node in self.seq_nodes 
+                      if node.node_type == "observation"]
+      report = {"nodes_before": len(self.seq_nodes), "clusters": 0, 
+                "removed": 0}
+      if measure and observations: 
+        report["retrieval_seconds_before"] = self._scoring_seconds(
+          self.seq_nodes)
+        report["storage_bytes_before"] = self._storage_bytes()
+
+      # Vectorized near-duplicate search. 
+      matrix = np.asarray([self.embeddings[node.content] 
+                           for node in observations], dtype=np.float32)
+      if len(observations): 
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        matrix = matrix / norms
+      first = 0
+      if incremental: 
+        first = next((count for count, node in enumerate(observations) 
+                      if node.node_id >= self.compacted_through), 
+                     len(observations))
+
+      parent = list(range(len(observations)))
+      def find(i): 
+        while parent[i] != i: 
+          parent[i] = parent[parent[i]]
+          i = parent[i]
+        return i
+
+      for block_start in range(first, len(observations), block_size): 
+        block = matrix[block_start:block_start + block_size]
+        sims = block @ matrix.T
+        rows, cols = np.nonzero(sims >= similarity)
+        for row, col in zip(rows + block_start, cols): 
+          if row != col: 
+            parent[find(row)] = find(col)
+
+      clusters = dict()
+      for count in range(len(observations)): 
+        clusters.setdefault(find(count), []).append(observations[count])
+
+      # Merging every cluster into its newest node (the largest node id). 
+      merged_into = dict()
+      for members in clusters.values(): 
+        if len(members) < 2: 
+          continue
+        keep = max(members, key=lambda node: node.node_id)
+        keep.importance = max(node.importance for node in members)
+        keep.last_retrieved = max(node.last_retrieved for node in members)
+        self.mark_dirty(keep.node_id)
+        for node in members: 
+          if node is not keep: 
+            merged_into[node.node_id] = keep.node_id
+        report["clusters"] += 1
+
+      if merged_into: 
+        self.seq_nodes = [node for node in self.seq_nodes 
+                          if node.node_id not in merged_into]
+        self._notify_size(-len(merged_into))
+        live_contents = set(node.content for node in self.seq_nodes)
+        for node_id, keep_id in merged_into.items(): 
+          node = self.id_to_node.pop(node_id)
+          self.dirty_node_ids.pop(node_id, None)
+          if node.content not in live_contents: 
+            self.embeddings.pop(node.content, None)
+          package = node.package()
+          package["merged_into"] = keep_id
+          self.pending_archive += [package]
+
+        # Keeping the lineage of the reflections. 
+        for node in self.seq_nodes: 
+          if node.node_type != "reflection" or not node.pointer_id: 
+            continue
+          pointer_id = list(dict.fromkeys(merged_into.get(i, i) 
+                                          for i in node.pointer_id))
+          if pointer_id != node.pointer_id: 
+            node.pointer_id = pointer_id
+            self.mark_dirty(node.node_id)
+        self.version += 1
+        self._fingerprints = dict()
+
+      if observations: 
+        self.compacted_through = observations[-1].node_id + 1
+      report["removed"] = len(merged_into)
+      report["nodes_after"] = len(self.seq_nodes)
+      if measure and observations: 
+        report["retrieval_seconds_after"] = self._scoring_seconds(
+          self.seq_nodes)
+        report["storage_bytes_after"] = self._storage_bytes()
+    report["seconds"] = time.time() - start
+    return report
+
+
+  def _add_deferred_node(self, time_step, node_type, content, pointer_id, 
+                         scorer): 
+    # Inserts the node right away with a heuristic importance and leaves the
+    # LLM score to the background scorer. With lazy embeddings, the new 
+    # content is not embedded yet and novelty falls back to word overlap. 
+    embedding = None if EMBEDDING_LAZY else get_text_embedding(content)
+    with self._nodes_lock: 
+      recent_nodes = self.seq_nodes[-IMPORTANCE_NOVELTY_WINDOW:]
+      recent_embeddings = [self.embeddings[node.content] 
+                           for node in recent_nodes
+                           if node.content in self.embeddings]
+    score = heuristic_importance(content, embedding, recent_embeddings, 
+                                 [node.content for node in recent_nodes])
+    node = self._add_node(time_step, node_type, content, score, pointer_id, 
+                          embedding)
+    scorer.submit(self, node)
+
+
+  def remember(self, content, time_step=0, deferred=None, 
+               scorer=shared_importance_scorer):
+    """
+    Adds an observation. By default (IMPORTANCE_DEFERRED) the importance is
+    scored by the LLM before the node is added; a deferred memory is added 
+    right away with a provisional heuristic score that <scorer> replaces 
+    with the LLM score in the background. 
+    """
+    start = time.time()
+    deferred = IMPORTANCE_DEFERRED if deferred is None else deferred
+    if deferred: 
+      self._add_deferred_node(time_step, "observation", content, None, scorer)
+    else: 
+      score = generate_importance_score([content])[0]
+      self._add_node(time_step, "observation", content, score, None)
+    scorer.record_ingest(time.time() - start)
 
 
   def reflect(self, anchor, reflection_count=5, 
-              retrieval_count=120, time_step=0): 
+              retrieval_count=120, time_step=0, deferred=None, 
+              scorer=shared_importance_scorer): 
     records = self.retrieve([anchor], time_step, retrieval_count)[anchor]
     record_ids = [i.node_id for i in records]
+    # Observations added while the reflection is generated count toward the
+    # next one. 
+    with self._nodes_lock: 
+      self.importance_since_reflection = 0
     reflections = generate_reflection(records, anchor, reflection_count)
-    scores = generate_importance_score(reflections)
 
+    deferred = IMPORTANCE_DEFERRED if deferred is None else deferred
+    if deferred: 
+      for reflection in reflections: 
+        self._add_deferred_node(time_step, "reflection", reflection, 
+                                record_ids, scorer)
+      return
+
+    scores = generate_importance_score(reflections)
     for count, reflection in enumerate(reflections): 
       self._add_node(time_step, "reflection", reflections[count], 
                      scores[count], record_ids)
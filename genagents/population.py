@@ -0,0 +1,322 @@
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from simulation_engine.settings import *
+from simulation_engine.global_methods import *
+from genagents.genagents import GenerativeAgent
+from genagents.modules.journal import AgentJournal, read_meta, read_scratch
+
+
+# ##############################################################################
+# ###                      POPULATION HELPER FUNCTIONS                       ###
+# ##############################################################################
+
+def discover_agent_folders(population_dir):
+  """
+  Finds every agent folder (a folder with a scratch.json) directly inside a
+  population directory.
+
+  Parameters:
+    population_dir: path to the population directory
+  Returns:
+    agent_folders: a dictionary whose keys are the agent ids (the folder
+      names) and whose values are the agent folder paths, sorted by id
+  """
+  agent_folders = dict()
+  if not os.path.isdir(population_dir):
+    print (f"Population directory not found at {population_dir}")
+    return agent_folders
+
+  for agent_id in sorted(os.listdir(population_dir)):
+    agent_folder = f"{population_dir}/{agent_id}"
+    if os.path.isfile(f"{agent_folder}/scratch.json"):
+      agent_folders[agent_id] = agent_folder
+  return agent_folders
+
+
+def load_agent_state(agent_folder):
+  """
+  Parses an agent folder into plain Python objects. This runs inside the
+  worker processes of the population loader, so that the JSON parsing of
+  many agents happens in parallel instead of under one GIL.
+
+  Parameters:
+    agent_folder: path to the agent folder
+  Returns:
+    A dictionary with the agent's scratch, nodes, embeddings, the number of
+    replayed journal records and the number of bytes read.
+  """
+  journal = AgentJournal(agent_folder)
+  scratch, nodes, embeddings = journal.load()
+
+  num_bytes = 0
+  for file_path in [f"{agent_folder}/scratch.json",
+                    f"{agent_folder}/memory_stream/nodes.json",
+                    f"{agent_folder}/memory_stream/embeddings.json",
+                    journal.journal_path]:
+    if os.path.exists(file_path):
+      num_bytes += os.path.getsize(file_path)
+
+  return {"agent_folder": agent_folder,
+          "scratch": scratch,
+          "nodes": nodes,
+          "embeddings": embeddings,
+          "journal_entries": journal.entry_count,
+          "meta": read_meta(agent_folder),
+          "num_bytes": num_bytes}
+
+
+def _agent_from_state(state):
+  return GenerativeAgent.from_state(state["scratch"],
+                                    state["nodes"],
+                                    state["embeddings"],
+                                    state["agent_folder"],
+                                    state["journal_entries"],
+                                    state.get("meta"))
+
+
+def _matches_criteria(scratch, criteria):
+  for field, allowed in criteria.items():
+    if field not in scratch:
+      return False
+    if callable(allowed):
+      if not allowed(scratch[field]):
+        return False
+    elif isinstance(allowed, (list, tuple, set)):
+      if scratch[field] not in allowed:
+        return False
+    elif scratch[field] != allowed:
+      return False
+  return True
+
+
+# ##############################################################################
+# ###                               POPULATION                               ###
+# ##############################################################################
+
+class Population:
+  def __init__(self, population=None, population_dir=None, num_workers=None,
+               agent_folders=None):
+    # A population is either named (a folder inside POPULATIONS_DIR) or
+    # given as an explicit directory.
+    if not population_dir:
+      population_dir = f"{POPULATIONS_DIR}/{population}"
+    self.population = population if population else os.path.basename(
+                                                population_dir.rstrip("/"))
+    self.population_dir = population_dir
+    self.num_workers = num_workers if num_workers else (os.cpu_count() or 1)
+
+    if agent_folders is None:
+      agent_folders = discover_agent_folders(population_dir)
+    self.agent_folders = agent_folders
+    self.agents = dict()
+    self.scratches = dict()
+    self.load_stats = {"agents": 0, "bytes": 0, "seconds": 0.0,
+                       "agents_per_sec": 0.0, "mb_per_sec": 0.0}
+
+
+  def __len__(self):
+    return len(self.agent_folders)
+
+
+  def __contains__(self, agent_id):
+    return agent_id in self.agent_folders
+
+
+  def __iter__(self):
+    return iter(self.agent_folders)
+
+
+  def __getitem__(self, agent_id):
+    """
+    Returns the agent with the given id, loading it on first access.
+
+    Parameters:
+      agent_id: the agent id (the name of the agent folder)
+    Returns:
+      GenerativeAgent
+    """
+    if agent_id not in self.agent_folders:
+      raise KeyError(agent_id)
+    if agent_id not in self.agents:
+      start = time.time()
+      state = load_agent_state(self.agent_folders[agent_id])
+      self.agents[agent_id] = _agent_from_state(state)
+      self.scratches[agent_id] = state["scratch"]
+      self._record_load(1, state["num_bytes"], time.time() - start)
+    return self.agents[agent_id]
+
+
+  def ids(self):
+    return list(self.agent_folders.keys())
+
+
+  def _record_load(self, num_agents, num_bytes, seconds):
+    self.load_stats["agents"] += num_agents
+    self.load_stats["bytes"] += num_bytes
+    self.load_stats["seconds"] += seconds
+    if self.load_stats["seconds"] > 0:
+      self.load_stats["agents_per_sec"] = (self.load_stats["agents"]
+                                           / self.load_stats["seconds"])
+      self.load_stats["mb_per_sec"] = (self.load_stats["bytes"] / 1e6
+                                       / self.load_stats["seconds"])
+
+
+  def _make_executor(self, num_workers):
+    # Spawned rather than forked: a forked worker would inherit the parent's
+    # threads' locks (the background scorers, flushers and HTTP pools) in
+    # whatever state they were in.
+    return ProcessPoolExecutor(
+      max_workers=num_workers,
+      mp_context=multiprocessing.get_context("spawn"))
+
+
+  def _load_states(self, executor, agent_ids):
+    agent_folders = [self.agent_folders[agent_id] for agent_id in agent_ids]
+    if executor is None:
+      return map(load_agent_state, agent_folders)
+    chunksize = max(1, len(agent_folders) // (self.num_workers * 4))
+    return executor.map(load_agent_state, agent_folders, chunksize=chunksize)
+
+
+  def load(self, agent_ids=None, num_workers=None, verbose=True):
+    """
+    Loads agents into memory in parallel. Agent folders are parsed in a
+    process pool and the agents are rebuilt in the parent process.
+
+    Parameters:
+      agent_ids: the ids to load; all agents that are not yet loaded when
+        None
+      num_workers: number of worker processes (defaults to the population's
+        num_workers). With 1 worker, the agents load in-process.
+      verbose: print the load throughput
+    Returns:
+      self
+    """
+    if agent_ids is None:
+      agent_ids = self.ids()
+    agent_ids = [i for i in agent_ids if i not in self.agents]
+    if not agent_ids:
+      return self
+
+    num_workers = num_workers if num_workers else self.num_workers
+    num_workers = min(num_workers, len(agent_ids))
+
+    start = time.time()
+    num_bytes = 0
+    if num_workers > 1:
+      with self._make_executor(num_workers) as executor:
+        for agent_id, state in zip(agent_ids,
+                                   self._load_states(executor, agent_ids)):
+          self.agents[agent_id] = _agent_from_state(state)
+          self.scratches[agent_id] = state["scratch"]
+          num_bytes += state["num_bytes"]
+    else:
+      for agent_id, state in zip(agent_ids,
+                                 self._load_states(None, agent_ids)):
+        self.agents[agent_id] = _agent_from_state(state)
+        self.scratches[agent_id] = state["scratch"]
+        num_bytes += state["num_bytes"]
+    self._record_load(len(agent_ids), num_bytes, time.time() - start)
+
+    if verbose:
+      print (f"Loaded {len(agent_ids)} agents from {self.population_dir} in "
+             f"{self.load_stats['seconds']:.2f}s "
+             f"({self.load_stats['agents_per_sec']:.1f} agents/s, "
+             f"{self.load_stats['mb_per_sec']:.1f} MB/s)")
+    return self
+
+
+  def stream(self, agent_ids=None, batch_size=None, num_workers=None):
+    """
+    Yields agents one at a time without keeping them in the population, so
+    memory stays bounded by the batch size. Batches are parsed in parallel
+    while the caller consumes the previous agents.
+
+    Parameters:
+      agent_ids: the ids to stream; all agents when None
+      batch_size: number of agents parsed ahead of the caller
+      num_workers: number of worker processes
+    Returns:
+      A generator of (agent_id, GenerativeAgent) tuples
+    """
+    if agent_ids is None:
+      agent_ids = self.ids()
+    num_workers = num_workers if num_workers else self.num_workers
+    if not batch_size:
+      batch_size = num_workers * 4
+
+    executor = None
+    if num_workers > 1:
+      executor = self._make_executor(num_workers)
+    try:
+      batches = chunk_list(agent_ids, batch_size)
+      pending = None
+      for count, batch in enumerate(batches):
+        start = time.time()
+        states = list(pending if pending is not None
+                      else self._load_states(executor, batch))
+        # The next batch is submitted to the pool before this one is handed
+        # to the caller, so the workers parse it in the meantime (the load
+        # time recorded is the time the caller waited).
+        pending = None
+        if executor and count + 1 < len(batches):
+          pending = self._load_states(executor, batches[count + 1])
+        self._record_load(len(batch),
+                          sum(state["num_bytes"] for state in states),
+                          time.time() - start)
+        for agent_id, state in zip(batch, states):
+          self.scratches[agent_id] = state["scratch"]
+          if agent_id in self.agents:
+            yield agent_id, self.agents[agent_id]
+          else:
+            yield agent_id, _agent_from_state(state)
+    finally:
+      if executor:
+        executor.shutdown()
+
+
+  def get_scratch(self, agent_id):
+    """
+    Returns the scratch of an agent without loading its memory stream (the
+    snapshot's scratch, or its latest update in the journal).
+
+    Parameters:
+      agent_id: the agent id
+    Returns:
+      the scratch dictionary
+    """
+    if agent_id not in self.scratches:
+      self.scratches[agent_id] = read_scratch(self.agent_folders[agent_id])
+    return self.scratches[agent_id]
+
+
+  def filter(self, criteria):
+    """
+    Filters the population on scratch fields. Only the scratches are read
+    (see get_scratch) for agents that are not loaded yet.
+
+    Parameters:
+      criteria: a dictionary whose keys are scratch fields and whose values
+        are either a list of allowed values, a single allowed value, or a
+        callable that takes the field value and returns a bool.
+    Returns:
+      A new Population holding the matching agents (loaded agents are
+      shared with this population).
+    Example:
+      >>> population.filter({"sex": ["Female"],
+                             "age": lambda x: int(x) >= 30})
+    """
+    agent_folders = {agent_id: agent_folder
+                     for agent_id, agent_folder in self.agent_folders.items()
+                     if _matches_criteria(self.get_scratch(agent_id), criteria)}
+    subset = Population(self.population, self.population_dir,
+                        self.num_workers, agent_folders)
+    subset.agents = {agent_id: self.agents[agent_id]
+                     for agent_id in subset.agent_folders
+                     if agent_id in self.agents}
+    subset.scratches = {agent_id: self.scratches[agent_id]
+                        for agent_id in subset.agent_folders}
+    return subset
@@ -0,0 +1,267 @@
+import time
+import weakref
+import threading
+
+import numpy as np
+
+from simulation_engine.gpt_structure import get_text_embedding
+from genagents.modules.interaction import agent_desc_from_nodes
+
+
+# ##############################################################################
+# ###                   POPULATION EMBEDDING INDEX HELPERS                   ###
+# ##############################################################################
+
+def segment_normalize(values, seg_starts, seg_lens):
+  """
+  Min-max normalizes <values> to [0, 1] separately inside every segment. This
+  is the vectorized equivalent of calling normalize_dict_floats on each
+  agent's scores; a segment whose values are all equal is set to 0.5, just
+  like normalize_dict_floats does.
+
+  Parameters:
+    values: 1-D float array holding all segments back to back
+    seg_starts: start offset of every segment (segments are non-empty)
+    seg_lens: length of every segment
+  Returns:
+    1-D float array of the normalized values
+  """
+  seg_min = np.repeat(np.minimum.reduceat(values, seg_starts), seg_lens)
+  seg_max = np.repeat(np.maximum.reduceat(values, seg_starts), seg_lens)
+  seg_range = seg_max - seg_min
+  flat = seg_range == 0
+  out = np.empty_like(values)
+  out[~flat] = (values[~flat] - seg_min[~flat]) / seg_range[~flat]
+  out[flat] = 0.5
+  return out
+
+
+def top_rows(scores, n_count):
+  """
+  The positions of the <n_count> highest scores, found by partial selection
+  rather than a full sort. Ties at the cut-off go to the earlier positions,
+  as with the stable sort of top_highest_x_values.
+
+  Parameters:
+    scores: 1-D float array of one agent's scores
+    n_count: the number of positions to keep
+  Returns:
+    1-D int array of positions (in no particular order)
+  """
+  if len(scores) <= n_count:
+    return np.arange(len(scores))
+  if n_count <= 0:
+    return np.zeros(0, dtype=np.int64)
+  threshold = -np.partition(-scores, n_count - 1)[n_count - 1]
+  above = np.flatnonzero(scores > threshold)
+  ties = np.flatnonzero(scores == threshold)[:n_count - len(above)]
+  return np.concatenate([above, ties])
+
+
+class AgentSegment:
+  def __init__(self, nodes, rows, importance, last_retrieved):
+    # One agent's rows of the index: its nodes, their normalized embeddings
+    # and their normalized recency and importance. Every value is normalized
+    # within the agent, so a segment does not depend on the other agents and
+    # can be reused by every index the agent is part of.
+    self.nodes = nodes
+    if not nodes:
+      self.matrix = np.zeros((0, 0), dtype=np.float32)
+      self.recency_out = np.zeros(0)
+      self.importance_out = np.zeros(0)
+      return
+
+    matrix = np.asarray(rows, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    self.matrix = matrix / norms
+
+    seg_starts = np.zeros(1, dtype=np.int64)
+    seg_lens = np.array([len(nodes)], dtype=np.int64)
+    last_retrieved = np.asarray(last_retrieved, dtype=np.float64)
+    recency = 0.99 ** (last_retrieved.max() - last_retrieved)
+    self.recency_out = segment_normalize(recency, seg_starts, seg_lens)
+    self.importance_out = segment_normalize(
+      np.asarray(importance, dtype=np.float64), seg_starts, seg_lens)
+
+
+# The segments of the memory streams that were indexed, by node type filter,
+# with the stream version they were built at. A stream that has not changed
+# since (no node was added, modified or compacted away) reuses its segment,
+# so indexing the same agents again (e.g., in the next survey wave) skips
+# the per-agent work. Entries go away with their memory streams.
+_segment_cache = weakref.WeakKeyDictionary()
+_segment_cache_lock = threading.Lock()
+
+
+def agent_segment(memory_stream, curr_filter="all"):
+  """
+  The index segment of one memory stream, reused from an earlier index when
+  the stream has not changed since.
+
+  Parameters:
+    memory_stream: the agent's MemoryStream
+    curr_filter: node type to index; 'all', 'reflection' or 'observation'
+  Returns:
+    (AgentSegment, whether it was reused)
+  """
+  memory_stream.flush_embeddings()
+  with memory_stream._nodes_lock:
+    version = memory_stream.version
+    with _segment_cache_lock:
+      cached = _segment_cache.get(memory_stream, dict()).get(curr_filter)
+    if cached is not None and cached[0] == version:
+      return cached[1], True
+
+    # The nodes and their embeddings are snapshotted under <_nodes_lock>, as
+    # in MemoryStream.retrieve; nodes that are not embedded yet are left out.
+    nodes = []
+    rows = []
+    for node in memory_stream.seq_nodes:
+      if curr_filter != "all" and node.node_type != curr_filter:
+        continue
+      if node.content not in memory_stream.embeddings:
+        continue
+      nodes += [node]
+      rows += [memory_stream.embeddings[node.content]]
+    importance = [node.importance for node in nodes]
+    last_retrieved = [node.last_retrieved for node in nodes]
+    complete = len(memory_stream.pending_embeddings) == 0
+
+  segment = AgentSegment(nodes, rows, importance, last_retrieved)
+  # A segment that left out nodes still waiting for their embeddings is not
+  # kept, since the stream's version does not change when they are embedded.
+  if complete:
+    with _segment_cache_lock:
+      _segment_cache.setdefault(memory_stream, dict())[curr_filter] = (
+        version, segment)
+  return segment, False
+
+
+# ##############################################################################
+# ###                       POPULATION EMBEDDING INDEX                       ###
+# ##############################################################################
+
+class PopulationEmbeddingIndex:
+  def __init__(self, agents, curr_filter="all"):
+    """
+    Stacks the normalized node embeddings of every agent into one matrix so
+    that a query can be scored against the whole population with one matrix
+    product.
+
+    Parameters:
+      agents: a dictionary (or Population) whose keys are agent ids and whose
+        values are GenerativeAgents
+      curr_filter: node type to index; 'all', 'reflection' or 'observation'
+    """
+    start = time.time()
+    self.curr_filter = curr_filter
+    self.agent_ids = []
+    self.agents = dict()
+    self.nodes = dict()
+    self.segments_built = 0
+    self.segments_reused = 0
+
+    segments = []
+    for agent_id in list(agents.keys()):
+      agent = agents[agent_id]
+      self.agents[agent_id] = agent
+      segment, reused = agent_segment(agent.memory_stream, curr_filter)
+      self.segments_reused += int(reused)
+      self.segments_built += int(not reused)
+      self.nodes[agent_id] = segment.nodes
+      if not segment.nodes:
+        continue
+      self.agent_ids += [agent_id]
+      segments += [segment]
+
+    self.seg_lens = np.array([len(segment.nodes) for segment in segments],
+                             dtype=np.int64)
+    self.seg_starts = np.zeros(len(segments), dtype=np.int64)
+    if len(segments) > 1:
+      self.seg_starts[1:] = np.cumsum(self.seg_lens)[:-1]
+
+    if segments:
+      self.matrix = np.concatenate([segment.matrix for segment in segments])
+      self.recency_out = np.concatenate([segment.recency_out
+                                         for segment in segments])
+      self.importance_out = np.concatenate([segment.importance_out
+                                            for segment in segments])
+    else:
+      self.matrix = np.zeros((0, 0), dtype=np.float32)
+      self.recency_out = np.zeros(0)
+      self.importance_out = np.zeros(0)
+    self.build_seconds = time.time() - start
+
+
+  def score(self, focal_pt, hp=[0, 1, 0.5], focal_embedding=None):
+    """
+    Scores every indexed node of every agent against a focal point. The focal
+    point is embedded once and scored against the whole stacked matrix.
+
+    Parameters:
+      focal_pt: the query sentence
+      hp: Hyperparameter for [recency_w, relevance_w, importance_w]
+      focal_embedding: a precomputed embedding of the focal point
+    Returns:
+      1-D float array of the combined retrieval score of every row
+    """
+    if focal_embedding is None:
+      focal_embedding = get_text_embedding(focal_pt)
+    focal_embedding = np.asarray(focal_embedding, dtype=np.float32)
+    focal_embedding = focal_embedding / np.linalg.norm(focal_embedding)
+
+    relevance = (self.matrix @ focal_embedding).astype(np.float64)
+    relevance_out = segment_normalize(relevance, self.seg_starts,
+                                      self.seg_lens)
+    return (hp[0] * self.recency_out
+            + hp[1] * relevance_out
+            + hp[2] * self.importance_out)
+
+
+  def retrieve(self, focal_pt, n_count=120, hp=[0, 1, 0.5],
+               focal_embedding=None):
+    """
+    Retrieves the top <n_count> nodes of every agent for one focal point,
+    using the same scoring as MemoryStream.retrieve.
+
+    Parameters:
+      focal_pt: the query sentence
+      n_count: the number of nodes to retrieve per agent
+      hp: Hyperparameter for [recency_w, relevance_w, importance_w]
+      focal_embedding: a precomputed embedding of the focal point
+    Returns:
+      retrieved: A dictionary whose keys are agent ids and whose values are
+        the retrieved nodes sorted by creation time. Agents without indexed
+        nodes map to an empty list.
+    """
+    retrieved = {agent_id: [] for agent_id in self.agents}
+    if not self.agent_ids:
+      return retrieved
+
+    scores = self.score(focal_pt, hp, focal_embedding)
+    for count, agent_id in enumerate(self.agent_ids):
+      start = self.seg_starts[count]
+      rows = top_rows(scores[start:start + self.seg_lens[count]], n_count)
+      curr_nodes = self.nodes[agent_id]
+      master_nodes = [curr_nodes[i] for i in rows]
+      retrieved[agent_id] = sorted(master_nodes,
+                                   key=lambda node: node.created)
+    return retrieved
+
+
+  def agent_descs(self, anchor, n_count=120):
+    """
+    Builds the agent description used by the survey prompts for every agent
+    from a single vectorized retrieval pass.
+
+    Parameters:
+      anchor: the retrieval anchor (e.g., the questions of a survey wave)
+      n_count: the number of nodes to retrieve per agent
+    Returns:
+      A dictionary whose keys are agent ids and whose values are the agent
+      description strings.
+    """
+    retrieved = self.retrieve(anchor, n_count)
+    return {agent_id: agent_desc_from_nodes(self.agents[agent_id], nodes)
+            for agent_id, nodes in retrieved.items()}
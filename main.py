@@ -1,6 +1,7 @@
 import json
 from simulation_engine.global_methods import *
 from genagents.genagents import GenerativeAgent
+from simulation_engine.scheduler import llm_priority
 
 class Conversation:
   def __init__(self, agent_folder, interviewer_name="Interviewer"):
@@ -20,7 +21,8 @@ class Conversation:
       # Add the interviewer's utterance to the conversation history
       self.conversation_history.append([self.interviewer_name, user_input])
       # Get the agent's response
-      agent_response = self.agent.utterance(self.conversation_history)
+      with llm_priority("interactive"):
+        agent_response = self.agent.utterance(self.conversation_history)
       print(f"{self.agent.get_fullname()}: {agent_response}")
       # Add the agent's response to the conversation history
       self.conversation_history.append([self.agent.get_fullname(), agent_response])
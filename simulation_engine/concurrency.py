@@ -0,0 +1,203 @@
+import time
+import threading
+from collections import deque
+
+from simulation_engine.settings import *
+
+
+# ##############################################################################
+# ###                     ADAPTIVE CONCURRENCY LIMITER                       ###
+# ##############################################################################
+
+class LimiterSlot:
+  def __init__(self, limiter):
+    # Handed out by AdaptiveConcurrencyLimiter.slot(). The caller sets
+    # <outcome> to "rate_limited", "timeout" or "error" when the call failed,
+    # or to "cancelled" when the caller gave up on it.
+    self.limiter = limiter
+    self.outcome = "ok"
+    self.start = None
+
+
+  def __enter__(self):
+    self.limiter.acquire()
+    self.start = time.time()
+    return self
+
+
+  def __exit__(self, exc_type, exc, tb):
+    if exc_type is not None and self.outcome == "ok":
+      self.outcome = "error"
+    self.limiter.release(time.time() - self.start, self.outcome)
+    return False
+
+
+class AdaptiveConcurrencyLimiter:
+  def __init__(self, min_limit=LLM_MIN_CONCURRENCY,
+               max_limit=LLM_MAX_CONCURRENCY,
+               initial_limit=LLM_INITIAL_CONCURRENCY,
+               decrease_factor=0.5, latency_tolerance=2.0,
+               error_rate_threshold=0.2, window=100, cooldown=2.0,
+               verbose=LLM_CONCURRENCY_VERBOSE):
+    """
+    An AIMD (additive increase, multiplicative decrease) limit on the number
+    of in-flight LLM requests. Each healthy completion raises the limit by
+    1/limit (so roughly +1 per round of requests); a 429, a timeout, a rising
+    error rate or a p95 latency above <latency_tolerance> times the best p95
+    seen so far cuts it by <decrease_factor>. Decreases are at most one per
+    <cooldown> seconds, so a burst of 429s from one overload counts once.
+    """
+    self.min_limit = min_limit
+    self.max_limit = max_limit
+    self.limit = float(max(min_limit, min(initial_limit, max_limit)))
+    self.decrease_factor = decrease_factor
+    self.latency_tolerance = latency_tolerance
+    self.error_rate_threshold = error_rate_threshold
+    self.cooldown = cooldown
+    self.verbose = verbose
+
+    self.in_flight = 0
+    self.latencies = deque(maxlen=window)
+    self.outcomes = deque(maxlen=window)
+    self.baseline_p95 = None
+    self._samples_since_check = 0
+    self._last_decrease = 0.0
+
+    self.decisions = deque(maxlen=500)
+    self.counts = {"ok": 0, "rate_limited": 0, "timeout": 0, "error": 0,
+                   "cancelled": 0}
+    self._cond = threading.Condition()
+
+
+  def slot(self):
+    return LimiterSlot(self)
+
+
+  def acquire(self):
+    with self._cond:
+      while self.in_flight >= int(self.limit):
+        self._cond.wait()
+      self.in_flight += 1
+
+
+  def try_acquire(self):
+    with self._cond:
+      if self.in_flight >= int(self.limit):
+        return False
+      self.in_flight += 1
+      return True
+
+
+  def release(self, latency, outcome="ok"):
+    """
+    Releases a slot and adapts the limit to the outcome of the call.
+
+    Parameters:
+      latency: seconds the call took
+      outcome: "ok", "rate_limited", "timeout", "error" or "cancelled"
+    Returns:
+      None
+    """
+    with self._cond:
+      self.in_flight -= 1
+      self.counts[outcome] = self.counts.get(outcome, 0) + 1
+      # A call the caller cancelled says nothing about the provider's health,
+      # so it neither raises nor lowers the limit.
+      if outcome == "cancelled":
+        self._cond.notify_all()
+        return
+      self.outcomes.append(outcome != "ok")
+
+      if outcome in ["rate_limited", "timeout"]:
+        self._decrease(outcome)
+      elif outcome == "error":
+        error_rate = sum(self.outcomes) / len(self.outcomes)
+        if (len(self.outcomes) >= 10
+            and error_rate > self.error_rate_threshold):
+          self._decrease(f"error rate {error_rate:.0%}")
+      else:
+        self.latencies.append(latency)
+        if not self._check_latency():
+          self._increase()
+      self._cond.notify_all()
+
+
+  def _p95(self):
+    latencies = sorted(self.latencies)
+    return latencies[int(0.95 * (len(latencies) - 1))]
+
+
+  def _check_latency(self):
+    # The p95 is recomputed every 20 healthy samples. Returns True when the
+    # limit was cut because of latency.
+    self._samples_since_check += 1
+    if self._samples_since_check < 20 or len(self.latencies) < 20:
+      return False
+    self._samples_since_check = 0
+
+    p95 = self._p95()
+    if self.baseline_p95 is None or p95 < self.baseline_p95:
+      self.baseline_p95 = p95
+      return False
+    if p95 > self.latency_tolerance * self.baseline_p95:
+      return self._decrease(f"p95 {p95:.2f}s > "
+                            f"{self.latency_tolerance} x {self.baseline_p95:.2f}s")
+    return False
+
+
+  def _increase(self):
+    old_limit = self.limit
+    self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+    if int(self.limit) != int(old_limit):
+      self._log("increase", old_limit, "healthy")
+
+
+  def _decrease(self, reason):
+    now = time.time()
+    if now - self._last_decrease < self.cooldown:
+      return False
+    self._last_decrease = now
+    old_limit = self.limit
+    self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+    # The latency baseline is relearned at the new level of concurrency.
+    self.latencies.clear()
+    self.baseline_p95 = None
+    self._log("decrease", old_limit, reason)
+    return True
+
+
+  def _log(self, decision, old_limit, reason):
+    entry = {"time": time.time(), "decision": decision,
+             "from": int(old_limit), "to": int(self.limit), "reason": reason,
+             "in_flight": self.in_flight}
+    self.decisions.append(entry)
+    if self.verbose or DEBUG:
+      print (f"[llm concurrency] {decision} {entry['from']} -> "
+             f"{entry['to']} ({reason})")
+
+
+  def share(self, num_shares):
+    """
+    Scales the limits down to one of <num_shares> equal shares (e.g., in one
+    of several worker processes, which each have their own limiter), so the
+    shares together stay within this limiter's budget.
+    """
+    with self._cond:
+      self.max_limit = max(1, self.max_limit // num_shares)
+      self.min_limit = max(1, min(self.min_limit // num_shares, self.max_limit))
+      self.limit = max(self.min_limit, min(self.limit / num_shares,
+                                           self.max_limit))
+      self._cond.notify_all()
+
+
+  def stats(self):
+    with self._cond:
+      return {"limit": int(self.limit),
+              "in_flight": self.in_flight,
+              "p95": self._p95() if self.latencies else None,
+              "counts": dict(self.counts),
+              "decisions": len(self.decisions)}
+
+
+# The limiter shared by every LLM and embedding request in the process.
+llm_limiter = AdaptiveConcurrencyLimiter()
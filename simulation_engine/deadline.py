@@ -0,0 +1,119 @@
+import time
+import threading
+import contextlib
+import contextvars
+
+
+class DeadlineExceeded(TimeoutError):
+  pass
+
+
+# Counts of the calls that were stopped by a deadline, by reason. Every stop
+# goes through Deadline.check(), so timeouts are recorded the same way
+# whichever layer (queue, coalesced wait, HTTP call) noticed them.
+deadline_metrics = {"timeouts": 0, "cancellations": 0}
+_metrics_lock = threading.Lock()
+
+
+class Deadline:
+  def __init__(self, seconds=None, expires_at=None, parent=None):
+    """
+    A point in time by which a unit of work (an LLM call, an API request or
+    an environment run) must finish, plus a cancellation flag. A deadline
+    created inside another one never outlives its parent, and cancelling the
+    parent cancels it too.
+
+    Parameters:
+      seconds: seconds from now, or None for no time limit of its own
+      expires_at: absolute time.time() at which the deadline expires
+      parent: the enclosing Deadline, if any
+    """
+    candidates = []
+    if seconds is not None:
+      candidates += [time.time() + seconds]
+    if expires_at is not None:
+      candidates += [expires_at]
+    if parent is not None and parent.expires_at is not None:
+      candidates += [parent.expires_at]
+    self.expires_at = min(candidates) if candidates else None
+    self.parent = parent
+    self._cancelled = threading.Event()
+
+
+  def cancel(self):
+    self._cancelled.set()
+
+
+  def cancelled(self):
+    if self._cancelled.is_set():
+      return True
+    return self.parent.cancelled() if self.parent else False
+
+
+  def remaining(self):
+    if self.expires_at is None:
+      return None
+    return max(0.0, self.expires_at - time.time())
+
+
+  def expired(self):
+    return self.cancelled() or self.remaining() == 0.0
+
+
+  def check(self):
+    """
+    Raises DeadlineExceeded (and records it in deadline_metrics) when the
+    deadline has passed or was cancelled.
+    """
+    if self.cancelled():
+      with _metrics_lock:
+        deadline_metrics["cancellations"] += 1
+      raise DeadlineExceeded("request was cancelled")
+    if self.remaining() == 0.0:
+      with _metrics_lock:
+        deadline_metrics["timeouts"] += 1
+      raise DeadlineExceeded("deadline exceeded")
+
+
+_current_deadline = contextvars.ContextVar("llm_deadline", default=None)
+
+
+def current_deadline():
+  return _current_deadline.get()
+
+
+@contextlib.contextmanager
+def deadline(seconds=None, expires_at=None, curr_deadline=None):
+  """
+  Runs the enclosed work under a deadline. Either give the seconds (or the
+  absolute expiry) of a new deadline nested in the current one, or pass an
+  existing Deadline object (e.g., one that another task can cancel).
+
+  Example:
+    >>> with deadline(30):
+    ...   agent.utterance(dialogue)
+  """
+  if curr_deadline is None:
+    curr_deadline = Deadline(seconds, expires_at, current_deadline())
+  token = _current_deadline.set(curr_deadline)
+  try:
+    yield curr_deadline
+  finally:
+    _current_deadline.reset(token)
+
+
+def check_deadline():
+  curr_deadline = current_deadline()
+  if curr_deadline is not None:
+    curr_deadline.check()
+
+
+def request_timeout(default):
+  """
+  The HTTP timeout for the next request: the per-call default, shortened to
+  what is left of the current deadline.
+  """
+  curr_deadline = current_deadline()
+  if curr_deadline is None or curr_deadline.remaining() is None:
+    return default
+  return max(0.001, min(default, curr_deadline.remaining()))
@@ -8,8 +8,79 @@ DEBUG = False
 
 MAX_CHUNK_SIZE = 4
 
+JOURNAL_FSYNC_EVERY = 64
+JOURNAL_COMPACT_EVERY = 2000
+
+AGENT_POOL_MAX_AGENTS = 2000
+AGENT_POOL_MAX_NODES = 2000000
+
+CHECKPOINT_FSYNC_EVERY = 32
+
+LLM_MIN_CONCURRENCY = 4
+LLM_MAX_CONCURRENCY = 64
+LLM_INITIAL_CONCURRENCY = 16
+LLM_CONCURRENCY_VERBOSE = False
+
+LLM_PRIORITY_WEIGHTS = {"interactive": 8, "batch": 1}
+LLM_STARVATION_SECONDS = 10.0
+
+LLM_REQUEST_TIMEOUT = 60
+CHAT_DEADLINE_SECONDS = 30
+
+EMBEDDING_LAZY = True
+EMBEDDING_FLUSH_SIZE = 64
+EMBEDDING_FLUSH_SECONDS = 30.0
+EMBEDDING_BATCH_SIZE = 256
+EMBEDDING_BACKGROUND_FLUSH = False
+
+IMPORTANCE_DEFERRED = False
+IMPORTANCE_BATCH_SIZE = 32
+IMPORTANCE_FLUSH_SECONDS = 2.0
+IMPORTANCE_MAX_ATTEMPTS = 3
+IMPORTANCE_NOVELTY_WINDOW = 200
+IMPORTANCE_HEURISTIC_WORDS = 60
+IMPORTANCE_HEURISTIC_LENGTH_W = 0.4
+
+REFLECTION_AUTO = False
+REFLECTION_THRESHOLD = 150
+REFLECTION_COUNT = 5
+REFLECTION_BATCH_SIZE = 8
+REFLECTION_ANCHOR_NODES = 10
+
+COMPACTION_SIMILARITY = 0.95
+COMPACTION_EVERY = 0
+
+SURVEY_REPAIR_ROUNDS = 1
+
+SAMPLING_BATCH_SIZE = 100
+SAMPLING_TARGET_MARGIN = 0.03
+SAMPLING_CONFIDENCE = 0.95
+SAMPLING_MIN_SAMPLE = 200
+
+ANSWER_STORE_ENABLED = False
+ANSWER_STORE_PATH = None
+ANSWER_STORE_MAX_ENTRIES = 200000
+ANSWER_STORE_INVALIDATION = "memory"
+
 LLM_VERS = "gpt-4o-mini"
 
+# Model, max_tokens and temperature per LLM task. A task with a "cascade" 
+# (a list of models, cheapest first) escalates to the next model when a 
+# response fails validation. Tasks that are not listed use LLM_VERS.
+LLM_TASK_ROUTES = {
+  "importance": {"model": LLM_VERS, "max_tokens": 1500, "temperature": 0.7},
+  "reflection": {"model": LLM_VERS, "max_tokens": 1500, "temperature": 0.7},
+  "categorical": {"model": LLM_VERS, "max_tokens": 1500, "temperature": 0.7},
+  "numerical": {"model": LLM_VERS, "max_tokens": 1500, "temperature": 0.7},
+  "utterance": {"model": LLM_VERS, "max_tokens": 1500, "temperature": 0.7},
+  "ask": {"model": LLM_VERS, "max_tokens": 1500, "temperature": 0.7},
+}
+# e.g., "categorical": {"model": "gpt-4o-mini", "max_tokens": 1500,
+#                       "temperature": 0.7, "cascade": ["gpt-4o-mini", "gpt-4o"]}
+
+# USD per million input and output tokens, for the per-task cost report.
+LLM_MODEL_PRICES = {"gpt-4o-mini": (0.15, 0.60), "gpt-4o": (2.50, 10.00)}
+
 BASE_DIR = f"{Path(__file__).resolve().parent.parent}"
 
 ## To do: Are the following needed in the new structure? Ideally Populations_Dir is for the user to define.
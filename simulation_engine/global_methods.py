@@ -192,8 +192,11 @@ def average(list_of_val):
     The average of the values
   """
   try: 
-    list_of_val = [float(i) for i in list_of_val if not math.isnan(i)]
-    return sum(list_of_val)/float(len(list_of_val))
+    values = numpy.asarray(list_of_val, dtype=float)
+    values = values[~numpy.isnan(values)]
+    if len(values) == 0: 
+      return float('nan')
+    return float(values.mean())
   except: 
     return float('nan')
 
@@ -207,9 +210,11 @@ def std(list_of_val):
     The std of the values
   """
   try: 
-    list_of_val = [float(i) for i in list_of_val if not math.isnan(i)]
-    std = numpy.std(list_of_val)
-    return std
+    values = numpy.asarray(list_of_val, dtype=float)
+    values = values[~numpy.isnan(values)]
+    if len(values) == 0: 
+      return float('nan')
+    return float(values.std())
   except: 
     return float('nan')
 
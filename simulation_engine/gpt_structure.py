@@ -4,6 +4,14 @@ import base64
 from typing import List, Union
 
 from simulation_engine.settings import *
+from simulation_engine.scheduler import llm_scheduler
+from simulation_engine.single_flight import llm_single_flight
+from simulation_engine.llm_json_parser import (ResponseFormatError, 
+                                               decode_json_response)
+from simulation_engine.deadline import (DeadlineExceeded, current_deadline,
+                                        check_deadline, request_timeout)
+from simulation_engine.llm_router import (task_route, route_steps, 
+                                          current_escalation, route_metrics)
 
 openai.api_key = OPENAI_API_KEY
 
@@ -50,33 +58,80 @@ def generate_prompt(prompt_input: Union[str, List[str]],
 # ####################### [SECTION 2: SAFE GENERATE] #########################
 # ============================================================================
 
+def _classify_error(e: Exception) -> str:
+  """Map an API exception to the outcome reported to the limiter."""
+  if isinstance(e, openai.RateLimitError):
+    return "rate_limited"
+  if isinstance(e, openai.APITimeoutError):
+    return "timeout"
+  if getattr(e, "status_code", None) == 429:
+    return "rate_limited"
+  return "error"
+
+
+def _record_usage(usage: dict, response_usage) -> None:
+  if usage is not None and response_usage is not None:
+    usage["prompt_tokens"] = response_usage.prompt_tokens
+    usage["completion_tokens"] = response_usage.completion_tokens
+
+
+def _stream_completion(client, timeout, usage=None, **kwargs) -> str:
+  """Stream a chat completion, dropping the connection as soon as the current
+     deadline expires or is cancelled."""
+  curr_deadline = current_deadline()
+  stream = client.chat.completions.create(
+    stream=True, stream_options={"include_usage": True}, timeout=timeout, 
+    **kwargs)
+  parts = []
+  try:
+    for chunk in stream:
+      curr_deadline.check()
+      if chunk.choices and chunk.choices[0].delta.content:
+        parts += [chunk.choices[0].delta.content]
+      # The last chunk carries the token usage and no choices.
+      _record_usage(usage, getattr(chunk, "usage", None))
+  finally:
+    stream.close()
+  return "".join(parts)
+
+
 def gpt_request(prompt: str, 
                 model: str = "gpt-4o", 
-                max_tokens: int = 1500) -> str:
-  """Make a request to OpenAI's GPT model."""
-  if model == "o1-preview": 
+                max_tokens: int = 1500,
+                json_mode: bool = False,
+                temperature: float = 0.7,
+                usage: dict = None) -> str:
+  """Make a request to OpenAI's GPT model. With json_mode, the model is 
+     constrained to return a single JSON object. If a usage dictionary is 
+     given, the request's prompt_tokens and completion_tokens are put in it."""
+  kwargs = {"model": model, 
+            "messages": [{"role": "user", "content": prompt}]}
+  if model != "o1-preview": 
+    kwargs.update(max_tokens=max_tokens, temperature=temperature)
+    if json_mode: 
+      kwargs["response_format"] = {"type": "json_object"}
+
+  check_deadline()
+  with llm_scheduler.slot() as slot:
     try:
-      client = openai.OpenAI(api_key=OPENAI_API_KEY)
-      response = client.chat.completions.create(
-        model=model,
-        messages=[{"role": "user", "content": prompt}]
-      )
-      return response.choices[0].message.content
+      timeout = request_timeout(LLM_REQUEST_TIMEOUT)
+      if current_deadline() is None: 
+        client = openai.OpenAI(api_key=OPENAI_API_KEY)
+        response = client.chat.completions.create(timeout=timeout, **kwargs)
+        _record_usage(usage, response.usage)
+        return response.choices[0].message.content
+      # Under a deadline, the SDK's own retries would outlive it.
+      client = openai.OpenAI(api_key=OPENAI_API_KEY, max_retries=0)
+      return _stream_completion(client, timeout, usage, **kwargs)
+    except DeadlineExceeded:
+      slot.outcome = "cancelled" if current_deadline().cancelled() else "timeout"
+      raise
     except Exception as e:
+      slot.outcome = _classify_error(e)
+      # The HTTP timeout was cut to the time left on the deadline.
+      check_deadline()
       return f"GENERATION ERROR: {str(e)}"
 
-  try:
-    client = openai.OpenAI(api_key=OPENAI_API_KEY)
-    response = client.chat.completions.create(
-      model=model,
-      messages=[{"role": "user", "content": prompt}],
-      max_tokens=max_tokens,
-      temperature=0.7
-    )
-    return response.choices[0].message.content
-  except Exception as e:
-    return f"GENERATION ERROR: {str(e)}"
-
 
 def gpt4_vision(messages: List[dict], max_tokens: int = 1500) -> str:
   """Make a request to OpenAI's GPT-4 Vision model."""
@@ -93,17 +148,81 @@ def gpt4_vision(messages: List[dict], max_tokens: int = 1500) -> str:
     return f"GENERATION ERROR: {str(e)}"
 
 
+def _generate_validated(prompt: str, 
+                        step: dict, 
+                        repeat: int,
+                        response_schema: dict = None,
+                        task: str = None,
+                        verbose: bool = False):
+  """Request a response from one model (one step of a route) up to repeat 
+     times. Returns the response (decoded when a response_schema is given), 
+     or None when every attempt failed."""
+  json_mode = response_schema is not None
+  for i in range(repeat):
+    usage = dict()
+    led = []
+
+    def request(*args, **kwargs):
+      led.append(True)
+      return gpt_request(*args, **kwargs)
+
+    start = time.time()
+    # Identical prompts that are already in flight (e.g., the same anchor
+    # asked by many threads at once) share one request, whose latency and
+    # usage are recorded once, by the caller that made it.
+    response = llm_single_flight.do(
+      ("chat", step["model"], step["max_tokens"], step["temperature"], 
+       json_mode, prompt), 
+      request, prompt, model=step["model"], 
+      max_tokens=step["max_tokens"], json_mode=json_mode, 
+      temperature=step["temperature"], usage=usage)
+    seconds = time.time() - start
+
+    def record(ok=True):
+      if led:
+        route_metrics.record(task, step["model"], seconds, usage, ok=ok)
+
+    if response.startswith("GENERATION ERROR"):
+      record(ok=False)
+      if i < repeat - 1:
+        time.sleep(2**i)
+      continue
+    if not json_mode:
+      record()
+      return response
+    try:
+      response = decode_json_response(response, response_schema)
+      record()
+      return response
+    except ResponseFormatError as e:
+      record(ok=False)
+      if verbose or DEBUG:
+        print (f"Invalid response from {step['model']} ({e}); "
+               f"attempt {i + 1} of {repeat}")
+  return None
+
+
 def chat_safe_generate(prompt_input: Union[str, List[str]], 
                        prompt_lib_file: str,
-                       gpt_version: str = "gpt-4o", 
+                       gpt_version: str = None, 
                        repeat: int = 1,
                        fail_safe: str = "error", 
                        func_clean_up: callable = None,
                        verbose: bool = False,
-                       max_tokens: int = 1500,
+                       max_tokens: int = None,
                        file_attachment: str = None,
-                       file_type: str = None) -> tuple:
-  """Generate a response using GPT models with error handling & retries."""
+                       file_type: str = None,
+                       response_schema: dict = None,
+                       task: str = None) -> tuple:
+  """Generate a response using GPT models with error handling & retries.
+     With a response_schema (see llm_json_parser.RESPONSE_SCHEMAS), the 
+     request is made in JSON mode and func_clean_up receives the decoded, 
+     validated object; a response that does not match is retried. 
+     The model, max_tokens and temperature come from the task's route in 
+     LLM_TASK_ROUTES (an explicit gpt_version or max_tokens overrides it). 
+     With a cascade, a response that still fails after repeat attempts is 
+     requested again from the next model."""
+  steps = route_steps(task_route(task, gpt_version, max_tokens))
   if file_attachment and file_type:
     prompt = generate_prompt(prompt_input, prompt_lib_file)
     messages = [{"role": "user", "content": prompt}]
@@ -119,7 +238,7 @@ def chat_safe_generate(prompt_input: Union[str, List[str]],
               {"url": f"data:image/jpeg;base64,{base64_image}"}}
         ]
       })
-      response = gpt4_vision(messages, max_tokens)
+      response = gpt4_vision(messages, steps[0]["max_tokens"])
 
     elif file_type.lower() == 'pdf':
       pdf_text = extract_text_from_pdf_file(file_attachment)
@@ -127,17 +246,25 @@ def chat_safe_generate(prompt_input: Union[str, List[str]],
       instruction = generate_prompt(prompt_input, prompt_lib_file)
       prompt = f"{pdf}"
       prompt += f"<End of the PDF attachment>\n=\nTask description:\n{instruction}"
-      response = gpt_request(prompt, gpt_version, max_tokens)
+      response = gpt_request(prompt, steps[0]["model"], 
+                             steps[0]["max_tokens"], 
+                             temperature=steps[0]["temperature"])
 
   else:
     prompt = generate_prompt(prompt_input, prompt_lib_file)
-    for i in range(repeat):
-      response = gpt_request(prompt, model=gpt_version)
-      if response != "GENERATION ERROR":
+    # Re-asks of invalid answers start further up the cascade.
+    steps = steps[min(current_escalation(), len(steps) - 1):]
+    for count, step in enumerate(steps):
+      response = _generate_validated(prompt, step, repeat, response_schema, 
+                                     task, verbose)
+      if response is not None:
         break
-      time.sleep(2**i)
+      if count + 1 < len(steps):
+        route_metrics.escalation(task, step["model"])
     else:
+      # The fail-safe is returned as is, without the clean-up.
       response = fail_safe
+      func_clean_up = None
 
   if func_clean_up:
     response = func_clean_up(response, prompt=prompt)
@@ -159,15 +286,38 @@ def get_text_embedding(text: str,
     raise ValueError("Input text must be a non-empty string.")
 
   text = text.replace("\n", " ").strip()
-  response = openai.embeddings.create(
-    input=[text], model=model).data[0].embedding
-  return response
-
-
-
-
-
-
-
-
-
+  return llm_single_flight.do(("embedding", model, text), 
+                              _embedding_request, text, model)
+
+
+def get_text_embeddings(texts: List[str], 
+                        model: str = "text-embedding-3-small",
+                        batch_size: int = EMBEDDING_BATCH_SIZE
+                        ) -> List[List[float]]:
+  """Generate the embeddings of several texts, with one request per 
+     batch_size texts instead of one per text."""
+  for text in texts:
+    if not isinstance(text, str) or not text.strip():
+      raise ValueError("Input text must be a non-empty string.")
+
+  texts = [text.replace("\n", " ").strip() for text in texts]
+  embeddings = []
+  for start in range(0, len(texts), batch_size):
+    embeddings += _embedding_request(texts[start:start + batch_size], model)
+  return embeddings
+
+
+def _embedding_request(texts: Union[str, List[str]], 
+                       model: str) -> Union[List[float], List[List[float]]]:
+  """Embed one text, or a list of texts in one request."""
+  check_deadline()
+  with llm_scheduler.slot() as slot:
+    try:
+      data = openai.embeddings.create(
+        input=texts if isinstance(texts, list) else [texts], model=model, 
+        timeout=request_timeout(LLM_REQUEST_TIMEOUT)).data
+    except Exception as e:
+      slot.outcome = _classify_error(e)
+      raise
+  embeddings = [item.embedding for item in sorted(data, key=lambda i: i.index)]
+  return embeddings if isinstance(texts, list) else embeddings[0]
@@ -1,57 +1,206 @@
 import json
-import re
+import threading
 
 
-def extract_first_json_dict(input_str):
+class ResponseFormatError(ValueError):
+  pass
+
+
+# ##############################################################################
+# ###                           RESPONSE SCHEMAS                             ###
+# ##############################################################################
+
+# The response each prompt family must return, in a small subset of JSON
+# Schema (type, properties, required, items, additionalProperties,
+# minProperties). The requests for these families are made in the provider's
+# JSON mode, and every response is checked against its schema before it is
+# cleaned up, so a malformed generation fails loudly (and can be retried)
+# instead of turning into None or a short list.
+
+# "Response" is not required per question: a batch response with a missing
+# or out-of-range answer is still decoded, and only that question is re-asked
+# (see interaction.repair_answers).
+_reasoned_answer = lambda response_schema: {
+  "type": "object",
+  "properties": {"Reasoning": {"type": "string"},
+                 "Response": response_schema}}
+
+RESPONSE_SCHEMAS = {
+  "importance": {
+    "type": "object",
+    "minProperties": 1,
+    "additionalProperties": {"type": "number"}},
+  "reflection": {
+    "type": "object",
+    "required": ["reflection"],
+    "properties": {"reflection": {"type": "array",
+                                  "items": {"type": "string"}}}},
+  "categorical": {
+    "type": "object",
+    "minProperties": 1,
+    "additionalProperties": _reasoned_answer(
+      {"type": ["string", "number"]})},
+  "numerical": {
+    "type": "object",
+    "minProperties": 1,
+    "additionalProperties": _reasoned_answer(
+      {"type": ["number", "string"]})},
+  "utterance": {
+    "type": "object",
+    "required": ["utterance"],
+    "properties": {"utterance": {"type": "string"}}},
+  "ask": {
+    "type": "object",
+    "minProperties": 1,
+    "additionalProperties": _reasoned_answer(
+      {"type": ["string", "number"]})},
+}
+
+
+_JSON_TYPES = {"object": dict, "array": list, "string": str,
+               "boolean": bool, "null": type(None)}
+
+
+def _is_type(value, type_name):
+  if type_name in ["number", "integer"]:
+    # bool is a subclass of int, but true/false is not a number.
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+      return False
+    return type_name == "number" or float(value).is_integer()
+  return isinstance(value, _JSON_TYPES[type_name])
+
+
+def validate_schema(value, schema, path="$"):
+  """
+  Checks a decoded response against a schema from RESPONSE_SCHEMAS.
+
+  Parameters:
+    value: the decoded JSON value
+    schema: the schema dictionary
+    path: the location of <value> in the response, for the error message
+  Returns:
+    None (raises ResponseFormatError on the first mismatch)
+  """
+  types = schema.get("type")
+  if types is not None:
+    types = [types] if isinstance(types, str) else types
+    if not any(_is_type(value, i) for i in types):
+      raise ResponseFormatError(f"{path}: expected {' or '.join(types)}, "
+                                f"got {type(value).__name__}")
+
+  if isinstance(value, dict):
+    for key in schema.get("required", []):
+      if key not in value:
+        raise ResponseFormatError(f"{path}: missing '{key}'")
+    if len(value) < schema.get("minProperties", 0):
+      raise ResponseFormatError(f"{path}: expected at least "
+                                f"{schema['minProperties']} entries")
+    properties = schema.get("properties", dict())
+    extra = schema.get("additionalProperties")
+    for key, item in value.items():
+      if key in properties:
+        validate_schema(item, properties[key], f"{path}.{key}")
+      elif isinstance(extra, dict):
+        validate_schema(item, extra, f"{path}.{key}")
+
+  elif isinstance(value, list) and "items" in schema:
+    for count, item in enumerate(value):
+      validate_schema(item, schema["items"], f"{path}[{count}]")
+
+
+# ##############################################################################
+# ###                                DECODER                                 ###
+# ##############################################################################
+
+_decoder = json.JSONDecoder()
+_curly_quotes = str.maketrans({"“": "\"", "”": "\"", "‘": "'", "’": "'"})
+
+# Counts of the responses that went through decode_json_response.
+parse_metrics = {"decoded": 0, "invalid": 0}
+_metrics_lock = threading.Lock()
+
+
+def _raw_decode_first(text):
+  # Decodes the first JSON object in the text with the C decoder, starting
+  # from each "{" in turn (prose before the object may contain braces too).
+  start = text.find("{")
+  while start != -1:
+    try:
+      return _decoder.raw_decode(text, start)[0]
+    except json.JSONDecodeError:
+      start = text.find("{", start + 1)
+  raise ResponseFormatError("no JSON object in the response")
+
+
+def decode_json_response(text, schema=None):
+  """
+  Decodes the first JSON object in an LLM response and validates it.
+
+  Parameters:
+    text: the raw response (in JSON mode this is the object itself, but
+      responses wrapped in prose or code fences are accepted too)
+    schema: optional schema from RESPONSE_SCHEMAS
+  Returns:
+    the decoded object (raises ResponseFormatError when the response has no
+    valid JSON object or does not match the schema)
+  """
   try:
-    # Replace curly quotes with standard double quotes
-    input_str = (input_str.replace("“", "\"")
-                          .replace("”", "\"")
-                          .replace("‘", "'")
-                          .replace("’", "'"))
-    
-    # Find the first occurrence of '{' in the input_str
-    start_index = input_str.index('{')
-    
-    # Initialize a count to keep track of open and close braces
-    count = 1
-    end_index = start_index + 1
-    
-    # Loop to find the closing '}' for the first JSON dictionary
-    while count > 0 and end_index < len(input_str):
-        if input_str[end_index] == '{':
-            count += 1
-        elif input_str[end_index] == '}':
-            count -= 1
-        end_index += 1
-    
-    # Extract the JSON substring
-    json_str = input_str[start_index:end_index]
-    
-    # Parse the JSON string into a Python dictionary
-    json_dict = json.loads(json_str)
-    
-    return json_dict
-  except ValueError:
-    # Handle the case where the JSON parsing fails
-    return None
+    try:
+      value = _raw_decode_first(text)
+    except ResponseFormatError:
+      # Curly quotes are only replaced when the response does not decode
+      # as is, since they are legitimate inside JSON strings.
+      value = _raw_decode_first(text.translate(_curly_quotes))
+    if schema is not None:
+      validate_schema(value, schema)
+  except ResponseFormatError:
+    with _metrics_lock:
+      parse_metrics["invalid"] += 1
+    raise
+
+  with _metrics_lock:
+    parse_metrics["decoded"] += 1
+  return value
+
+
+def answers_from_response(value, field="Response", num_questions=None):
+  """
+  The per-question fields of a categorical, numerical or ask response
+  ({"1": {"Reasoning": ..., "Response": ...}, "2": ...}), in question order.
+  With <num_questions>, the list has exactly one entry per question: answers
+  are placed by their question number, and questions the response skipped
+  are None.
+  """
+  if num_questions is None:
+    return [item.get(field) for item in value.values()]
 
+  ret = [None] * num_questions
+  for count, (key, item) in enumerate(value.items()):
+    index = int(key) - 1 if str(key).strip().isdigit() else count
+    if 0 <= index < num_questions and isinstance(item, dict):
+      ret[index] = item.get(field)
+  return ret
 
-def extract_first_json_dict_categorical(input_str): 
-  reasoning_pattern = r'"Reasoning":\s*"([^"]+)"'
-  response_pattern = r'"Response":\s*"([^"]+)"'
 
-  reasonings = re.findall(reasoning_pattern, input_str)
-  responses = re.findall(response_pattern, input_str)
+# ##############################################################################
+# ###                          FREE-TEXT EXTRACTION                          ###
+# ##############################################################################
 
-  return responses, reasonings
+def extract_first_json_dict(input_str):
+  try:
+    return decode_json_response(input_str)
+  except ResponseFormatError:
+    return None
 
 
-def extract_first_json_dict_numerical(input_str): 
-  reasoning_pattern = re.compile(r'"Reasoning":\s*"([^"]+)"')
-  response_pattern = re.compile(r'"Response":\s*(\d+\.?\d*)')
+def extract_first_json_dict_categorical(input_str):
+  value = extract_first_json_dict(input_str)
+  if not isinstance(value, dict):
+    return [], []
+  value = {key: item for key, item in value.items() if isinstance(item, dict)}
+  return (answers_from_response(value, "Response"),
+          answers_from_response(value, "Reasoning"))
 
-  reasonings = reasoning_pattern.findall(input_str)
-  responses = response_pattern.findall(input_str)
-  return responses, reasonings
 
+def extract_first_json_dict_numerical(input_str):
+  return extract_first_json_dict_categorical(input_str)
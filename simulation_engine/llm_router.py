@@ -0,0 +1,166 @@
+import threading
+import contextlib
+import contextvars
+
+from simulation_engine.settings import *
+
+
+# ##############################################################################
+# ###                                ROUTES                                  ###
+# ##############################################################################
+
+_DEFAULT_ROUTE = {"model": LLM_VERS, "max_tokens": 1500, "temperature": 0.7}
+
+
+def task_route(task, model=None, max_tokens=None):
+  """
+  The route of an LLM task from LLM_TASK_ROUTES: its model, max_tokens,
+  temperature and optional cascade. Tasks without a route use LLM_VERS.
+
+  Parameters:
+    task: "importance", "reflection", "categorical", "numerical",
+      "utterance", "ask" (or None)
+    model: an explicit model, which overrides the route (and its cascade)
+    max_tokens: an explicit max_tokens, which overrides the route
+  Returns:
+    the route dictionary
+  """
+  route = dict(_DEFAULT_ROUTE)
+  route.update(LLM_TASK_ROUTES.get(task, dict()))
+  if model:
+    route["model"] = model
+    route.pop("cascade", None)
+  if max_tokens:
+    route["max_tokens"] = max_tokens
+  return route
+
+
+def route_steps(route):
+  """
+  The (model, max_tokens, temperature) steps of a route, cheapest first. A
+  route without a cascade has one step; each cascade entry is a model name or
+  a dictionary that overrides the route's settings.
+  """
+  base = {key: route[key] for key in ["model", "max_tokens", "temperature"]}
+  cascade = route.get("cascade")
+  if not cascade:
+    return [base]
+  steps = []
+  for entry in cascade:
+    step = dict(base)
+    step.update({"model": entry} if isinstance(entry, str) else entry)
+    steps += [step]
+  return steps
+
+
+def route_signature(task):
+  """
+  The models a task's answers can come from, e.g., "gpt-4o-mini" or
+  "gpt-4o-mini>gpt-4o" for a cascade (used in the answer store's keys).
+  """
+  return ">".join(step["model"] for step in route_steps(task_route(task)))
+
+
+# The cascade step the LLM requests made in the current context start from.
+# Re-asks of answers that failed validation run escalated, so they go to the
+# next model of the task's cascade instead of the one that got them wrong.
+_current_escalation = contextvars.ContextVar("llm_escalation", default=0)
+
+
+@contextlib.contextmanager
+def escalated(level=1):
+  """
+  Runs the enclosed LLM calls starting from the given cascade step (routes
+  without a cascade are unaffected).
+
+  Example:
+    >>> with escalated(1):
+    ...   run_gpt_generate_categorical_resp(agent_desc, invalid_questions)
+  """
+  token = _current_escalation.set(max(level, _current_escalation.get()))
+  try:
+    yield
+  finally:
+    _current_escalation.reset(token)
+
+
+def current_escalation():
+  return _current_escalation.get()
+
+
+# ##############################################################################
+# ###                                METRICS                                 ###
+# ##############################################################################
+
+def model_cost(model, prompt_tokens, completion_tokens):
+  """
+  The cost in USD of a request, from LLM_MODEL_PRICES (USD per million input
+  and output tokens); 0.0 for models without a price.
+  """
+  input_price, output_price = LLM_MODEL_PRICES.get(model, (0.0, 0.0))
+  return (prompt_tokens * input_price + completion_tokens * output_price) / 1e6
+
+
+class RouteMetrics:
+  def __init__(self):
+    """
+    Per task and model: the number of requests, how many failed (generation
+    errors or responses that failed validation), how many escalated to the
+    next model of a cascade, their latency, token usage and cost.
+    """
+    self.stats = dict()
+    self._lock = threading.Lock()
+
+
+  def _entry(self, task, model):
+    return self.stats.setdefault(task or "default", dict()).setdefault(
+      model, {"requests": 0, "failures": 0, "escalations": 0, "seconds": 0.0,
+              "max_seconds": 0.0, "prompt_tokens": 0,
+              "completion_tokens": 0, "cost": 0.0})
+
+
+  def record(self, task, model, seconds, usage=None, ok=True):
+    usage = usage or dict()
+    prompt_tokens = usage.get("prompt_tokens", 0)
+    completion_tokens = usage.get("completion_tokens", 0)
+    with self._lock:
+      entry = self._entry(task, model)
+      entry["requests"] += 1
+      entry["failures"] += 0 if ok else 1
+      entry["seconds"] += seconds
+      entry["max_seconds"] = max(entry["max_seconds"], seconds)
+      entry["prompt_tokens"] += prompt_tokens
+      entry["completion_tokens"] += completion_tokens
+      entry["cost"] += model_cost(model, prompt_tokens, completion_tokens)
+
+
+  def escalation(self, task, model):
+    with self._lock:
+      self._entry(task, model)["escalations"] += 1
+
+
+  def report(self):
+    """
+    The metrics per task and model, with the mean latency and the cost per
+    request.
+    """
+    with self._lock:
+      ret = dict()
+      for task, models in self.stats.items():
+        ret[task] = dict()
+        for model, entry in models.items():
+          entry = dict(entry)
+          requests = max(entry["requests"], 1)
+          entry["mean_seconds"] = entry["seconds"] / requests
+          entry["cost_per_request"] = entry["cost"] / requests
+          ret[task][model] = entry
+      return ret
+
+
+  def reset(self):
+    with self._lock:
+      self.stats = dict()
+
+
+# The metrics of every routed request in this process.
+route_metrics = RouteMetrics()
@@ -0,0 +1,199 @@
+import time
+import threading
+import itertools
+import contextlib
+import contextvars
+from collections import deque
+
+from simulation_engine.settings import *
+from simulation_engine.concurrency import LimiterSlot, llm_limiter
+from simulation_engine.deadline import current_deadline
+
+
+# The priority class of the LLM requests made in the current context. Batch is
+# the default; interactive entry points (the chat endpoint, the CLI
+# conversation) wrap their calls in llm_priority("interactive").
+_current_priority = contextvars.ContextVar("llm_priority", default="batch")
+
+
+@contextlib.contextmanager
+def llm_priority(priority_class):
+  """
+  Runs the enclosed LLM calls in the given priority class.
+
+  Example:
+    >>> with llm_priority("interactive"):
+    ...   agent.utterance(dialogue)
+  """
+  token = _current_priority.set(priority_class)
+  try:
+    yield
+  finally:
+    _current_priority.reset(token)
+
+
+def current_priority():
+  return _current_priority.get()
+
+
+# ##############################################################################
+# ###                            LLM SCHEDULER                               ###
+# ##############################################################################
+
+class SchedulerSlot(LimiterSlot):
+  def __init__(self, scheduler, priority_class):
+    super().__init__(scheduler.limiter)
+    self.scheduler = scheduler
+    self.priority_class = priority_class
+
+
+  def __enter__(self):
+    self.scheduler.acquire(self.priority_class)
+    self.start = time.time()
+    return self
+
+
+  def __exit__(self, exc_type, exc, tb):
+    if exc_type is not None and self.outcome == "ok":
+      self.outcome = "error"
+    self.scheduler.release(time.time() - self.start, self.outcome)
+    return False
+
+
+class LLMScheduler:
+  def __init__(self, limiter, weights=LLM_PRIORITY_WEIGHTS,
+               starvation_seconds=LLM_STARVATION_SECONDS):
+    """
+    Orders waiting LLM requests by priority class before they take a slot of
+    the concurrency limiter. Classes share the slots in proportion to their
+    weights (stride scheduling over the classes that have requests waiting),
+    and any request that has waited longer than <starvation_seconds> goes
+    next regardless of its class, so batch work always makes progress.
+    """
+    self.limiter = limiter
+    self.weights = dict(weights)
+    self.starvation_seconds = starvation_seconds
+
+    self.queues = {priority_class: deque() for priority_class in self.weights}
+    self.virtual_time = {priority_class: 0.0 for priority_class in self.weights}
+    self.metrics = {priority_class: self._empty_metrics()
+                    for priority_class in self.weights}
+    self._counter = itertools.count()
+    self._cond = threading.Condition()
+
+
+  def _empty_metrics(self):
+    return {"dispatched": 0, "starvation_promotions": 0,
+            "total_wait": 0.0, "max_wait": 0.0,
+            "recent_waits": deque(maxlen=500)}
+
+
+  def slot(self, priority_class=None):
+    if priority_class is None:
+      priority_class = current_priority()
+    return SchedulerSlot(self, priority_class)
+
+
+  def _add_class(self, priority_class):
+    self.weights[priority_class] = 1
+    self.queues[priority_class] = deque()
+    self.virtual_time[priority_class] = 0.0
+    self.metrics[priority_class] = self._empty_metrics()
+
+
+  def _pick(self):
+    # Returns the (class, ticket) that should go next and whether it was
+    # promoted because it starved.
+    now = time.time()
+    waiting = [priority_class for priority_class, queue in self.queues.items()
+               if queue]
+    if not waiting:
+      return None, None, False
+
+    oldest = min(waiting, key=lambda c: self.queues[c][0][1])
+    if now - self.queues[oldest][0][1] >= self.starvation_seconds:
+      return oldest, self.queues[oldest][0], True
+
+    chosen = min(waiting, key=lambda c: (self.virtual_time[c],
+                                         -self.weights[c]))
+    return chosen, self.queues[chosen][0], False
+
+
+  def acquire(self, priority_class):
+    with self._cond:
+      if priority_class not in self.queues:
+        self._add_class(priority_class)
+
+      # A class that was idle does not get to spend the credit it built up
+      # while idle; it restarts at the virtual time of the busiest class.
+      queue = self.queues[priority_class]
+      if not queue:
+        active = [self.virtual_time[c] for c, q in self.queues.items() if q]
+        if active:
+          self.virtual_time[priority_class] = max(
+            self.virtual_time[priority_class], min(active))
+
+      curr_deadline = current_deadline()
+      ticket = (next(self._counter), time.time())
+      queue.append(ticket)
+      while True:
+        chosen, head, starved = self._pick()
+        if head is ticket and self.limiter.try_acquire():
+          break
+        # A request whose deadline passed (or whose caller went away) while
+        # queued leaves the queue without ever taking a slot.
+        if curr_deadline is not None and curr_deadline.expired():
+          queue.remove(ticket)
+          self._cond.notify_all()
+          curr_deadline.check()
+        # Slots are freed by limiter.release, which notifies this condition
+        # through release(); the timeout also re-checks for starvation.
+        self._cond.wait(timeout=0.05)
+
+      queue.popleft()
+      self.virtual_time[priority_class] += 1.0 / self.weights[priority_class]
+
+      wait = time.time() - ticket[1]
+      metrics = self.metrics[priority_class]
+      metrics["dispatched"] += 1
+      metrics["total_wait"] += wait
+      metrics["max_wait"] = max(metrics["max_wait"], wait)
+      metrics["recent_waits"].append(wait)
+      if starved:
+        metrics["starvation_promotions"] += 1
+      self._cond.notify_all()
+
+
+  def release(self, latency, outcome="ok"):
+    self.limiter.release(latency, outcome)
+    with self._cond:
+      self._cond.notify_all()
+
+
+  def stats(self):
+    """
+    Per-class queue-time metrics.
+
+    Returns:
+      A dictionary whose keys are the priority classes and whose values hold
+      the number of dispatched requests, the number currently waiting, the
+      mean, p95 and max queue time, and the number of starvation promotions.
+    """
+    with self._cond:
+      ret = dict()
+      for priority_class, metrics in self.metrics.items():
+        waits = sorted(metrics["recent_waits"])
+        dispatched = metrics["dispatched"]
+        ret[priority_class] = {
+          "dispatched": dispatched,
+          "waiting": len(self.queues[priority_class]),
+          "mean_wait": metrics["total_wait"] / dispatched if dispatched else 0.0,
+          "p95_wait": waits[int(0.95 * (len(waits) - 1))] if waits else 0.0,
+          "max_wait": metrics["max_wait"],
+          "starvation_promotions": metrics["starvation_promotions"]}
+      return ret
+
+
+# The scheduler in front of llm_limiter for every LLM and embedding request
+# in the process.
+llm_scheduler = LLMScheduler(llm_limiter)
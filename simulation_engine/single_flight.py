@@ -0,0 +1,162 @@
+import asyncio
+import threading
+
+from simulation_engine.deadline import DeadlineExceeded, current_deadline
+
+
+class _Call:
+  def __init__(self):
+    self.event = threading.Event()
+    self.result = None
+    self.error = None
+    # Set when the leader gave up (its own deadline, or a cancellation) before
+    # the call finished, so the waiting callers retry instead.
+    self.abandoned = False
+
+
+# The result an abandoned async call hands to the tasks waiting on it.
+_ABANDONED = object()
+
+
+def _abandons(error):
+  # Errors that belong to the leader alone rather than to the shared call.
+  return (isinstance(error, DeadlineExceeded)
+          or not isinstance(error, Exception))
+
+
+class SingleFlight:
+  def __init__(self):
+    """
+    Deduplicates concurrent calls that share a key: the first caller (the
+    leader) runs the function, and every caller that arrives with the same
+    key while it is in flight waits for it and receives the same result (or
+    the same exception). Nothing is cached once the call finishes.
+
+    Deadlines and cancellations stay with the caller they belong to: when
+    the leader's own deadline passes (or it is cancelled) the call is handed
+    off, and one of the callers still waiting runs it again as the new
+    leader.
+    """
+    self._calls = dict()
+    self._async_calls = dict()
+    self._lock = threading.Lock()
+    self.metrics = {"calls": 0, "executed": 0, "coalesced": 0}
+
+
+  def do(self, key, fn, *args, **kwargs):
+    """
+    Runs fn(*args, **kwargs) unless a call with the same key is already in
+    flight in another thread, in which case it waits for that call.
+
+    Parameters:
+      key: hashable key identifying identical calls
+      fn: the function to run
+    Returns:
+      the result of fn
+    """
+    with self._lock:
+      self.metrics["calls"] += 1
+    while True:
+      with self._lock:
+        call = self._calls.get(key)
+        if call is not None:
+          self.metrics["coalesced"] += 1
+          leader = False
+        else:
+          call = _Call()
+          self._calls[key] = call
+          self.metrics["executed"] += 1
+          leader = True
+
+      if leader:
+        break
+      # A follower stops waiting when its own deadline passes; the leader's
+      # call carries on for the callers that are still waiting on it.
+      curr_deadline = current_deadline()
+      if curr_deadline is None:
+        call.event.wait()
+      else:
+        while not call.event.wait(timeout=0.05):
+          curr_deadline.check()
+      if call.abandoned:
+        continue
+      if call.error is not None:
+        raise call.error
+      return call.result
+
+    try:
+      call.result = fn(*args, **kwargs)
+      return call.result
+    except BaseException as e:
+      if _abandons(e):
+        call.abandoned = True
+      else:
+        call.error = e
+      raise
+    finally:
+      with self._lock:
+        del self._calls[key]
+      call.event.set()
+
+
+  async def do_async(self, key, coro_fn, *args, **kwargs):
+    """
+    The asyncio counterpart of do(): concurrent tasks (on the same event loop)
+    awaiting the same key share one awaited coroutine.
+
+    Parameters:
+      key: hashable key identifying identical calls
+      coro_fn: a coroutine function
+    Returns:
+      the result of the coroutine
+    """
+    loop = asyncio.get_running_loop()
+    loop_key = (id(loop), key)
+    with self._lock:
+      self.metrics["calls"] += 1
+    while True:
+      with self._lock:
+        future = self._async_calls.get(loop_key)
+        if future is not None:
+          self.metrics["coalesced"] += 1
+          leader = False
+        else:
+          future = loop.create_future()
+          self._async_calls[loop_key] = future
+          self.metrics["executed"] += 1
+          leader = True
+
+      if leader:
+        break
+      # Shielded, so a cancelled follower does not cancel the shared call.
+      result = await asyncio.shield(future)
+      if result is not _ABANDONED:
+        return result
+
+    try:
+      result = await coro_fn(*args, **kwargs)
+      future.set_result(result)
+      return result
+    except BaseException as e:
+      # A cancelled leader hands the call off to the tasks still waiting.
+      if _abandons(e):
+        future.set_result(_ABANDONED)
+      else:
+        future.set_exception(e)
+        # Marking the exception as retrieved when no other task waits on it.
+        future.exception()
+      raise
+    finally:
+      with self._lock:
+        del self._async_calls[loop_key]
+
+
+  def stats(self):
+    with self._lock:
+      ret = dict(self.metrics)
+      ret["in_flight"] = len(self._calls) + len(self._async_calls)
+      return ret
+
+
+# Shared by the chat completion and embedding requests in gpt_structure.
+llm_single_flight = SingleFlight()
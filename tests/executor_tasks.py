@@ -0,0 +1,21 @@
+# Module-level tasks for the HybridExecutor tests. Workers are spawned, so
+# their task functions must be importable by name from a module, not defined
+# inside a test.
+import os
+
+import environment.executor as executor_module
+
+
+def agent_state(agent, tag=None):
+  # The worker the task ran in, what it sees of the agent and its agent
+  # pool's counters.
+  stats = executor_module._worker_agent_pool.stats
+  return {"pid": os.getpid(), "tag": tag,
+          "first_name": agent.scratch["first_name"],
+          "nodes": len(agent.memory_stream.seq_nodes),
+          "hits": stats["hits"], "misses": stats["misses"],
+          "reloads": stats["reloads"]}
+
+
+def failing_task(agent):
+  raise RuntimeError(f"no answer from {agent.scratch['first_name']}")
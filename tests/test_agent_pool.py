@@ -0,0 +1,132 @@
+import pytest
+
+from environment.agent_pool import AgentPool
+from genagents.genagents import GenerativeAgent
+
+
+def _node(node_id, content):
+  return {"node_id": node_id, "node_type": "observation", "content": content,
+          "importance": 10, "created": node_id, "last_retrieved": node_id,
+          "pointer_id": None}
+
+
+@pytest.fixture
+def agent_folders(tmp_path):
+  folders = dict()
+  for name in ["a", "b", "c"]:
+    folder = str(tmp_path / name)
+    nodes = [_node(i, f"{name} {i}") for i in range(3)]
+    embeddings = {f"{name} {i}": [1.0, float(i)] for i in range(3)}
+    GenerativeAgent.from_state({"first_name": name}, nodes,
+                               embeddings).save(folder)
+    folders[name] = folder
+  return folders
+
+
+def _get(pool, folder):
+  return pool.get({"agent_folder": folder})
+
+
+def _grow(agent, count):
+  memory_stream = agent.memory_stream
+  memory_stream.reflection_scheduler = None
+  for _ in range(count):
+    memory_stream._add_node(1, "observation", "new", 10, None,
+                            embedding=[0.0, 1.0])
+
+
+def test_least_recently_used_agent_is_evicted(agent_folders):
+  pool = AgentPool(max_agents=2, max_nodes=100)
+  agent_a = _get(pool, agent_folders["a"])
+  _get(pool, agent_folders["b"])
+  assert _get(pool, agent_folders["a"]) is agent_a
+  _get(pool, agent_folders["c"])
+
+  assert list(pool.agents) == [agent_folders["a"], agent_folders["c"]]
+  assert pool.stats["hits"] == 1
+  assert pool.stats["misses"] == 3
+  assert pool.stats["evictions"] == 1
+  assert pool.node_count == 6
+
+
+def test_node_count_follows_agents_growing_after_load(agent_folders):
+  pool = AgentPool(max_agents=10, max_nodes=10)
+  agent_a = _get(pool, agent_folders["a"])
+  _get(pool, agent_folders["b"])
+  assert pool.node_count == 6
+
+  _grow(agent_a, 3)
+  assert pool.node_count == 9
+  agent_a.save(agent_folders["a"])
+  # "a" grew but is the least recently used one, so it goes first.
+  _get(pool, agent_folders["c"])
+  assert list(pool.agents) == [agent_folders["b"], agent_folders["c"]]
+  assert pool.node_count == 6
+  assert agent_a.memory_stream.size_listeners == []
+
+  pool.clear()
+  assert pool.node_count == 0
+  assert len(pool) == 0
+
+
+def test_compaction_lowers_node_count(agent_folders):
+  pool = AgentPool(max_agents=10, max_nodes=100)
+  agent = _get(pool, agent_folders["a"])
+  memory_stream = agent.memory_stream
+  memory_stream.reflection_scheduler = None
+  for _ in range(2):
+    memory_stream._add_node(1, "observation", "a 0", 10, None,
+                            embedding=[1.0, 0.0])
+  assert pool.node_count == 5
+  report = agent.compact_memories(incremental=False)
+  assert report["removed"] == 2
+  assert pool.node_count == 5 - report["removed"]
+  assert pool.node_count == len(memory_stream.seq_nodes)
+
+
+def test_agents_with_unsaved_changes_are_not_evicted(agent_folders, capsys):
+  pool = AgentPool(max_agents=1, max_nodes=100)
+  agent_a = _get(pool, agent_folders["a"])
+  agent_a.update_scratch({"age": 30})
+  _get(pool, agent_folders["b"])
+
+  assert agent_folders["a"] in pool
+  assert pool.stats["dirty_skips"] == 1
+  assert "over its bounds" in capsys.readouterr().out
+
+  # Once saved, the agent can go.
+  agent_a.save(agent_folders["a"])
+  _get(pool, agent_folders["c"])
+  assert list(pool.agents) == [agent_folders["c"]]
+  assert pool.stats["evictions"] == 2
+
+
+def test_revalidating_pool_reloads_agents_saved_elsewhere(agent_folders):
+  pool = AgentPool(max_agents=10, max_nodes=100, revalidate=True)
+  agent = _get(pool, agent_folders["a"])
+  assert _get(pool, agent_folders["a"]) is agent
+
+  other = GenerativeAgent(agent_folders["a"])
+  other.update_scratch({"age": 44})
+  other.save(agent_folders["a"])
+
+  reloaded = _get(pool, agent_folders["a"])
+  assert reloaded is not agent
+  assert reloaded.scratch["age"] == 44
+  assert pool.stats["reloads"] == 1
+  assert pool.node_count == 3
+
+  # Without revalidation the cached agent is kept.
+  pool = AgentPool(max_agents=10, max_nodes=100)
+  agent = _get(pool, agent_folders["b"])
+  other = GenerativeAgent(agent_folders["b"])
+  other.update_scratch({"age": 44})
+  other.save(agent_folders["b"])
+  assert _get(pool, agent_folders["b"]) is agent
+
+
+def test_missing_agent_raises(tmp_path):
+  pool = AgentPool()
+  with pytest.raises(FileNotFoundError):
+    _get(pool, str(tmp_path / "missing"))
+  assert len(pool) == 0
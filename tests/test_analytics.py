@@ -0,0 +1,135 @@
+import numpy as np
+import pytest
+
+from environment.survey.analytics import SurveyAnalytics
+from environment.survey.response_index import ResponseIndex
+
+
+class _Survey:
+  # The parts of a Survey the analytics read: its index and question schema.
+  # Everything here is indexed up front.
+  def __init__(self):
+    self.response_index = ResponseIndex()
+    self.question_schema = dict()
+
+  def _index_questions(self, questions):
+    pass
+
+  def _index_scratch(self, fields):
+    pass
+
+
+@pytest.fixture
+def survey():
+  survey = _Survey()
+  index = survey.response_index
+  agent_pids = ["a", "b", "c", "d", "e"]
+  survey.question_schema["Q1"] = {"type": "categorical",
+                                  "options": ["No", "Yes", "Maybe"]}
+  index.update("Q1", agent_pids, ["Yes", "No", "Yes", "Yes", None])
+  index.update("Score", agent_pids, [1, 2, 3, 4, 5])
+  index.update("sex", agent_pids, ["F", "M", "M", "F", "F"], "scratch")
+  index.update("weight", agent_pids[:4], [1.0, 3.0, 1.0, 1.0], "scratch")
+  return survey
+
+
+def test_distribution_follows_option_order(survey):
+  analytics = SurveyAnalytics(survey)
+  shares = analytics.distribution("Q1")
+  # Options without answers are left out; unanswered agents do not count.
+  assert list(shares.index) == ["No", "Yes"]
+  assert shares.tolist() == pytest.approx([0.25, 0.75])
+  counts = analytics.distribution("Q1", normalize=False)
+  assert counts.tolist() == [1.0, 3.0]
+
+
+def test_weighted_distribution(survey):
+  # By scratch field: b weighs 3 and e, without a weight, weighs 0.
+  analytics = SurveyAnalytics(survey, weights="weight")
+  assert analytics.distribution("Q1").tolist() == pytest.approx([0.5, 0.5])
+  # By dictionary, overriding the default.
+  shares = analytics.distribution("Q1", weights={"a": 2, "b": 1, "c": 1,
+                                                 "d": 0, "missing": 9})
+  assert shares.tolist() == pytest.approx([0.25, 0.75])
+  assert set(analytics.distributions()) == {"Q1", "Score"}
+
+
+def test_crosstab_normalization(survey):
+  analytics = SurveyAnalytics(survey)
+  table = analytics.crosstab("Q1", "sex")
+  assert list(table.index) == ["No", "Yes"]
+  assert list(table.columns) == ["F", "M"]
+  assert table.values.tolist() == [[0, 1], [2, 1]]
+
+  rows = analytics.crosstab("Q1", "sex", normalize="index")
+  assert np.allclose(rows.values, [[0, 1], [2 / 3, 1 / 3]])
+  columns = analytics.crosstab("Q1", "sex", normalize="columns")
+  assert np.allclose(columns.values, [[0, 0.5], [1, 0.5]])
+  everything = analytics.crosstab("Q1", "sex", normalize="all")
+  assert everything.values.sum() == pytest.approx(1.0)
+
+  weighted = analytics.crosstab("Q1", "sex", weights="weight")
+  assert weighted.values.tolist() == [[0, 3], [2, 1]]
+
+
+def test_numeric_summary(survey):
+  analytics = SurveyAnalytics(survey)
+  summary = analytics.numeric_summary("Score")
+  assert summary["count"] == 5
+  assert summary["mean"] == pytest.approx(3.0)
+  assert summary["std"] == pytest.approx(np.std([1, 2, 3, 4, 5]))
+  assert (summary["min"], summary["max"]) == (1.0, 5.0)
+
+  weighted = analytics.numeric_summary("Score", weights="weight")
+  # Weights 1, 3, 1, 1 and 0.
+  assert weighted["count"] == 5
+  assert weighted["mean"] == pytest.approx((1 + 6 + 3 + 4) / 6)
+  assert weighted["std"] == pytest.approx(
+    np.sqrt(np.average(np.square(np.array([1, 2, 3, 4]) - 14 / 6),
+                       weights=[1, 3, 1, 1])))
+
+  empty = analytics.numeric_summary("Score", weights={"missing": 1})
+  assert np.isnan(empty["mean"])
+
+
+def test_bootstrap_ci(survey):
+  analytics = SurveyAnalytics(survey, n_boot=2000, seed=7)
+  estimate, low, high = analytics.bootstrap_ci("Q1", answer="Yes")
+  assert estimate == pytest.approx(0.75)
+  assert 0.0 <= low <= estimate <= high <= 1.0
+  assert low < high
+
+  estimate, low, high = analytics.bootstrap_ci("Score")
+  assert estimate == pytest.approx(3.0)
+  assert 1.0 <= low < 3.0 < high <= 5.0
+
+  estimate, low, high = analytics.bootstrap_ci("Score", weights="weight")
+  assert estimate == pytest.approx(14 / 6)
+  assert 1.0 <= low <= estimate <= high <= 4.0
+
+  # The same seed gives the same interval.
+  first = SurveyAnalytics(survey, n_boot=2000, seed=7)
+  second = SurveyAnalytics(survey, n_boot=2000, seed=7)
+  assert first.bootstrap_ci("Q1", "Yes") == second.bootstrap_ci("Q1", "Yes")
+
+
+def test_bootstrap_without_answers_is_nan(survey):
+  analytics = SurveyAnalytics(survey, n_boot=10)
+  assert all(np.isnan(i) for i in analytics.bootstrap_ci("Unasked"))
+  assert all(np.isnan(i) for i in analytics.bootstrap_ci(
+    "Unasked", weights={"a": 1}))
+
+
+def test_rows_are_cached_until_the_field_changes(survey):
+  analytics = SurveyAnalytics(survey)
+  values, rows = analytics._rows("Q1")
+  assert analytics._rows("Q1")[1] is rows
+  # A change to another field leaves this one cached.
+  survey.response_index.update("Score", ["a"], [9])
+  assert analytics._rows("Q1")[1] is rows
+
+  survey.response_index.update("Q1", ["e", "f"], ["Maybe", "No"])
+  values, new_rows = analytics._rows("Q1")
+  assert new_rows is not rows
+  assert values == ["No", "Yes", "Maybe"]
+  assert analytics.distribution("Q1", normalize=False).tolist() == [2, 3, 1]
@@ -0,0 +1,107 @@
+from genagents.genagents import GenerativeAgent
+from genagents.modules.answer_store import AnswerStore, agent_state_version
+
+
+def _agent():
+  nodes = [{"node_id": 0, "node_type": "observation", "content": "a",
+            "importance": 10, "created": 0, "last_retrieved": 0,
+            "pointer_id": None}]
+  agent = GenerativeAgent.from_state({"first_name": "Ada"}, nodes,
+                                     {"a": [1.0, 0.0]})
+  agent.memory_stream.reflection_scheduler = None
+  return agent
+
+
+def _add(agent, node_type, content):
+  agent.memory_stream._add_node(1, node_type, content, 10, None,
+                                embedding=[0.0, 1.0])
+
+
+def test_state_version_follows_invalidation_policy():
+  agent = _agent()
+  memory = agent_state_version(agent, "memory")
+  reflection = agent_state_version(agent, "reflection")
+  never = agent_state_version(agent, "never")
+  assert memory[0] == str(agent.id)
+
+  _add(agent, "observation", "b")
+  assert agent_state_version(agent, "memory") != memory
+  assert agent_state_version(agent, "reflection") == reflection
+
+  _add(agent, "reflection", "c")
+  assert agent_state_version(agent, "reflection") != reflection
+
+  memory = agent_state_version(agent, "memory")
+  reflection = agent_state_version(agent, "reflection")
+  agent.update_scratch({"age": 30})
+  assert agent_state_version(agent, "memory") != memory
+  assert agent_state_version(agent, "reflection") != reflection
+  assert agent_state_version(agent, "never") == never
+
+
+def test_state_version_ignores_retrieval_times():
+  agent = _agent()
+  version = agent_state_version(agent)
+  agent.memory_stream.seq_nodes[0].last_retrieved = 50
+  assert agent_state_version(agent) == version
+
+
+def test_key_depends_on_every_part():
+  parts = [("id", "m", "s"), "categorical", "Q?", ["Yes", "No"], "gpt", "1"]
+  key = AnswerStore.key(*parts)
+  assert AnswerStore.key(*parts) == key
+  for count in range(len(parts)):
+    changed = list(parts)
+    changed[count] = ("other", "m", "s") if count == 0 else "other"
+    assert AnswerStore.key(*changed) != key
+
+
+def test_least_recently_used_entry_is_evicted():
+  store = AnswerStore(store_path=None, max_entries=2, enabled=True)
+  store.put("a", "agent", "A")
+  store.put("b", "agent", "B")
+  assert store.get("a") == ("A", None)
+  store.put("c", "agent", "C")
+
+  assert store.get("b") is None
+  assert store.get("a") == ("A", None)
+  assert store.get("c") == ("C", None)
+  stats = store.stats()
+  assert stats["evictions"] == 1
+  assert stats["entries"] == 2
+  assert (stats["hits"], stats["misses"]) == (3, 1)
+
+
+def test_invalidate_drops_one_agent():
+  store = AnswerStore(store_path=None, enabled=True)
+  store.put("a", "1", "A")
+  store.put("b", "2", "B")
+  store.invalidate(1)
+  assert store.get("a") is None
+  assert store.get("b") == ("B", None)
+  store.invalidate()
+  assert store.stats()["entries"] == 0
+
+
+def test_jsonl_store_is_reloaded(tmp_path):
+  store_path = str(tmp_path / "store" / "answers.jsonl")
+  store = AnswerStore(store_path=store_path, max_entries=10, enabled=True)
+  store.put("a", "agent", "A", "because")
+  store.put("b", "agent", 3)
+  store.put("a", "agent", "A2", "changed")
+  store.close()
+  with open(store_path, "a") as f:
+    f.write('{"key": "c", "agent_id"')
+
+  reloaded = AnswerStore(store_path=store_path, max_entries=10)
+  assert reloaded.get("a") == ("A2", "changed")
+  assert reloaded.get("b") == (3, None)
+  assert reloaded.get("c") is None
+
+  # Only the most recently written entries are kept on reload.
+  trimmed = AnswerStore(store_path=store_path, max_entries=1)
+  assert list(trimmed.entries) == ["a"]
+
+
+def test_store_is_disabled_by_default():
+  assert not AnswerStore(store_path=None).enabled
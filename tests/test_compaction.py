@@ -0,0 +1,130 @@
+import math
+
+import genagents.modules.memory_stream as memory_stream_module
+from genagents.genagents import GenerativeAgent
+from genagents.modules.memory_stream import MemoryStream, ReflectionScheduler
+
+
+def _angle(degrees):
+  return [math.cos(math.radians(degrees)), math.sin(math.radians(degrees))]
+
+
+def _node(node_id, content, node_type="observation", pointer_id=None,
+          importance=10):
+  return {"node_id": node_id, "node_type": node_type, "content": content,
+          "importance": importance, "created": node_id,
+          "last_retrieved": node_id, "pointer_id": pointer_id}
+
+
+def _stream(nodes, angles):
+  memory_stream = MemoryStream(nodes, {node["content"]: _angle(angle)
+                                       for node, angle in zip(nodes, angles)})
+  memory_stream.reflection_scheduler = None
+  memory_stream.compaction_scheduler = None
+  return memory_stream
+
+
+def _ids(memory_stream):
+  return [node.node_id for node in memory_stream.seq_nodes]
+
+
+def test_chained_near_duplicates_merge_into_newest():
+  # 0 ~ 1 and 1 ~ 2 but not 0 ~ 2: union-find puts all three in one cluster.
+  nodes = [_node(0, "a", importance=70), _node(1, "b"), _node(2, "c"),
+           _node(3, "far")]
+  memory_stream = _stream(nodes, [0, 15, 30, 90])
+  report = memory_stream.compact(similarity=0.95, incremental=False,
+                                 measure=False)
+
+  assert report["clusters"] == 1
+  assert report["removed"] == 2
+  assert _ids(memory_stream) == [2, 3]
+  keep = memory_stream.id_to_node[2]
+  assert keep.importance == 70
+  assert keep.last_retrieved == 2
+  assert set(memory_stream.embeddings) == {"c", "far"}
+  archived = {node["node_id"]: node["merged_into"]
+              for node in memory_stream.pending_archive}
+  assert archived == {0: 2, 1: 2}
+
+
+def test_small_blocks_find_the_same_clusters():
+  nodes = [_node(i, f"n{i}") for i in range(6)]
+  angles = [0, 5, 50, 55, 90, 170]
+  full = _stream([dict(node) for node in nodes], angles)
+  blocked = _stream([dict(node) for node in nodes], angles)
+  full.compact(similarity=0.99, incremental=False, measure=False)
+  blocked.compact(similarity=0.99, incremental=False, measure=False,
+                  block_size=2)
+  assert _ids(full) == _ids(blocked) == [1, 3, 4, 5]
+
+
+def test_reflection_pointers_follow_merged_nodes():
+  nodes = [_node(0, "a"), _node(1, "a'"), _node(2, "b"),
+           _node(3, "r", "reflection", pointer_id=[0, 1, 2]),
+           _node(4, "r2", "reflection", pointer_id=[2])]
+  memory_stream = _stream(nodes, [0, 1, 90, 45, 60])
+  memory_stream.dirty_node_ids = dict()
+  memory_stream.compact(similarity=0.95, incremental=False, measure=False)
+
+  assert _ids(memory_stream) == [1, 2, 3, 4]
+  # Both pointers now name node 1; the duplicate is dropped, order kept.
+  assert memory_stream.id_to_node[3].pointer_id == [1, 2]
+  assert memory_stream.id_to_node[4].pointer_id == [2]
+  assert set(memory_stream.dirty_node_ids) == {1, 3}
+
+
+def test_incremental_compaction_compares_only_new_observations():
+  nodes = [_node(0, "a"), _node(1, "a'"), _node(2, "b")]
+  memory_stream = _stream(nodes, [0, 1, 90])
+  # As if loaded with meta.json saying 0-1 were compacted already.
+  memory_stream.compacted_through = 2
+  report = memory_stream.compact(similarity=0.95, measure=False)
+  assert report["removed"] == 0
+  assert memory_stream.compacted_through == 3
+
+  # A new observation is compared against every observation.
+  memory_stream._add_node(3, "observation", "b'", 10, None,
+                          embedding=_angle(91))
+  memory_stream._add_node(4, "reflection", "r", 10, [3],
+                          embedding=_angle(45))
+  report = memory_stream.compact(similarity=0.95, measure=False)
+  assert report["removed"] == 1
+  assert _ids(memory_stream) == [0, 1, 3, 4]
+  # Up to the last observation compared.
+  assert memory_stream.compacted_through == 4
+
+  report = memory_stream.compact(similarity=0.95, incremental=False,
+                                 measure=False)
+  assert report["removed"] == 1
+  assert _ids(memory_stream) == [1, 3, 4]
+
+
+def test_scheduled_compaction_runs_on_the_scheduler(monkeypatch):
+  monkeypatch.setattr(memory_stream_module, "COMPACTION_EVERY", 3)
+  memory_stream = _stream([_node(0, "a")], [0])
+  scheduler = ReflectionScheduler()
+  memory_stream.compaction_scheduler = scheduler
+  assert not memory_stream.compaction_due()
+
+  memory_stream._add_node(1, "observation", "a'", 10, None,
+                          embedding=_angle(1))
+  assert scheduler.stats()["enqueued"] == 0
+  memory_stream._add_node(2, "observation", "b", 10, None,
+                          embedding=_angle(90))
+  assert scheduler.flush(timeout=5)
+
+  stats = scheduler.stats()
+  assert (stats["compactions"], stats["compacted_nodes"]) == (1, 1)
+  assert _ids(memory_stream) == [1, 2]
+  assert not memory_stream.compaction_due()
+
+
+def test_save_does_not_compact(monkeypatch, tmp_path):
+  monkeypatch.setattr(memory_stream_module, "COMPACTION_EVERY", 1)
+  agent = GenerativeAgent.from_state(
+    {"first_name": "Ada"}, [_node(0, "a"), _node(1, "a'")],
+    {"a": _angle(0), "a'": _angle(1)})
+  assert agent.memory_stream.compaction_due()
+  agent.save(str(tmp_path / "agent"))
+  assert len(agent.memory_stream.seq_nodes) == 2
@@ -0,0 +1,128 @@
+import pytest
+
+from simulation_engine.concurrency import AdaptiveConcurrencyLimiter
+
+
+def _limiter(**kwargs):
+  params = {"min_limit": 1, "max_limit": 64, "initial_limit": 8,
+            "cooldown": 0.0}
+  params.update(kwargs)
+  return AdaptiveConcurrencyLimiter(**params)
+
+
+def _complete(limiter, latency, outcome="ok"):
+  limiter.acquire()
+  limiter.release(latency, outcome)
+
+
+def test_healthy_calls_raise_limit_additively():
+  limiter = _limiter()
+  for _ in range(8):
+    _complete(limiter, 0.1)
+  # Eight increments of 1/limit at a limit of about 8 add about one slot.
+  assert limiter.limit == pytest.approx(9.0, abs=0.1)
+
+  limiter = _limiter(initial_limit=4, max_limit=5)
+  for _ in range(100):
+    _complete(limiter, 0.1)
+  assert limiter.limit == 5
+
+
+@pytest.mark.parametrize("outcome", ["rate_limited", "timeout"])
+def test_rate_limit_and_timeout_halve_limit(outcome):
+  limiter = _limiter(initial_limit=16)
+  _complete(limiter, 0.1, outcome)
+  assert limiter.limit == 8
+  assert limiter.counts[outcome] == 1
+  assert limiter.decisions[-1]["decision"] == "decrease"
+
+  limiter = _limiter(initial_limit=2, min_limit=2)
+  _complete(limiter, 0.1, outcome)
+  assert limiter.limit == 2
+
+
+def test_cooldown_counts_a_burst_once():
+  limiter = _limiter(initial_limit=16, cooldown=60.0)
+  for _ in range(5):
+    _complete(limiter, 0.1, "rate_limited")
+  assert limiter.limit == 8
+  assert len(limiter.decisions) == 1
+
+
+def test_error_rate_decreases_only_over_threshold():
+  limiter = _limiter(initial_limit=16)
+  for _ in range(9):
+    _complete(limiter, 0.1, "error")
+  # Fewer than ten outcomes are not enough to judge the error rate.
+  assert limiter.limit == 16
+  _complete(limiter, 0.1, "error")
+  assert limiter.limit == 8
+
+
+def test_cancelled_calls_leave_limit_alone():
+  limiter = _limiter(initial_limit=16)
+  for _ in range(20):
+    _complete(limiter, 10.0, "cancelled")
+  assert limiter.limit == 16
+  assert limiter.in_flight == 0
+  assert len(limiter.outcomes) == 0
+
+
+def test_p95_is_checked_every_20_samples():
+  limiter = _limiter(initial_limit=16, max_limit=16)
+  for _ in range(20):
+    _complete(limiter, 0.1)
+  assert limiter.baseline_p95 == pytest.approx(0.1)
+
+  # Slow samples only count when the next check comes round.
+  for _ in range(19):
+    _complete(limiter, 1.0)
+  assert limiter.limit == 16
+  _complete(limiter, 1.0)
+  assert limiter.limit == 8
+  # The baseline is relearned at the new limit.
+  assert limiter.baseline_p95 is None
+  assert len(limiter.latencies) == 0
+
+
+def test_p95_within_tolerance_keeps_increasing():
+  limiter = _limiter(initial_limit=8, latency_tolerance=2.0)
+  for _ in range(20):
+    _complete(limiter, 0.1)
+  limit = limiter.limit
+  for _ in range(20):
+    _complete(limiter, 0.15)
+  assert limiter.limit > limit
+  assert limiter.baseline_p95 == pytest.approx(0.1)
+
+
+def test_try_acquire_respects_limit():
+  limiter = _limiter(initial_limit=2)
+  assert limiter.try_acquire()
+  assert limiter.try_acquire()
+  assert not limiter.try_acquire()
+  limiter.release(0.1, "cancelled")
+  assert limiter.try_acquire()
+
+
+def test_slot_records_errors_raised_inside():
+  limiter = _limiter()
+  with pytest.raises(ValueError):
+    with limiter.slot():
+      raise ValueError()
+  assert limiter.counts["error"] == 1
+  assert limiter.in_flight == 0
+
+
+def test_share_splits_limits():
+  limiter = _limiter(min_limit=4, max_limit=64, initial_limit=32)
+  limiter.share(4)
+  assert limiter.max_limit == 16
+  assert limiter.min_limit == 1
+  assert limiter.limit == 8
+
+  limiter = _limiter(min_limit=1, max_limit=3, initial_limit=3)
+  limiter.share(8)
+  assert limiter.max_limit == 1
+  assert limiter.min_limit == 1
+  assert limiter.limit == 1
@@ -0,0 +1,73 @@
+import time
+
+import pytest
+
+from simulation_engine.deadline import (Deadline, DeadlineExceeded,
+                                        check_deadline, current_deadline,
+                                        deadline, deadline_metrics,
+                                        request_timeout)
+
+
+def test_nested_deadline_never_outlives_parent():
+  assert current_deadline() is None
+  with deadline(0.5) as outer:
+    with deadline(60) as inner:
+      assert current_deadline() is inner
+      assert inner.parent is outer
+      assert inner.expires_at == outer.expires_at
+    with deadline(0.1) as inner:
+      assert inner.expires_at < outer.expires_at
+    assert current_deadline() is outer
+  assert current_deadline() is None
+
+
+def test_deadline_without_limit_inherits_parent():
+  with deadline() as outer:
+    assert outer.remaining() is None
+    with deadline(expires_at=time.time() + 10) as inner:
+      assert 9 < inner.remaining() <= 10
+
+
+def test_cancelling_parent_cancels_child():
+  parent = Deadline()
+  with deadline(curr_deadline=parent):
+    with deadline(60) as child:
+      assert not child.expired()
+      parent.cancel()
+      assert child.cancelled()
+      assert child.expired()
+
+
+def test_check_deadline_raises_and_counts():
+  check_deadline()
+
+  timeouts = deadline_metrics["timeouts"]
+  with deadline(expires_at=time.time() - 1):
+    with pytest.raises(DeadlineExceeded, match="exceeded"):
+      check_deadline()
+  assert deadline_metrics["timeouts"] == timeouts + 1
+
+  cancellations = deadline_metrics["cancellations"]
+  with deadline(60) as curr_deadline:
+    check_deadline()
+    curr_deadline.cancel()
+    with pytest.raises(DeadlineExceeded, match="cancelled"):
+      check_deadline()
+  assert deadline_metrics["cancellations"] == cancellations + 1
+
+
+def test_deadline_exceeded_is_a_timeout():
+  assert issubclass(DeadlineExceeded, TimeoutError)
+
+
+def test_request_timeout_is_clamped_to_deadline():
+  assert request_timeout(30) == 30
+  with deadline():
+    assert request_timeout(30) == 30
+  with deadline(5):
+    assert 4 < request_timeout(30) <= 5
+    assert request_timeout(2) == 2
+  with deadline(expires_at=time.time() - 1):
+    # A passed deadline still gives the request a positive timeout; the
+    # deadline check is what stops it.
+    assert request_timeout(30) == 0.001
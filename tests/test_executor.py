@@ -0,0 +1,117 @@
+import zlib
+import concurrent.futures
+
+import pytest
+
+from environment.executor import HybridExecutor
+from genagents.genagents import GenerativeAgent
+
+import executor_tasks
+
+
+def _node(node_id, content):
+  return {"node_id": node_id, "node_type": "observation", "content": content,
+          "importance": 10, "created": node_id, "last_retrieved": node_id,
+          "pointer_id": None}
+
+
+@pytest.fixture(scope="module")
+def executor():
+  executor = HybridExecutor(2, threads_per_worker=2, batch_size=2)
+  yield executor
+  executor.shutdown()
+
+
+@pytest.fixture
+def agent_folders(tmp_path):
+  # Three agents on each of the two shards (tmp_path changes every run).
+  folders = dict()
+  per_shard = [0, 0]
+  for name in "abcdefghijklmnopqrstuvwxyz":
+    folder = str(tmp_path / name)
+    shard = zlib.crc32(folder.encode("utf-8")) % 2
+    if per_shard[shard] == 3:
+      continue
+    per_shard[shard] += 1
+    GenerativeAgent.from_state({"first_name": name}, [_node(0, name)],
+                               {name: [1.0, 0.0]}).save(folder)
+    folders[name] = folder
+  assert per_shard == [3, 3]
+  return folders
+
+
+def _tasks(agent_folders, args=()):
+  return [(name, {"agent_folder": folder}, args)
+          for name, folder in agent_folders.items()]
+
+
+def _run(executor, task_fn, tasks):
+  results = dict()
+  for key, result, error, _, _ in executor.run(task_fn, tasks):
+    assert error is None
+    results[key] = result
+  return results
+
+
+def test_tasks_go_to_the_shard_of_their_agent_folder(executor, agent_folders):
+  shards = {name: zlib.crc32(folder.encode("utf-8")) % 2
+            for name, folder in agent_folders.items()}
+  assert all(executor._shard({"agent_folder": folder}) == shards[name]
+             for name, folder in agent_folders.items())
+
+  first = _run(executor, executor_tasks.agent_state, _tasks(agent_folders))
+  second = _run(executor, executor_tasks.agent_state, _tasks(agent_folders))
+  pids = dict()
+  for name, shard in shards.items():
+    assert first[name]["first_name"] == name
+    # Each shard is one process, and an agent stays in it across runs.
+    assert pids.setdefault(shard, first[name]["pid"]) == first[name]["pid"]
+    assert second[name]["pid"] == first[name]["pid"]
+  assert pids[0] != pids[1]
+
+  # The second run found every agent in its worker's cache.
+  for shard, pid in pids.items():
+    names = [name for name in shards if shards[name] == shard]
+    assert max(second[name]["hits"] for name in names) >= len(names)
+
+
+def test_workers_reload_agents_saved_by_the_parent(executor, agent_folders):
+  tasks = _tasks({"a": agent_folders["a"]})
+  before = _run(executor, executor_tasks.agent_state, tasks)["a"]
+  assert before["nodes"] == 1
+
+  # Unchanged on disk: the cached agent is used.
+  cached = _run(executor, executor_tasks.agent_state, tasks)["a"]
+  assert (cached["nodes"], cached["reloads"]) == (1, before["reloads"])
+
+  agent = GenerativeAgent(agent_folders["a"])
+  agent.memory_stream.reflection_scheduler = None
+  agent.memory_stream._add_node(1, "observation", "a again", 10, None,
+                                embedding=[0.0, 1.0])
+  agent.save(agent_folders["a"])
+
+  after = _run(executor, executor_tasks.agent_state, tasks)["a"]
+  assert after["pid"] == before["pid"]
+  assert after["nodes"] == 2
+  assert after["reloads"] == before["reloads"] + 1
+
+
+def test_submitted_tasks_come_back_with_their_own_results(executor,
+                                                          agent_folders):
+  futures = [executor.submit(executor_tasks.agent_state, task)
+             for task in _tasks(agent_folders, args=("x",))]
+  futures += [executor.submit(executor_tasks.failing_task,
+                              ("fail", {"agent_folder": agent_folders["b"]},
+                               ()))]
+  futures += [executor.submit(executor_tasks.agent_state,
+                              ("missing", {"agent_folder": "/nonexistent"},
+                               ()))]
+  concurrent.futures.wait(futures, timeout=60)
+  results = {future.result()[0]: future.result() for future in futures}
+
+  for name in agent_folders:
+    _, result, error, _, _ = results[name]
+    assert error is None
+    assert (result["first_name"], result["tag"]) == (name, "x")
+  assert results["fail"][2] == "RuntimeError: no answer from b"
+  assert results["missing"][2].startswith("FileNotFoundError")
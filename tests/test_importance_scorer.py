@@ -0,0 +1,120 @@
+import time
+
+import genagents.modules.memory_stream as memory_stream_module
+from genagents.modules.memory_stream import ImportanceScorer, MemoryStream
+
+
+def _fake_importance(monkeypatch, responses):
+  # <responses> maps the list of contents to the scores to return; None
+  # stands for a failed request (the fail-safe scores come back).
+  calls = []
+  def run_gpt_generate_importance(records, prompt_version="1"):
+    calls.append(list(records))
+    fail_safe = [25] * len(records)
+    scores = responses(list(records), len(calls))
+    if scores is None:
+      scores = fail_safe
+    return scores, [scores, "prompt", records, fail_safe]
+  monkeypatch.setattr(memory_stream_module, "run_gpt_generate_importance",
+                      run_gpt_generate_importance)
+  return calls
+
+
+def _stream_with(contents, provisional=10):
+  memory_stream = MemoryStream([], dict())
+  memory_stream.reflection_scheduler = None
+  nodes = [memory_stream._add_node(0, "observation", content, provisional,
+                                   None, embedding=[1.0, 0.0])
+           for content in contents]
+  memory_stream.dirty_node_ids = dict()
+  return memory_stream, nodes
+
+
+def _wait_for(condition, timeout=5.0):
+  end = time.time() + timeout
+  while not condition():
+    assert time.time() < end
+    time.sleep(0.01)
+
+
+def test_provisional_scores_are_replaced(monkeypatch):
+  _fake_importance(monkeypatch, lambda records, _: [50 + i for i in
+                                                     range(len(records))])
+  memory_stream, nodes = _stream_with(["a", "b", "c"])
+  version = memory_stream.version
+  scorer = ImportanceScorer(batch_size=2, flush_seconds=0.05)
+  for node in nodes:
+    scorer.submit(memory_stream, node)
+
+  assert scorer.flush(timeout=5)
+  assert [node.importance for node in nodes] == [50, 51, 50]
+  # The new scores are journaled and invalidate the memoized answers.
+  assert set(memory_stream.dirty_node_ids) == {0, 1, 2}
+  assert memory_stream.version > version
+  stats = scorer.stats()
+  assert (stats["scored"], stats["batches"], stats["pending"]) == (3, 2, 0)
+  assert stats["drift_max"] == 41
+  assert memory_stream.importance_since_reflection == 50 + 51 + 50
+
+
+def test_failed_batch_is_retried(monkeypatch):
+  calls = _fake_importance(monkeypatch, lambda records, count: (
+    None if count == 1 else [70] * len(records)))
+  memory_stream, nodes = _stream_with(["a", "b"])
+  scorer = ImportanceScorer(batch_size=2, flush_seconds=0.05,
+                            backoff_seconds=0.01)
+  for node in nodes:
+    scorer.submit(memory_stream, node)
+
+  assert scorer.flush(timeout=5)
+  assert [node.importance for node in nodes] == [70, 70]
+  assert len(calls) == 2
+  stats = scorer.stats()
+  assert (stats["retries"], stats["scored"], stats["unscored"]) == (2, 2, 0)
+
+
+def test_nodes_left_out_of_response_are_retried(monkeypatch):
+  calls = _fake_importance(monkeypatch, lambda records, _: [60])
+  memory_stream, nodes = _stream_with(["a", "b"])
+  scorer = ImportanceScorer(batch_size=2, flush_seconds=0.05,
+                            backoff_seconds=0.01)
+  for node in nodes:
+    scorer.submit(memory_stream, node)
+
+  assert scorer.flush(timeout=5)
+  assert [node.importance for node in nodes] == [60, 60]
+  assert calls == [["a", "b"], ["b"]]
+
+
+def test_fail_safe_keeps_provisional_after_max_attempts(monkeypatch):
+  calls = _fake_importance(monkeypatch, lambda records, _: None)
+  memory_stream, nodes = _stream_with(["a"], provisional=33)
+  scorer = ImportanceScorer(batch_size=1, flush_seconds=0.05,
+                            max_attempts=3, backoff_seconds=0.01)
+  scorer.submit(memory_stream, nodes[0])
+
+  assert scorer.flush(timeout=5)
+  # The fail-safe scores are never stored as the node's importance.
+  assert nodes[0].importance == 33
+  assert memory_stream.dirty_node_ids == dict()
+  assert len(calls) == 3
+  stats = scorer.stats()
+  assert (stats["retries"], stats["unscored"], stats["scored"]) == (2, 1, 0)
+
+
+def test_backoff_does_not_hold_up_other_nodes(monkeypatch):
+  _fake_importance(monkeypatch, lambda records, _: (
+    None if "bad" in records else [80] * len(records)))
+  memory_stream, nodes = _stream_with(["bad", "good"])
+  scorer = ImportanceScorer(batch_size=1, flush_seconds=0.05,
+                            backoff_seconds=30.0)
+  scorer.submit(memory_stream, nodes[0])
+  _wait_for(lambda: scorer.stats()["retries"] == 1)
+
+  start = time.time()
+  scorer.submit(memory_stream, nodes[1])
+  _wait_for(lambda: nodes[1].importance == 80)
+  assert time.time() - start < 5
+  # The failed node waits out its backoff in the queue.
+  assert nodes[0].importance == 10
+  assert scorer.pending() == 1
@@ -0,0 +1,170 @@
+import math
+import time
+import threading
+
+from genagents.modules.interaction import (ask_in_chunks, repair_answers,
+                                           validate_ask_answer,
+                                           validate_categorical_answer,
+                                           validate_numerical_answer)
+from simulation_engine.llm_router import current_escalation
+from simulation_engine.scheduler import current_priority, llm_priority
+
+
+QUESTIONS = {"Q1": ["Yes", "No"], "Q2": ["Agree", "Disagree"],
+             "Q3": ["Red", "Blue", "Green"]}
+
+
+def _output(responses):
+  return {"responses": list(responses),
+          "reasonings": [f"because {i}" for i in responses]}
+
+
+def test_validate_categorical_answer():
+  options = ["Yes", "No", 3]
+  assert validate_categorical_answer("Yes", options) == "Yes"
+  assert validate_categorical_answer("  yes ", options) == "Yes"
+  assert validate_categorical_answer(3, options) == "3"
+  assert validate_categorical_answer("Maybe", options) is None
+  assert validate_categorical_answer(None, options) is None
+
+
+def test_validate_numerical_answer():
+  assert validate_numerical_answer("7", [1, 10]) == 7
+  assert validate_numerical_answer(6.6, [1, 10]) == 7
+  assert validate_numerical_answer(6.6, [1, 10], float_resp=True) == 6.6
+  # The scale may be given high to low.
+  assert validate_numerical_answer(1, [10, 1]) == 1
+  assert validate_numerical_answer(0, [1, 10]) is None
+  assert validate_numerical_answer(10.5, [1, 10]) is None
+  assert validate_numerical_answer("seven", [1, 10]) is None
+  assert validate_numerical_answer(None, [1, 10]) is None
+  assert validate_numerical_answer(math.nan, [1, 10]) is None
+  # Without a two-sided scale any number goes.
+  assert validate_numerical_answer(1000, []) == 1000
+
+
+def test_validate_ask_answer():
+  categorical = {"response-type": "categorical",
+                 "response-options": ["Yes", "No"]}
+  numeric = {"response-type": "float", "response-scale": [0, 1]}
+  open_question = {"response-type": "open", "response-char-limit": 5}
+  assert validate_ask_answer("no", categorical) == "No"
+  assert validate_ask_answer("Perhaps", categorical) is None
+  assert validate_ask_answer(0.25, numeric) == 0.25
+  assert validate_ask_answer(2, numeric) is None
+  assert validate_ask_answer("  long answer ", open_question) == "long "
+  assert validate_ask_answer("   ", open_question) is None
+
+
+def test_only_invalid_answers_are_reasked():
+  reasks = []
+  def reask(sub_questions):
+    reasks.append((list(sub_questions), current_escalation()))
+    return _output(["Disagree" if "Q2" == q else "Blue"
+                    for q in sub_questions])
+
+  output = repair_answers(QUESTIONS, _output(["yes", "Maybe", "Purple"]),
+                          validate_categorical_answer, reask)
+  assert output["responses"] == ["Yes", "Disagree", "Blue"]
+  assert output["reasonings"] == ["because yes", "because Disagree",
+                                  "because Blue"]
+  assert output["repairs"] == {"invalid": 2, "repaired": 2, "reasks": 1}
+  # The re-ask goes one step up the model cascade.
+  assert reasks == [(["Q2", "Q3"], 1)]
+
+
+def test_each_round_escalates_further():
+  rounds = []
+  def reask(sub_questions):
+    rounds.append((list(sub_questions), current_escalation()))
+    if len(rounds) == 1:
+      return _output(["Agree", "Purple"])
+    return _output(["Red"])
+
+  output = repair_answers(QUESTIONS, _output(["Yes", None, "Purple"]),
+                          validate_categorical_answer, reask, max_rounds=3)
+  assert output["responses"] == ["Yes", "Agree", "Red"]
+  assert rounds == [(["Q2", "Q3"], 1), (["Q3"], 2)]
+  assert output["repairs"] == {"invalid": 2, "repaired": 2, "reasks": 2}
+  assert current_escalation() == 0
+
+
+def test_unrepaired_answers_are_none():
+  questions = {"Age": [18, 99], "Score": [1, 5]}
+  def reask(sub_questions):
+    return None if len(sub_questions) == 2 else _output([120])
+
+  output = repair_answers(questions, None, validate_numerical_answer, reask,
+                          max_rounds=2)
+  assert output["responses"] == [None, None]
+  assert output["repairs"] == {"invalid": 2, "repaired": 0, "reasks": 2}
+
+  output = repair_answers(questions, _output([150, 3]),
+                          validate_numerical_answer, lambda q: _output([-1]),
+                          max_rounds=2)
+  assert output["responses"] == [None, 3]
+  assert output["repairs"] == {"invalid": 1, "repaired": 0, "reasks": 2}
+
+
+def test_valid_output_needs_no_reask():
+  def reask(sub_questions):
+    raise AssertionError("nothing to re-ask")
+  output = repair_answers(QUESTIONS, _output(["No", "Agree", "Green"]),
+                          validate_categorical_answer, reask)
+  assert output["responses"] == ["No", "Agree", "Green"]
+  assert output["repairs"] == {"invalid": 0, "repaired": 0, "reasks": 0}
+
+
+def test_chunks_merge_back_in_question_order():
+  questions = {f"Q{i}": ["Yes", "No"] for i in range(7)}
+  asked = []
+  def ask(sub_questions):
+    asked.append(list(sub_questions))
+    # Later chunks finish first.
+    time.sleep(0.05 / len(asked))
+    return _output([f"A{q[1:]}" for q in sub_questions])
+
+  output = ask_in_chunks(questions, ask, chunk_size=3)
+  assert sorted(asked) == [["Q0", "Q1", "Q2"], ["Q3", "Q4", "Q5"], ["Q6"]]
+  assert output["responses"] == [f"A{i}" for i in range(7)]
+  assert output["reasonings"] == [f"because A{i}" for i in range(7)]
+
+
+def test_failed_chunk_leaves_its_questions_unanswered():
+  questions = {f"Q{i}": ["Yes", "No"] for i in range(4)}
+  def ask(sub_questions):
+    if "Q2" in sub_questions:
+      return None
+    return _output(["Yes"] * len(sub_questions))
+
+  output = ask_in_chunks(questions, ask, chunk_size=2)
+  assert output["responses"] == ["Yes", "Yes", None, None]
+
+
+def test_chunks_share_the_pool_and_the_caller_context():
+  questions = {f"Q{i}": ["Yes", "No"] for i in range(6)}
+  seen = []
+  def ask(sub_questions):
+    seen.append((threading.current_thread().name, current_priority()))
+    return _output(["Yes"] * len(sub_questions))
+
+  with llm_priority("interactive"):
+    ask_in_chunks(questions, ask, chunk_size=2)
+    ask_in_chunks(questions, ask, chunk_size=2)
+
+  assert all(priority == "interactive" for _, priority in seen)
+  names = [name for name, _ in seen]
+  assert names.count(threading.current_thread().name) == 2
+  assert all(name.startswith("questionnaire-chunk") for name in names
+             if name != threading.current_thread().name)
+
+
+def test_small_questionnaire_is_one_prompt():
+  calls = []
+  def ask(sub_questions):
+    calls.append(list(sub_questions))
+    return _output(["Yes"] * len(sub_questions))
+
+  ask_in_chunks(QUESTIONS, ask, chunk_size=3)
+  ask_in_chunks(QUESTIONS, ask, chunk_size=None)
+  assert calls == [list(QUESTIONS), list(QUESTIONS)]
@@ -0,0 +1,152 @@
+import threading
+
+from environment.checkpoint import JsonlCheckpoint, wave_key
+from environment.interview.interview import Interview
+
+
+SCRIPT = [["Where did you grow up?", 1], ["What do you do?", 1],
+          ["Any plans?", 1]]
+
+
+class _Agent:
+  # Answers turn k with "<name> k" and records every dialogue it was given.
+  # <gates> holds an Event per turn that the turn waits for.
+  def __init__(self, name, gates=None):
+    self.name = name
+    self.gates = gates or dict()
+    self.dialogues = []
+
+  def get_fullname(self):
+    return self.name
+
+  def utterance(self, dialogue, context):
+    turn = (len(dialogue) - 1) // 2
+    self.dialogues += [dialogue]
+    if turn in self.gates:
+      assert self.gates[turn].wait(timeout=5)
+    return f"{self.name} {turn}"
+
+
+class _Pool:
+  def __init__(self, agents):
+    self.agents = agents
+
+  def get(self, agent_meta):
+    return self.agents[agent_meta["name"]]
+
+
+def _interview(agents, responses=None):
+  interview = Interview(agent_pool=_Pool(agents))
+  interview.agent_registry = {name: {"name": name} for name in agents}
+  if responses is not None:
+    interview.responses = responses
+  return interview
+
+
+def _turns(name, count):
+  dialogue = []
+  for turn in range(count):
+    dialogue += [["Interviewer", SCRIPT[turn][0]], [name, f"{name} {turn}"]]
+  return dialogue
+
+
+def _record(key, name, turn):
+  return {"wave": key, "agent_pid": name, "turn": turn,
+          "question": SCRIPT[turn][0], "speaker": name,
+          "response": f"{name} {turn}"}
+
+
+def test_agents_do_not_wait_for_each_other():
+  # a is held on its first turn until b has answered its last one; with a
+  # barrier per turn the run could never finish.
+  done = threading.Event()
+  agents = {"a": _Agent("a", {0: done}), "b": _Agent("b")}
+  order = []
+  def on_turn(agent_pid, turn, question, response):
+    order.append((agent_pid, turn))
+    if (agent_pid, turn) == ("b", 2):
+      done.set()
+
+  interview = _interview(agents)
+  responses = interview.interview(SCRIPT, "", num_threads=2, on_turn=on_turn)
+  assert order == [("b", 0), ("b", 1), ("b", 2), ("a", 0), ("a", 1),
+                   ("a", 2)]
+  assert responses == {"a": _turns("a", 3), "b": _turns("b", 3)}
+  assert interview.last_run["done"] == 6
+
+
+def test_resume_continues_each_agent_from_its_checkpoint(tmp_path):
+  checkpoint_path = str(tmp_path / "interview.jsonl")
+  key = wave_key([SCRIPT, ""])
+  checkpoint = JsonlCheckpoint(checkpoint_path)
+  for record in [_record(key, "a", 0), _record(key, "b", 1),
+                 _record(key, "b", 0), _record("other", "a", 1),
+                 _record(key, "c", 2), _record(key, "gone", 0)]:
+    checkpoint.append(record)
+  checkpoint.close()
+
+  agents = {"a": _Agent("a"), "b": _Agent("b"), "c": _Agent("c")}
+  interview = _interview(agents)
+  responses = interview.interview(SCRIPT, "", checkpoint_path=checkpoint_path)
+
+  # a resumes after turn 0 and b after turn 1; c's turn 2 has no turns 0-1
+  # before it and the other wave's record does not count.
+  assert [len(i.dialogues) for i in agents.values()] == [2, 1, 3]
+  assert agents["b"].dialogues[0] == _turns("b", 2) + [
+    ["Interviewer", SCRIPT[2][0]]]
+  assert responses == {name: _turns(name, 3) for name in agents}
+  assert interview.last_run["skipped"] == 3
+  assert interview.last_run["done"] == 6
+
+  # Every turn is now checkpointed: a second resume asks nothing.
+  for agent in agents.values():
+    agent.dialogues = []
+  _interview(agents).interview(SCRIPT, "", checkpoint_path=checkpoint_path)
+  assert all(agent.dialogues == [] for agent in agents.values())
+
+  # A changed script starts over.
+  changed = SCRIPT[:2]
+  _interview(agents).interview(changed, "", checkpoint_path=checkpoint_path)
+  assert [len(i.dialogues) for i in agents.values()] == [2, 2, 2]
+
+
+def test_resumed_turns_are_not_recorded_twice(tmp_path):
+  checkpoint_path = str(tmp_path / "interview.jsonl")
+  key = wave_key([SCRIPT, ""])
+  checkpoint = JsonlCheckpoint(checkpoint_path)
+  for record in [_record(key, "a", 0), _record(key, "a", 1)]:
+    checkpoint.append(record)
+  checkpoint.close()
+
+  # The earlier run, cut off after two turns, already recorded them.
+  agents = {"a": _Agent("a"), "b": _Agent("b")}
+  earlier = {"a": _turns("a", 2)}
+  interview = _interview(agents, responses=earlier)
+  responses = interview.interview(SCRIPT, "", checkpoint_path=checkpoint_path)
+  assert responses == {"a": _turns("a", 3), "b": _turns("b", 3)}
+
+  # A fresh environment has not recorded them: they are added back.
+  responses = _interview(agents).interview(
+    SCRIPT, "", checkpoint_path=checkpoint_path)
+  assert responses == {"a": _turns("a", 3), "b": _turns("b", 3)}
+
+  # An earlier interview before the resumed one is kept in front of it.
+  earlier = {"a": _turns("x", 1) + _turns("a", 3)}
+  responses = _interview(agents, responses=earlier).interview(
+    SCRIPT, "", checkpoint_path=checkpoint_path, resume=False)
+  assert responses["a"] == _turns("x", 1) + _turns("a", 3) + _turns("a", 3)
+
+
+def test_failed_agent_stops_but_others_finish():
+  class _Failing(_Agent):
+    def utterance(self, dialogue, context):
+      if len(dialogue) > 1:
+        raise RuntimeError("no answer")
+      return super().utterance(dialogue, context)
+
+  agents = {"a": _Failing("a"), "b": _Agent("b")}
+  interview = _interview(agents)
+  responses = interview.interview(SCRIPT, "")
+  assert responses == {"a": _turns("a", 1), "b": _turns("b", 3)}
+  assert list(interview.last_run["failures"]) == ["a"]
+  assert interview.last_run["failed"] == 2
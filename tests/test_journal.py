@@ -0,0 +1,171 @@
+import os
+import json
+
+from genagents.genagents import GenerativeAgent
+from genagents.modules.journal import AgentJournal, read_scratch
+from genagents.modules.memory_stream import ConceptNode
+
+
+def _node(node_id, content, node_type="observation", pointer_id=None):
+  return {"node_id": node_id, "node_type": node_type, "content": content,
+          "importance": 10, "created": node_id, "last_retrieved": node_id,
+          "pointer_id": pointer_id}
+
+
+def _agent(nodes, embeddings):
+  return GenerativeAgent.from_state({"first_name": "Ada"}, nodes, embeddings)
+
+
+def _load(agent_folder):
+  agent = GenerativeAgent(agent_folder)
+  return agent, [node.package() for node in agent.memory_stream.seq_nodes]
+
+
+def test_journal_replays_over_snapshot(tmp_path):
+  folder = str(tmp_path / "agent")
+  agent = _agent([_node(0, "a")], {"a": [1.0, 0.0]})
+  agent.save(folder)
+
+  agent.memory_stream.id_to_node[0].importance = 50
+  agent.memory_stream.mark_dirty(0)
+  new_node = ConceptNode(_node(1, "b"))
+  agent.memory_stream.seq_nodes += [new_node]
+  agent.memory_stream.id_to_node[1] = new_node
+  agent.memory_stream.embeddings["b"] = [0.0, 1.0]
+  agent.memory_stream.mark_dirty(1)
+  agent.update_scratch({"age": 30})
+  agent.save(folder)
+
+  assert os.path.exists(f"{folder}/memory_stream/journal.jsonl")
+  with open(f"{folder}/memory_stream/nodes.json") as f:
+    assert len(json.load(f)) == 1
+
+  loaded, nodes = _load(folder)
+  assert [node["node_id"] for node in nodes] == [0, 1]
+  assert nodes[0]["importance"] == 50
+  assert loaded.scratch["age"] == 30
+  assert loaded.memory_stream.embeddings["b"] == [0.0, 1.0]
+
+
+def test_partial_trailing_line_is_dropped(tmp_path):
+  folder = str(tmp_path / "agent")
+  agent = _agent([_node(0, "a")], {"a": [1.0, 0.0]})
+  agent.save(folder)
+  agent.update_scratch({"age": 30})
+  agent.save(folder, sync=True)
+
+  with open(f"{folder}/memory_stream/journal.jsonl", "a") as f:
+    f.write('{"op": "scratch", "scratch": {"age"')
+
+  journal = AgentJournal(folder)
+  records = journal.read_records()
+  assert len(records) == 1
+  assert journal.entry_count == 1
+  loaded, _ = _load(folder)
+  assert loaded.scratch["age"] == 30
+
+
+def test_read_scratch_takes_latest_journal_record(tmp_path):
+  folder = str(tmp_path / "agent")
+  agent = _agent([_node(0, "a")], {"a": [1.0, 0.0]})
+  agent.save(folder)
+  agent.update_scratch({"age": 30})
+  agent.save(folder)
+  agent.update_scratch({"age": 31})
+  agent.save(folder, sync=True)
+  assert read_scratch(folder)["age"] == 31
+
+
+def test_archive_records_replay_after_compact(tmp_path):
+  folder = str(tmp_path / "agent")
+  nodes = [_node(0, "a"), _node(1, "a again"), _node(2, "b"),
+           _node(3, "reflection", "reflection", pointer_id=[0, 2])]
+  embeddings = {"a": [1.0, 0.0], "a again": [1.0, 0.0], "b": [0.0, 1.0],
+                "reflection": [0.5, 0.5]}
+  agent = _agent(nodes, embeddings)
+  agent.save(folder)
+
+  report = agent.compact_memories(incremental=False)
+  assert report["removed"] == 1
+  agent.save(folder)
+
+  loaded, nodes = _load(folder)
+  assert [node["node_id"] for node in nodes] == [1, 2, 3]
+  assert nodes[-1]["pointer_id"] == [1, 2]
+  assert "a" not in loaded.memory_stream.embeddings
+  assert loaded.memory_stream.compacted_through == 3
+  archive = loaded.journal.read_archive()
+  assert archive[0]["merged_into"] == 1
+
+
+def test_snapshot_crash_window_keeps_journal_harmless(tmp_path):
+  # A crash after the snapshot files are replaced but before the journal is
+  # removed replays records that are already in the snapshot.
+  folder = str(tmp_path / "agent")
+  agent = _agent([_node(0, "a")], {"a": [1.0, 0.0]})
+  agent.save(folder)
+  agent.memory_stream.id_to_node[0].importance = 70
+  agent.memory_stream.mark_dirty(0)
+  agent.update_scratch({"age": 30})
+  agent.save(folder, sync=True)
+
+  journal_path = f"{folder}/memory_stream/journal.jsonl"
+  with open(journal_path) as f:
+    journal = f.read()
+  agent.compact()
+  assert not os.path.exists(journal_path)
+  with open(journal_path, "w") as f:
+    f.write(journal)
+
+  loaded, nodes = _load(folder)
+  assert len(nodes) == 1
+  assert nodes[0]["importance"] == 70
+  assert loaded.scratch["age"] == 30
+
+
+def test_id_is_stable_across_reloads(tmp_path):
+  folder = str(tmp_path / "agent")
+  agent = _agent([_node(0, "a")], {"a": [1.0, 0.0]})
+  agent.save(folder)
+  assert GenerativeAgent(folder).id == agent.id
+  assert GenerativeAgent(folder).id == agent.id
+
+  # A folder without meta.json gets its id written on the next save.
+  os.remove(f"{folder}/meta.json")
+  loaded = GenerativeAgent(folder)
+  loaded.update_scratch({"age": 30})
+  loaded.save(folder)
+  assert os.path.exists(f"{folder}/memory_stream/journal.jsonl")
+  assert GenerativeAgent(folder).id == loaded.id
+
+
+def test_read_scratch_parses_any_record_layout(tmp_path):
+  folder = str(tmp_path / "agent")
+  agent = _agent([_node(0, "a")], {"a": [1.0, 0.0]})
+  agent.save(folder)
+
+  # Records written with other key orders or separators, and node records
+  # whose content mentions a scratch op, are told apart by parsing.
+  records = [
+    json.dumps({"scratch": {"age": 30}, "op": "scratch"}),
+    json.dumps({"op": "scratch", "scratch": {"age": 31}},
+               separators=(",", ":")),
+    json.dumps({"op": "node",
+                "node": _node(1, '{"op": "scratch", "scratch": {"age": 99}}')}),
+    '{"content": "\\"op\\": \\"scratch\\"", "op": "node"}',
+  ]
+  with open(f"{folder}/memory_stream/journal.jsonl", "a") as f:
+    f.write("\n".join(records) + "\n")
+  assert read_scratch(folder)["age"] == 31
+
+  with open(f"{folder}/memory_stream/journal.jsonl", "a") as f:
+    f.write(json.dumps({"scratch": {"age": 32}, "op": "scratch"}) + "\n")
+    f.write('{"op":"scratch","scratch":{"age"')
+  assert read_scratch(folder)["age"] == 32
+
+
+def test_read_scratch_without_journal(tmp_path):
+  folder = str(tmp_path / "agent")
+  _agent([_node(0, "a")], {"a": [1.0, 0.0]}).save(folder)
+  assert not os.path.exists(f"{folder}/memory_stream/journal.jsonl")
+  assert read_scratch(folder) == {"first_name": "Ada"}
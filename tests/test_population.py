@@ -0,0 +1,96 @@
+import os
+
+import pytest
+
+from genagents.genagents import GenerativeAgent
+from genagents.population import Population, discover_agent_folders
+
+
+AGES = {"p0": 25, "p1": 34, "p2": 41, "p3": 52, "p4": 67}
+
+
+def _node(node_id, content):
+  return {"node_id": node_id, "node_type": "observation", "content": content,
+          "importance": 10, "created": node_id, "last_retrieved": node_id,
+          "pointer_id": None}
+
+
+@pytest.fixture
+def population_dir(tmp_path):
+  for count, (agent_id, age) in enumerate(AGES.items()):
+    scratch = {"first_name": agent_id, "age": age,
+               "sex": "Female" if count % 2 else "Male"}
+    agent = GenerativeAgent.from_state(
+      scratch, [_node(0, f"{agent_id} memory")],
+      {f"{agent_id} memory": [1.0, float(count)]})
+    agent.save(str(tmp_path / agent_id))
+  # Folders without a scratch.json are not agents.
+  os.makedirs(tmp_path / "not_an_agent")
+  return str(tmp_path)
+
+
+def test_discover_finds_agent_folders(population_dir, tmp_path):
+  agent_folders = discover_agent_folders(population_dir)
+  assert list(agent_folders) == sorted(AGES)
+  assert agent_folders["p0"] == f"{population_dir}/p0"
+  assert discover_agent_folders(str(tmp_path / "missing")) == dict()
+
+
+@pytest.mark.parametrize("num_workers", [1, 2])
+def test_load_rebuilds_every_agent(population_dir, num_workers):
+  population = Population(population_dir=population_dir,
+                          num_workers=num_workers)
+  assert len(population) == len(AGES)
+  population.load(verbose=False)
+
+  assert set(population.agents) == set(AGES)
+  for agent_id, age in AGES.items():
+    agent = population.agents[agent_id]
+    assert agent.scratch["age"] == age
+    assert agent.memory_stream.seq_nodes[0].content == f"{agent_id} memory"
+  assert population.load_stats["agents"] == len(AGES)
+  assert population.load_stats["bytes"] > 0
+
+  # Loaded agents are not loaded again.
+  population.load(verbose=False)
+  assert population.load_stats["agents"] == len(AGES)
+
+
+def test_getitem_loads_on_first_access(population_dir):
+  population = Population(population_dir=population_dir, num_workers=1)
+  agent = population["p2"]
+  assert agent.scratch["age"] == 41
+  assert population["p2"] is agent
+  assert list(population.agents) == ["p2"]
+  with pytest.raises(KeyError):
+    population["missing"]
+
+
+@pytest.mark.parametrize("num_workers", [1, 2])
+def test_stream_yields_agents_in_order_without_keeping_them(population_dir,
+                                                            num_workers):
+  population = Population(population_dir=population_dir,
+                          num_workers=num_workers)
+  streamed = [(agent_id, agent.scratch["age"])
+              for agent_id, agent in population.stream(batch_size=2)]
+  assert streamed == list(AGES.items())
+  assert population.agents == dict()
+  assert set(population.scratches) == set(AGES)
+
+
+def test_filter_reads_scratches_only(population_dir):
+  # The latest scratch is read from the journal, not just the snapshot.
+  agent = GenerativeAgent(f"{population_dir}/p4")
+  agent.update_scratch({"age": 18})
+  agent.save(f"{population_dir}/p4")
+
+  population = Population(population_dir=population_dir, num_workers=1)
+  population.load(["p0"], verbose=False)
+  subset = population.filter({"sex": ["Male"],
+                              "age": lambda age: int(age) < 30})
+  assert subset.ids() == ["p0", "p4"]
+  assert subset.agents == {"p0": population.agents["p0"]}
+  assert "p2" not in subset
+
+  assert population.filter({"sex": "Female"}).ids() == ["p1", "p3"]
+  assert population.filter({"missing": 1}).ids() == []
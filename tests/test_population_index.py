@@ -0,0 +1,86 @@
+import numpy as np
+
+import genagents.modules.memory_stream as memory_stream_module
+from genagents.genagents import GenerativeAgent
+from genagents.population_index import PopulationEmbeddingIndex, top_rows
+
+
+def _agent(seed, num_nodes=30):
+  rng = np.random.default_rng(seed)
+  nodes = []
+  embeddings = dict()
+  for node_id in range(num_nodes):
+    content = f"memory {seed}-{node_id}"
+    nodes += [{"node_id": node_id,
+               "node_type": "reflection" if node_id % 4 == 3 else "observation",
+               "content": content,
+               "importance": int(rng.integers(0, 100)),
+               "created": node_id,
+               "last_retrieved": int(rng.integers(0, num_nodes)),
+               "pointer_id": None}]
+    embeddings[content] = rng.normal(size=8).tolist()
+  return GenerativeAgent.from_state({"first_name": f"Agent {seed}"}, nodes,
+                                    embeddings)
+
+
+def _ids(nodes):
+  return [node.node_id for node in nodes]
+
+
+def test_index_ranks_like_memory_stream(monkeypatch):
+  focal_embedding = np.random.default_rng(99).normal(size=8).tolist()
+  monkeypatch.setattr(memory_stream_module, "get_text_embedding",
+                      lambda text: focal_embedding)
+  agents = {f"a{seed}": _agent(seed, num_nodes=10 + 10 * seed)
+            for seed in range(4)}
+
+  for curr_filter in ["all", "observation", "reflection"]:
+    for hp in [[0, 1, 0.5], [1, 1, 1]]:
+      index = PopulationEmbeddingIndex(agents, curr_filter)
+      retrieved = index.retrieve("focal", n_count=12, hp=hp,
+                                 focal_embedding=focal_embedding)
+      for agent_id, agent in agents.items():
+        expected = agent.memory_stream.retrieve(
+          ["focal"], 0, n_count=12, curr_filter=curr_filter, hp=hp)["focal"]
+        assert _ids(retrieved[agent_id]) == _ids(expected)
+
+
+def test_top_rows_breaks_ties_like_stable_sort():
+  scores = np.array([0.5, 0.9, 0.5, 0.1, 0.5, 0.9])
+  assert sorted(top_rows(scores, 3)) == [0, 1, 5]
+  assert sorted(top_rows(scores, 4)) == [0, 1, 2, 5]
+  assert sorted(top_rows(scores, 10)) == [0, 1, 2, 3, 4, 5]
+  assert len(top_rows(scores, 0)) == 0
+
+
+def test_unchanged_agents_reuse_their_segments():
+  agents = {"a": _agent(1), "b": _agent(2)}
+  first = PopulationEmbeddingIndex(agents)
+  assert (first.segments_built, first.segments_reused) == (2, 0)
+
+  second = PopulationEmbeddingIndex(agents)
+  assert (second.segments_built, second.segments_reused) == (0, 2)
+  assert np.array_equal(first.matrix, second.matrix)
+
+  # A changed memory stream is indexed again, with the new values.
+  memory_stream = agents["b"].memory_stream
+  memory_stream.id_to_node[0].importance = 1000
+  memory_stream.mark_dirty(0)
+  third = PopulationEmbeddingIndex(agents)
+  assert (third.segments_built, third.segments_reused) == (1, 1)
+  assert third.importance_out[third.seg_starts[1]] == 1.0
+
+  # Each node type filter has a segment of its own.
+  observations = PopulationEmbeddingIndex(agents, "observation")
+  assert observations.segments_built == 2
+  assert all(node.node_type == "observation"
+             for node in observations.nodes["a"])
+
+
+def test_agents_without_nodes_retrieve_nothing():
+  agents = {"empty": GenerativeAgent.from_state({}, [], {}), "a": _agent(1)}
+  index = PopulationEmbeddingIndex(agents)
+  assert index.agent_ids == ["a"]
+  retrieved = index.retrieve("focal", n_count=5, focal_embedding=[1.0] * 8)
+  assert retrieved["empty"] == []
+  assert len(retrieved["a"]) == 5
@@ -0,0 +1,101 @@
+import threading
+from types import SimpleNamespace
+
+from genagents.modules.memory_stream import ReflectionScheduler
+
+
+class _Stream:
+  # The parts of a MemoryStream the scheduler touches. reflect() blocks until
+  # <release> is set so tests can look at the queue while a batch runs.
+  def __init__(self, contents, release=None):
+    self._nodes_lock = threading.Lock()
+    self.seq_nodes = [SimpleNamespace(node_type="observation", content=content,
+                                      created=i)
+                      for i, content in enumerate(contents)]
+    self.release = release
+    self.reflections = []
+    self.compactions = 0
+    self.threads = set()
+
+  def reflect(self, anchor, reflection_count, time_step=0):
+    self.threads.add(threading.current_thread().name)
+    if self.release is not None:
+      assert self.release.wait(timeout=5)
+    self.reflections += [(anchor, reflection_count, time_step)]
+
+  def compact(self, measure=True):
+    self.compactions += 1
+    return {"removed": 2}
+
+
+def test_queued_stream_is_enqueued_once_per_job():
+  release = threading.Event()
+  scheduler = ReflectionScheduler(batch_size=1, reflection_count=2,
+                                  anchor_nodes=2)
+  busy = _Stream(["x"], release)
+  stream = _Stream(["a", "b", "c"])
+  # <busy> holds the worker so <stream> stays in the queue.
+  scheduler.enqueue(busy)
+  scheduler.enqueue(stream)
+  scheduler.enqueue(stream)
+  scheduler.enqueue(stream, job="compact")
+  scheduler.enqueue(stream, job="compact")
+  assert scheduler.stats()["enqueued"] == 3
+  assert scheduler.pending() == 3
+
+  release.set()
+  assert scheduler.flush(timeout=5)
+  assert stream.reflections == [("b c", 2, 2)]
+  assert stream.compactions == 1
+  stats = scheduler.stats()
+  assert (stats["reflections"], stats["compactions"]) == (2, 1)
+  assert stats["compacted_nodes"] == 2
+  assert stats["pending"] == 0
+
+  # Once run, the stream can be queued again.
+  scheduler.enqueue(stream)
+  assert scheduler.flush(timeout=5)
+  assert len(stream.reflections) == 2
+
+
+def test_flush_waits_for_the_running_batch():
+  release = threading.Event()
+  scheduler = ReflectionScheduler(batch_size=4)
+  streams = [_Stream(["a"], release) for _ in range(6)]
+  for memory_stream in streams:
+    scheduler.enqueue(memory_stream)
+  assert not scheduler.flush(timeout=0.05)
+  assert scheduler.pending() == 6
+
+  release.set()
+  assert scheduler.flush(timeout=5)
+  assert all(len(i.reflections) == 1 for i in streams)
+  assert scheduler.stats()["batches"] == 2
+  # Nothing queued: flush returns at once.
+  assert scheduler.flush(timeout=0)
+
+
+def test_batches_share_one_pool():
+  scheduler = ReflectionScheduler(batch_size=2)
+  streams = [_Stream(["a"]) for _ in range(6)]
+  for memory_stream in streams:
+    scheduler.enqueue(memory_stream)
+    assert scheduler.flush(timeout=5)
+  names = set().union(*(i.threads for i in streams))
+  assert all(name.startswith("reflection-job") for name in names)
+  assert len(names) <= 2
+
+
+def test_failures_and_empty_streams():
+  class _Failing(_Stream):
+    def reflect(self, anchor, reflection_count, time_step=0):
+      raise RuntimeError("no reflection")
+
+  scheduler = ReflectionScheduler()
+  empty = _Stream([])
+  scheduler.enqueue(_Failing(["a"]))
+  scheduler.enqueue(empty)
+  assert scheduler.flush(timeout=5)
+  stats = scheduler.stats()
+  assert (stats["failures"], stats["reflections"]) == (1, 0)
+  assert empty.reflections == []
@@ -0,0 +1,106 @@
+import numpy as np
+import pandas as pd
+
+from environment.survey.response_index import ResponseIndex
+
+
+def _select(index, criteria, namespace="responses"):
+  return index.select(index.mask(criteria, namespace))
+
+
+def test_update_replaces_values_and_adds_agents():
+  index = ResponseIndex()
+  index.update("Q1", ["a", "b", "c"], ["Yes", "No", "Yes"])
+  assert len(index) == 3
+  assert _select(index, {"Q1": "Yes"}) == ["a", "c"]
+
+  # A later wave changes b's answer and adds d.
+  index.update("Q1", ["b", "d"], ["Yes", "No"])
+  assert len(index) == 4
+  assert "d" in index
+  assert _select(index, {"Q1": ["Yes"]}) == ["a", "b", "c"]
+  assert _select(index, {"Q1": "No"}) == ["d"]
+  assert index.values("Q1") == ["Yes", "No"]
+  assert index.field_versions[("responses", "Q1")] == 2
+
+
+def test_missing_values_are_never_selected():
+  index = ResponseIndex()
+  index.update("Q1", ["a", "b", "c", "d"], ["Yes", None, np.nan, "No"])
+  codes, values = index.codes("Q1")
+  assert codes.tolist() == [0, -1, -1, 1]
+  assert values == ["Yes", "No"]
+  assert _select(index, {"Q1": ["Yes", "No"]}) == ["a", "d"]
+  assert _select(index, {"Q1": [None]}) == []
+  # Agents added by another field have no value for this one either.
+  index.update("Q2", ["e"], [3])
+  assert index.codes("Q1")[0].tolist() == [0, -1, -1, 1, -1]
+  assert _select(index, {"Q1": lambda value: True}) == ["a", "d"]
+
+
+def test_criteria_combine_across_fields_and_namespaces():
+  index = ResponseIndex()
+  index.update("Q1", ["a", "b", "c"], ["Yes", "Yes", "No"])
+  index.update("Age", ["a", "b", "c"], [25, 40, 61], namespace="scratch")
+
+  assert _select(index, {"Q1": "Yes", "Unknown": "x"}) == []
+  assert _select(index, {"Age": lambda age: age >= 40}, "scratch") == ["b", "c"]
+  mask = index.mask({"Age": lambda age: age >= 40}, "scratch")
+  assert index.select(index.mask({"Q1": "Yes"}, mask=mask)) == ["b"]
+  assert index.fields() == ["Q1"]
+  assert index.fields("scratch") == ["Age"]
+
+
+def test_numeric_values_match_across_types():
+  index = ResponseIndex()
+  index.update("Q1", ["a", "b", "c", "d"], [1, 1.0, np.int64(2), 2.5])
+  assert index.values("Q1") == [1, 2, 2.5]
+  assert _select(index, {"Q1": 1.0}) == ["a", "b"]
+  assert _select(index, {"Q1": [np.float64(2)]}) == ["c"]
+  assert _select(index, {"Q1": 2.5}) == ["d"]
+
+
+def test_update_frame_indexes_selected_columns():
+  index = ResponseIndex()
+  frame = pd.DataFrame({"agent_pid": ["a", "b"], "Q1": ["Yes", "No"],
+                        "Q2": [3, 4], "Open": ["long text", "more"]})
+  index.update_frame(frame, columns=["Q1", "Q2"])
+  assert index.fields() == ["Q1", "Q2"]
+
+  # Already indexed columns follow later frames even when not listed.
+  index.update_frame(pd.DataFrame({"agent_pid": ["a"], "Q1": ["No"],
+                                   "Open": ["x"]}), columns=[])
+  assert _select(index, {"Q1": "No"}) == ["a", "b"]
+  assert not index.has_field("Open")
+
+  index.update_frame(frame)
+  assert index.has_field("Open")
+  index.update_frame(frame.iloc[0:0])
+  assert len(index) == 2
+
+
+def test_codes_widen_with_many_distinct_values():
+  index = ResponseIndex()
+  agent_pids = [f"agent {i}" for i in range(40000)]
+  index.update("Small", agent_pids[:3], ["x", "y", "z"])
+  assert index.columns[("responses", "Small")].codes.dtype == np.int8
+
+  index.update("Q1", agent_pids[:200], [f"v{i}" for i in range(200)])
+  assert index.columns[("responses", "Q1")].codes.dtype == np.int16
+  index.update("Q1", agent_pids, [f"v{i}" for i in range(40000)])
+  assert index.columns[("responses", "Q1")].codes.dtype == np.int32
+
+  # Widening keeps the earlier codes and the missing markers.
+  assert _select(index, {"Q1": "v150"}) == ["agent 150"]
+  assert _select(index, {"Q1": "v39999"}) == ["agent 39999"]
+  assert index.codes("Small")[0][:4].tolist() == [0, 1, 2, -1]
+
+
+def test_growing_keeps_codes_and_bumps_versions():
+  index = ResponseIndex()
+  index.update("Q1", ["a"], ["Yes"])
+  version = index.field_versions[("responses", "Q1")]
+  index.update("Q2", [f"agent {i}" for i in range(2000)], ["x"] * 2000)
+  assert index.field_versions[("responses", "Q1")] == version + 1
+  assert _select(index, {"Q1": "Yes"}) == ["a"]
+  assert len(index.codes("Q1")[0]) == 2001
@@ -0,0 +1,140 @@
+import math
+
+import numpy as np
+import pytest
+
+from environment.survey.sampling import AdaptiveSampler
+
+
+def _population(sizes):
+  # sizes: dictionary of stratum to its number of agents.
+  agent_pids = []
+  agent_strata = dict()
+  for stratum, size in sizes.items():
+    for i in range(size):
+      agent_pid = f"{stratum}{i}"
+      agent_pids += [agent_pid]
+      agent_strata[agent_pid] = stratum
+  return agent_pids, agent_strata
+
+
+def _sampler(sizes, **kwargs):
+  agent_pids, agent_strata = _population(sizes)
+  params = {"batch_size": 10, "target_margin": 0.1, "confidence": 0.95,
+            "min_sample": 0, "seed": 3}
+  params.update(kwargs)
+  return AdaptiveSampler(agent_pids, agent_strata, ["Q"], **params)
+
+
+def _strata_of(sampler, batch):
+  return [sampler.strata[sampler._agent_strata[i]] for i in batch]
+
+
+def test_batches_follow_proportional_allocation():
+  sampler = _sampler({"A": 600, "B": 300, "C": 100})
+  batch = sampler.next_batch(100)
+  strata = _strata_of(sampler, batch)
+  assert (strata.count("A"), strata.count("B"), strata.count("C")) == (
+    60, 30, 10)
+  assert len(set(batch)) == 100
+  assert sampler.remaining() == 900
+
+
+def test_every_stratum_gets_two_draws_first():
+  sampler = _sampler({"A": 1000, "B": 5, "C": 1})
+  strata = _strata_of(sampler, sampler.next_batch(5))
+  # C has a single agent, so it gets just that one.
+  assert sorted(strata) == ["A", "A", "B", "B", "C"]
+
+
+def test_population_is_exhausted_without_repeats():
+  sampler = _sampler({"A": 7, "B": 3})
+  drawn = []
+  while True:
+    batch = sampler.next_batch(4)
+    if not batch:
+      break
+    drawn += batch
+  assert sorted(drawn) == sorted(_population({"A": 7, "B": 3})[0])
+  assert sampler.remaining() == 0
+
+
+def test_discard_removes_resumed_agents():
+  sampler = _sampler({"A": 5})
+  sampler.discard("A0")
+  sampler.discard("A0")
+  assert sampler.remaining() == 4
+  drawn = sampler.next_batch(10)
+  assert "A0" not in drawn and len(drawn) == 4
+
+
+def test_stratified_estimate_and_fpc_variance():
+  sampler = _sampler({"A": 10, "B": 30})
+  answers = {"A0": "Yes", "A1": "Yes", "A2": "No", "A3": "No",
+             "B0": "Yes", "B1": "No", "B2": "No", "B3": "No", "B4": "No",
+             "B5": "No"}
+  for agent_pid, answer in answers.items():
+    sampler.add(agent_pid, [answer])
+  sampler.add("B6", [None])
+
+  estimates = sampler.estimate("Q")
+  share, margin = estimates["Yes"]
+  p = np.array([2 / 4, 1 / 6])
+  weights = np.array([0.25, 0.75])
+  n = np.array([4, 6])
+  fpc = 1 - n / np.array([10, 30])
+  variance = (weights ** 2 * p * (1 - p) / (n - 1) * fpc).sum()
+  assert share == pytest.approx((weights * p).sum())
+  assert margin == pytest.approx(1.959964 * math.sqrt(variance), rel=1e-5)
+  assert estimates["No"][0] == pytest.approx(1 - share)
+  assert sampler.sampled == 11
+
+
+def test_fully_sampled_stratum_has_no_variance():
+  sampler = _sampler({"A": 3})
+  for agent_pid, answer in [("A0", "Yes"), ("A1", "No"), ("A2", "No")]:
+    sampler.add(agent_pid, [answer])
+  share, margin = sampler.estimate("Q")["Yes"]
+  assert share == pytest.approx(1 / 3)
+  assert margin == 0.0
+
+
+def test_converged_waits_for_every_stratum_and_min_sample():
+  sampler = _sampler({"A": 100, "B": 100}, target_margin=0.3, min_sample=6)
+  assert not sampler.converged()
+  for i in range(6):
+    sampler.add(f"A{i}", ["Yes"])
+  # Every answer is known within the margin in A, but B is unsampled.
+  assert not sampler.converged()
+  sampler.add("B0", ["Yes"])
+  assert not sampler.converged()
+  sampler.add("B1", ["Yes"])
+  assert sampler.converged()
+
+  sampler = _sampler({"A": 100}, target_margin=0.01, min_sample=2)
+  for i in range(10):
+    sampler.add(f"A{i}", ["Yes" if i % 2 else "No"])
+  assert sampler.max_margin() > 0.01
+  assert not sampler.converged()
+
+
+def test_exhausted_small_stratum_does_not_block_convergence():
+  sampler = _sampler({"A": 50, "B": 1}, target_margin=0.5)
+  batch = sampler.next_batch(5)
+  for agent_pid in batch:
+    sampler.add(agent_pid, ["Yes"])
+  assert "B0" in batch
+  assert sampler.converged()
+  summary = sampler.summary(calls_per_agent=3)
+  assert summary["sampled"] == 5
+  assert summary["agents_skipped"] == 46
+  assert summary["llm_calls_saved"] == 138
+
+
+def test_planned_size():
+  sampler = _sampler({"A": 10000}, target_margin=0.05)
+  n0 = (1.959964 / 0.05) ** 2 * 0.25
+  assert sampler.planned_size() == math.ceil(n0 / (1 + (n0 - 1) / 10000))
+  assert _sampler({"A": 50}, target_margin=0.01).planned_size() == 50
+  assert _sampler({"A": 10000}, target_margin=0.5,
+                  min_sample=100).planned_size() == 100
@@ -0,0 +1,112 @@
+import time
+import threading
+
+import pytest
+
+from simulation_engine.concurrency import AdaptiveConcurrencyLimiter
+from simulation_engine.deadline import DeadlineExceeded, deadline
+from simulation_engine.scheduler import LLMScheduler, llm_priority
+
+
+def _scheduler(starvation_seconds=60.0):
+  limiter = AdaptiveConcurrencyLimiter(min_limit=1, max_limit=1,
+                                       initial_limit=1, cooldown=0.0)
+  return LLMScheduler(limiter, weights={"interactive": 8, "batch": 1},
+                      starvation_seconds=starvation_seconds)
+
+
+def _wait_for(condition, timeout=5.0):
+  end = time.time() + timeout
+  while not condition():
+    assert time.time() < end
+    time.sleep(0.005)
+
+
+def _enqueue(scheduler, priority_class, name, order):
+  # Starts a thread that takes a slot in <priority_class> and waits until its
+  # request is queued.
+  def run():
+    with scheduler.slot(priority_class):
+      order.append(name)
+  waiting = len(scheduler.queues.get(priority_class, []))
+  thread = threading.Thread(target=run)
+  thread.start()
+  _wait_for(lambda: len(scheduler.queues[priority_class]) > waiting)
+  return thread
+
+
+def _hold(scheduler):
+  held = scheduler.slot("batch")
+  held.__enter__()
+  return held
+
+
+def test_interactive_goes_before_waiting_batch():
+  scheduler = _scheduler()
+  order = []
+  held = _hold(scheduler)
+  threads = [_enqueue(scheduler, "batch", "batch 1", order),
+             _enqueue(scheduler, "batch", "batch 2", order),
+             _enqueue(scheduler, "interactive", "interactive", order)]
+  held.__exit__(None, None, None)
+  for thread in threads:
+    thread.join()
+
+  assert order[0] == "interactive"
+  # Within a class requests keep their arrival order.
+  assert order.index("batch 1") < order.index("batch 2")
+  stats = scheduler.stats()
+  assert stats["interactive"]["dispatched"] == 1
+  assert stats["batch"]["dispatched"] == 3
+  assert stats["batch"]["waiting"] == 0
+
+
+def test_priority_context_picks_class():
+  scheduler = _scheduler()
+  with llm_priority("interactive"):
+    assert scheduler.slot().priority_class == "interactive"
+  assert scheduler.slot().priority_class == "batch"
+
+
+def test_starved_batch_request_is_promoted():
+  scheduler = _scheduler(starvation_seconds=0.1)
+  # Batch has spent its share, so stride scheduling alone would keep
+  # choosing interactive.
+  scheduler.virtual_time["batch"] = 100.0
+  order = []
+  held = _hold(scheduler)
+  batch = _enqueue(scheduler, "batch", "batch", order)
+  time.sleep(0.2)
+  interactive = _enqueue(scheduler, "interactive", "interactive", order)
+  held.__exit__(None, None, None)
+  batch.join()
+  interactive.join()
+
+  assert order == ["batch", "interactive"]
+  assert scheduler.stats()["batch"]["starvation_promotions"] == 1
+
+
+def test_slot_is_released_when_call_raises():
+  scheduler = _scheduler()
+  with pytest.raises(ValueError):
+    with scheduler.slot("batch"):
+      raise ValueError()
+  assert scheduler.limiter.in_flight == 0
+  assert scheduler.limiter.counts["error"] == 1
+
+  # The single slot is free again for the next request.
+  with scheduler.slot("interactive"):
+    assert scheduler.limiter.in_flight == 1
+  assert scheduler.limiter.in_flight == 0
+
+
+def test_expired_request_leaves_queue():
+  scheduler = _scheduler()
+  held = _hold(scheduler)
+  with pytest.raises(DeadlineExceeded):
+    with deadline(0.1):
+      with scheduler.slot("batch"):
+        pass
+  assert len(scheduler.queues["batch"]) == 0
+  held.__exit__(None, None, None)
+  assert scheduler.limiter.in_flight == 0
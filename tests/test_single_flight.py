@@ -0,0 +1,154 @@
+import time
+import asyncio
+import threading
+
+import pytest
+
+from simulation_engine.deadline import DeadlineExceeded
+from simulation_engine.single_flight import SingleFlight
+
+
+def _wait_for(condition, timeout=5.0):
+  end = time.time() + timeout
+  while not condition():
+    assert time.time() < end
+    time.sleep(0.005)
+
+
+def _run_callers(flight, fn, num_callers):
+  # Starts a leader and <num_callers> - 1 followers on the same key, all
+  # waiting on the leader's call. Returns (threads, results, errors).
+  results, errors = [], []
+  def run():
+    try:
+      results.append(flight.do("key", fn))
+    except BaseException as e:
+      errors.append(e)
+  threads = [threading.Thread(target=run) for _ in range(num_callers)]
+  threads[0].start()
+  _wait_for(lambda: "key" in flight._calls)
+  for thread in threads[1:]:
+    thread.start()
+  _wait_for(lambda: flight.metrics["coalesced"] >= num_callers - 1)
+  return threads, results, errors
+
+
+def test_concurrent_calls_share_one_execution():
+  flight = SingleFlight()
+  release = threading.Event()
+  executions = []
+  def fn():
+    executions.append(1)
+    release.wait()
+    return "value"
+
+  threads, results, errors = _run_callers(flight, fn, 4)
+  release.set()
+  for thread in threads:
+    thread.join()
+
+  assert results == ["value"] * 4
+  assert errors == []
+  assert len(executions) == 1
+  assert flight.stats() == {"calls": 4, "executed": 1, "coalesced": 3,
+                            "in_flight": 0}
+
+  # Nothing is cached once the call finished.
+  assert flight.do("key", lambda: "again") == "again"
+
+
+def test_error_fans_out_to_followers():
+  flight = SingleFlight()
+  release = threading.Event()
+  def fn():
+    release.wait()
+    raise ValueError("boom")
+
+  threads, results, errors = _run_callers(flight, fn, 3)
+  release.set()
+  for thread in threads:
+    thread.join()
+
+  assert results == []
+  assert len(errors) == 3
+  assert all(isinstance(e, ValueError) for e in errors)
+  assert flight.metrics["executed"] == 1
+
+
+def test_abandoned_call_is_handed_to_follower():
+  flight = SingleFlight()
+  release = threading.Event()
+  executions = []
+  def fn():
+    executions.append(1)
+    if len(executions) == 1:
+      release.wait()
+      raise DeadlineExceeded("deadline exceeded")
+    return "value"
+
+  threads, results, errors = _run_callers(flight, fn, 2)
+  release.set()
+  for thread in threads:
+    thread.join()
+
+  # The leader's deadline stays with the leader; the follower runs the call
+  # again as the new leader.
+  assert len(errors) == 1 and isinstance(errors[0], DeadlineExceeded)
+  assert results == ["value"]
+  assert len(executions) == 2
+  # Each caller counts once however many times it retried.
+  assert flight.metrics["calls"] == 2
+  assert flight.metrics["executed"] == 2
+
+
+def test_async_calls_share_one_execution():
+  flight = SingleFlight()
+  executions = []
+  async def coro_fn():
+    executions.append(1)
+    await asyncio.sleep(0.05)
+    return "value"
+
+  async def main():
+    return await asyncio.gather(*[flight.do_async("key", coro_fn)
+                                  for _ in range(4)])
+
+  assert asyncio.run(main()) == ["value"] * 4
+  assert len(executions) == 1
+  assert flight.stats() == {"calls": 4, "executed": 1, "coalesced": 3,
+                            "in_flight": 0}
+
+
+def test_async_error_fans_out_and_cancelled_leader_hands_off():
+  flight = SingleFlight()
+  async def failing():
+    await asyncio.sleep(0.05)
+    raise ValueError("boom")
+
+  async def fan_out():
+    return await asyncio.gather(*[flight.do_async("key", failing)
+                                  for _ in range(3)], return_exceptions=True)
+
+  errors = asyncio.run(fan_out())
+  assert all(isinstance(e, ValueError) for e in errors)
+
+  flight = SingleFlight()
+  executions = []
+  async def slow():
+    executions.append(1)
+    await asyncio.sleep(0.05)
+    return "value"
+
+  async def handoff():
+    leader = asyncio.ensure_future(flight.do_async("key", slow))
+    await asyncio.sleep(0.01)
+    follower = asyncio.ensure_future(flight.do_async("key", slow))
+    await asyncio.sleep(0.01)
+    leader.cancel()
+    with pytest.raises(asyncio.CancelledError):
+      await leader
+    return await follower
+
+  assert asyncio.run(handoff()) == "value"
+  assert len(executions) == 2
+  assert flight.metrics["calls"] == 2
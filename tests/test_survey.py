@@ -0,0 +1,107 @@
+from environment.checkpoint import JsonlCheckpoint, wave_key
+from environment.survey.survey import Survey
+
+
+QUESTIONS = {"Do you vote?": ["Yes", "No"], "Do you drive?": ["Yes", "No"]}
+
+
+class _Agent:
+  def __init__(self, name, answers):
+    self.name = name
+    self.answers = answers
+    self.asked = []
+
+  def categorical_resp(self, questions, agent_desc=None, chunk_size=None):
+    self.asked += [list(questions)]
+    return {"responses": [self.answers[q] for q in questions],
+            "reasonings": ["" for _ in questions]}
+
+
+class _Pool:
+  def __init__(self, agents):
+    self.agents = agents
+
+  def get(self, agent_meta):
+    return self.agents[agent_meta["name"]]
+
+
+def _survey(agents):
+  survey = Survey(agent_pool=_Pool(agents))
+  survey.agent_registry = {name: {"name": name} for name in agents}
+  return survey
+
+
+def _agents():
+  return {"a": _Agent("a", {"Do you vote?": "Yes", "Do you drive?": "No"}),
+          "b": _Agent("b", {"Do you vote?": "No", "Do you drive?": "No"}),
+          "c": _Agent("c", {"Do you vote?": "Yes", "Do you drive?": "Yes"})}
+
+
+def _answers(survey):
+  responses = survey.responses.set_index("agent_pid").sort_index()
+  return {agent_pid: list(row) for agent_pid, row in
+          responses[list(QUESTIONS)].iterrows()}
+
+
+def test_resume_skips_agents_completed_in_the_checkpoint(tmp_path):
+  checkpoint_path = str(tmp_path / "wave.jsonl")
+  agents = _agents()
+  _survey({"a": agents["a"]}).survey(QUESTIONS,
+                                     checkpoint_path=checkpoint_path)
+  assert len(JsonlCheckpoint(checkpoint_path).read()) == 1
+
+  # a resumes from the checkpoint; b and c are asked.
+  survey = _survey(agents)
+  outputs = survey.survey(QUESTIONS, checkpoint_path=checkpoint_path)
+  assert [len(agent.asked) for agent in agents.values()] == [1, 1, 1]
+  assert sorted(output["agent_pid"] for output in outputs) == ["a", "b", "c"]
+  assert (survey.last_run["skipped"], survey.last_run["done"]) == (1, 2)
+  assert _answers(survey) == {"a": ["Yes", "No"], "b": ["No", "No"],
+                              "c": ["Yes", "Yes"]}
+
+  # Nothing is left to ask; resume=False asks everyone again.
+  _survey(agents).survey(QUESTIONS, checkpoint_path=checkpoint_path)
+  assert [len(agent.asked) for agent in agents.values()] == [1, 1, 1]
+  _survey(agents).survey(QUESTIONS, checkpoint_path=checkpoint_path,
+                         resume=False)
+  assert [len(agent.asked) for agent in agents.values()] == [2, 2, 2]
+
+
+def test_resume_only_counts_filtered_agents(tmp_path):
+  checkpoint_path = str(tmp_path / "wave.jsonl")
+  agents = _agents()
+  _survey(agents).survey(QUESTIONS, checkpoint_path=checkpoint_path)
+
+  # Only a and c answered Yes; b's checkpointed answers are left out.
+  survey = _survey(agents)
+  survey.survey({"Do you vote?": ["Yes", "No"]})
+  outputs = survey.survey(QUESTIONS, {"Do you vote?": "Yes"},
+                          checkpoint_path=checkpoint_path)
+  assert sorted(output["agent_pid"] for output in outputs) == ["a", "c"]
+  assert survey.last_run["skipped"] == 2
+
+
+def test_changed_questions_do_not_resume(tmp_path):
+  checkpoint_path = str(tmp_path / "wave.jsonl")
+  agents = _agents()
+  _survey(agents).survey(QUESTIONS, checkpoint_path=checkpoint_path)
+
+  reordered = dict(reversed(list(QUESTIONS.items())))
+  survey = _survey(agents)
+  survey.survey(reordered, checkpoint_path=checkpoint_path)
+  # Asked again, so the answers land in the reordered columns.
+  assert [len(agent.asked) for agent in agents.values()] == [2, 2, 2]
+  assert _answers(survey)["a"] == ["Yes", "No"]
+
+
+def test_wave_key_follows_the_questions():
+  key = wave_key(QUESTIONS)
+  assert wave_key(dict(QUESTIONS)) == key
+  assert wave_key({**QUESTIONS, "Do you cook?": ["Yes", "No"]}) != key
+  assert wave_key({"Do you vote?": ["Yes", "No", "Maybe"],
+                   "Do you drive?": ["Yes", "No"]}) != key
+  assert wave_key({"Do you vote?": ["Yes", "No"]}) != key
+  # An interview key covers its script and its context.
+  script = [["Hello?", 1]]
+  assert wave_key([script, ""]) != wave_key([script, "other"])
+  assert wave_key([script, ""]) != wave_key([[["Hi?", 1]], ""])